@@ -30,7 +30,7 @@ nodd_rtofs_topic_arn = 'arn:aws:sns:us-east-1:709902155096:NewRTOFSObject'
 # First nos ofs queue
 new_ofs_object_queue = MessageQueue(
     'nos-new-ofs-object-queue',
-    visibility_timeout=360,
+    visibility_timeout=720,
 )
 
 new_ofs_object_subscription = new_ofs_object_queue.subscribe_to_sns(
@@ -41,7 +41,7 @@ new_ofs_object_subscription = new_ofs_object_queue.subscribe_to_sns(
 # next, rtofs queue
 new_rtofs_object_queue = MessageQueue(
     'new-rtofs-object-queue',
-    visibility_timeout=360,
+    visibility_timeout=720,
 )
 
 new_rtofs_object_subscription = new_rtofs_object_queue.subscribe_to_sns(
@@ -49,13 +49,14 @@ new_rtofs_object_subscription = new_rtofs_object_queue.subscribe_to_sns(
     sns_arn=nodd_rtofs_topic_arn,
 )
 
-# Create the lambda to ingest NODD data into the bucket
+# Create the lambda to ingest NODD data into the bucket. Each invocation processes a batch of files,
+# so the queue visibility timeouts are kept at six times the lambda timeouts as recommended for sqs event sources
 # TODO: Decrease memory
 ingest_lambda = LocalDockerLambda(
     name="ingest-nos-to-zarr",
     repo="nextgen-dmac-ingest",
     path='./ingest',
-    timeout=60,
+    timeout=120,
     memory_size=1024,
     concurrency=6,
 )
@@ -69,13 +70,15 @@ ingest_lambda.add_s3_access('ingest-s3-lambda-policy', bucket.bucket)
 ingest_lambda.subscribe_to_sqs(
     subscription_name='nos-sqs-lambda-mapping',
     queue=new_ofs_object_queue.queue,
-    batch_size=1,
+    batch_size=10,
+    maximum_batching_window=5,
 )
 
 ingest_lambda.subscribe_to_sqs(
     subscription_name='rtofs-sqs-lambda-mapping',
     queue=new_rtofs_object_queue.queue,
-    batch_size=1,
+    batch_size=10,
+    maximum_batching_window=5,
 )
 
 # Okay now for the aggregation. This part of the infra will create an sqs queue that receives bucket notifications
@@ -99,7 +102,7 @@ bucket.subscribe_sns_to_bucket_notifications(
 # Create the queue for the aggregation lambda
 aggregation_queue = MessageQueue(
     'aggregation-queue',
-    visibility_timeout=720,
+    visibility_timeout=2880,
 )
 
 # Subscribe the aggregation queue to the ingestion bucket SNS topic
@@ -113,7 +116,7 @@ aggregation_lambda = LocalDockerLambda(
     name="aggregate-nos-zarr", 
     repo="nextgen-dmac-aggregation",
     path='./aggregation',
-    timeout=240,
+    timeout=480,
     memory_size=1536,
     concurrency=6,
 )
@@ -122,8 +125,11 @@ aggregation_lambda = LocalDockerLambda(
 # to the aggregation queue
 aggregation_lambda.add_cloudwatch_log_access()
 aggregation_lambda.add_s3_access('aggreagtion-s3-lambda-policy', bucket.bucket)
+# The batching window is the debounce window of the aggregations, the notifications for every
+# file written within it update each aggregation once
 aggregation_lambda.subscribe_to_sqs(
     subscription_name='nos-aggregation-lambda-mapping',
     queue=aggregation_queue.queue,
-    batch_size=1,
+    batch_size=100,
+    maximum_batching_window=60,
 )
@@ -138,13 +138,15 @@ class LocalDockerLambda(pulumi.ComponentResource):
 
         return self.attach_policy_to_role(f"{policy_name}_{self._name}_attachment", lambda_s3_policy)
 
-    def subscribe_to_sqs(self, subscription_name: str, queue: sqs.Queue, batch_size: int):
+    def subscribe_to_sqs(self, subscription_name: str, queue: sqs.Queue, batch_size: int, maximum_batching_window: int = 0):
         '''
-        Subscribes the lambda function to an sqs queue
+        Subscribes the lambda function to an sqs queue. The lambda function is expected to report
+        partial batch failures, so only the failed messages of a batch are returned to the queue
 
         :param subscription_name: The name of the subscription to create
         :param sqs_queue: The sqs queue to subscribe to
         :param batch_size: The number of messages to retrieve from the queue per lambda invocation
+        :param maximum_batching_window: The maximum number of seconds to wait to fill a batch before invoking the lambda
 
         :returns: The event source mapping
         '''
@@ -171,11 +173,12 @@ class LocalDockerLambda(pulumi.ComponentResource):
 
         # Then we can create the event mapping
         # TODO: Include filters! (https://www.pulumi.com/registry/packages/aws/api-docs/lambda/eventsourcemapping/#sqs-with-event-filter)
-        # TODO: Use larger batches? (https://www.pulumi.com/registry/packages/aws/api-docs/lambda/eventsourcemapping/#batch-size)
         return lambda_.EventSourceMapping(
             subscription_name, 
             event_source_arn=queue.arn.apply(lambda arn: f"{arn}"),
             function_name=self.lambda_.arn.apply(lambda arn: f"{arn}"),
             batch_size=batch_size,
+            maximum_batching_window_in_seconds=maximum_batching_window,
+            function_response_types=['ReportBatchItemFailures'],
             opts=pulumi.ResourceOptions(parent=self, depends_on=[self.lambda_, lambda_sqs_policy_attachemnt, queue])
         )
\ No newline at end of file
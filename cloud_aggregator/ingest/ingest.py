@@ -1,31 +1,36 @@
+from ingest_tools.engine import IngestEngine
 from ingest_tools.pipeline import PipelineContext
-from ingest_tools.nos_ofs import NOS_Pipeline
-from ingest_tools.rtofs import RTOFS_Pipeline
-from ingest_tools.aws import parse_s3_sqs_payload
 
 
 # TODO: Make these configurable
 DESTINATION_BUCKET_NAME='nextgen-dmac-cloud-ingest'
+MAX_CONCURRENT_FILES = 16
+
+# The pipelines and their routing table are built once per container and reused by every invocation
+_contexts = {}
+
+
+def get_context(region: str) -> PipelineContext:
+    context = _contexts.get(region)
+    if context is None:
+        context = PipelineContext.from_entry_points(region, DESTINATION_BUCKET_NAME)
+        _contexts[region] = context
+    return context
+
+
+_engine = IngestEngine(get_context, max_concurrent=MAX_CONCURRENT_FILES)
+
 
 def handler(event, context):
     '''
     This is the entry point for the ingest lambda function. It is responsible for
-    taking the event from the NOS new object topic and processing it. This means
-    scanning the netcdf file and extracting the metadata to create a virtual 
+    taking the events from the NOS new object topic and processing them. This means
+    scanning each netcdf file and extracting the metadata to create a virtual 
     zarr representation of the dataset in the referenced object. 
-    '''
-    payload = event['Records'][0]['body']
-    
-    print(f'Ingesting SQS Message: {payload}')
-
-    region, bucket, key = parse_s3_sqs_payload(payload)
 
-    context = PipelineContext(region, DESTINATION_BUCKET_NAME)
-
-    # TODO: These could get auto-registered
-    context.add_pipeline('nos_ofs', NOS_Pipeline())
-    context.add_pipeline('rtofs', RTOFS_Pipeline())
+    The files of the batch are kerchunked concurrently, and the records that failed
+    are reported back so that only those are redelivered.
+    '''
+    print(f'Ingesting {len(event["Records"])} SQS Messages')
 
-    matching = context.get_matching_pipelines(key)
-    for pipeline in matching:
-        pipeline.run(context.get_region(), bucket, key, context.get_dest_bucket())    
\ No newline at end of file
+    return _engine.handle_batch(event['Records'])    
\ No newline at end of file
@@ -22,22 +22,31 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import base64
+import hashlib
 import logging
 import os
 import re
+import threading
+import time
 import types
+import uuid
+import weakref
 from abc import abstractmethod, ABC
+from collections import OrderedDict
 from pathlib import PurePosixPath
-from typing import Dict, Union
+from typing import Dict, Iterable, Set, Union
 import json
 import ujson
 import fsspec
 import gcsfs
 import datetime
-import xarray as xr
+import numpy as np
+import zarr
 
 from dask.distributed import Client
 
+import cfgrib.dataset
 from kerchunk.grib2 import scan_grib
 from kerchunk.combine import MultiZarrToZarr
 
@@ -46,17 +55,15 @@ from google.cloud import pubsub_v1
 
 logger = logging.getLogger(__name__)
 
-# Arguments for scan_grib to extract surface variables
-SCAN_SURFACE_INSTANT_GRIB = dict(
-    filter=dict(typeOfLevel="surface", stepType="instant"),
-    storage_options=dict(token=None),
+# Named level selections extracted from each grib file, every file is scanned once for all of them
+GRIB_LEVEL_SELECTIONS = dict(
+    surface=dict(typeOfLevel="surface", stepType="instant"),
+    height_above_ground=dict(typeOfLevel="heightAboveGround", stepType="instant"),
 )
+GRIB_STORAGE_OPTIONS = dict(token=None)
 
-# Arguments for scan_grib to extract height above ground variables
-SCAN_HEIGHT_ABOVE_GROUND_INSTANT_GRIB = dict(
-    filter=dict(typeOfLevel="heightAboveGround", stepType="instant"),
-    storage_options=dict(token=None),
-)
+# Coordinates that are the same for all the inputs of an aggregation
+IDENTICAL_DIMS = ["latitude", "longitude", "step"]
 
 consts = types.SimpleNamespace()
 consts.EXTRACTED_BUCKET = "gcp-public-data-weather"
@@ -69,6 +76,210 @@ consts.ALLTIME_HORIZON = "alltime_horizon"
 # Cloud archive goes back to 2014. Are there different variables or dimensions?
 # https://rapidrefresh.noaa.gov/hrrr/
 consts.ALL_TIME_START_DATE = "2020-06-01"
+# Root attribute of the aggregation listing its input blobs, used to append new inputs to an existing aggregation.
+# It is kept in the root .zattrs so the aggregation stays a standard kerchunk version 1 reference set.
+consts.AGGREGATION_MEMBERS = "aggregation_members"
+
+
+class GribValidator(ABC):
+    """
+    Base class for the checks of the references extracted from a grib file before they are written.
+    Sometimes the output is truncated so make sure we don't aggregate broken data.
+    """
+
+    @abstractmethod
+    def validate(
+        self,
+        references: dict,
+        input_fs: fsspec.spec.AbstractFileSystem,
+        input_url: str,
+    ) -> None:
+        """
+        :param references: the combined zarr references of the grib file
+        :param input_fs: the filesystem of the grib file
+        :param input_url: the url of the grib file
+        :raises AssertionError: if the references are not valid
+        """
+
+
+class DecodedTemperatureValidator(GribValidator):
+    """
+    Decode the temperature with numpy and check it has no nan values and a plausible mean. With a stride, only a
+    regular sample of the grid is checked. The grib messages are still decoded whole, but the statistics are computed
+    on a fraction of the values.
+    """
+
+    def __init__(
+        self,
+        variable: str = "t",
+        grid_shape: tuple[int, int] = (1059, 1799),
+        min_mean: float = 250.0,
+        stride: int = 1,
+    ):
+        """
+        :param variable: the temperature variable
+        :param grid_shape: the shape of the gridded domain
+        :param min_mean: the lowest plausible mean temperature in kelvin
+        :param stride: check every stride-th value along each grid dimension
+        """
+        self.variable = variable
+        self.grid_shape = tuple(grid_shape)
+        self.min_mean = min_mean
+        self.stride = stride
+
+    def validate(
+        self,
+        references: dict,
+        input_fs: fsspec.spec.AbstractFileSystem,
+        input_url: str,
+    ) -> None:
+        fs = fsspec.filesystem("reference", fo=references, fs=input_fs)
+        array = zarr.open_array(fs.get_mapper(self.variable), mode="r")
+        assert (
+            tuple(array.shape[-2:]) == self.grid_shape
+        ), "HRRR Temperature grid is the wrong shape!"
+
+        # Missing messages read as the nan fill value
+        values = array[..., :: self.stride, :: self.stride]
+        assert (
+            np.count_nonzero(np.isnan(values)) == 0
+        ), "HRRR Temperature values are nan!"
+        assert values.mean() > self.min_mean, "HRRR Temperature values are too low!"
+
+
+class ReferencesValidator(GribValidator):
+    """
+    Check the references without decoding any message: every chunk of every array must be referenced, and every
+    referenced message must be a non empty byte range inside the grib file.
+    """
+
+    def validate(
+        self,
+        references: dict,
+        input_fs: fsspec.spec.AbstractFileSystem,
+        input_url: str,
+    ) -> None:
+        refs = references.get("refs", references)
+        input_size = None
+        for name in [k[: -len("/.zarray")] for k in refs if k.endswith("/.zarray")]:
+            zarray = ujson.loads(refs[f"{name}/.zarray"])
+            expected_chunks = 1
+            for size, chunk in zip(zarray["shape"], zarray["chunks"]):
+                expected_chunks *= -(-size // chunk)
+            chunk_keys = [
+                k
+                for k in _array_keys(refs, name)
+                if not k.rsplit("/", 1)[-1].startswith(".z")
+            ]
+            assert (
+                len(chunk_keys) == expected_chunks
+            ), f"HRRR {name} has {len(chunk_keys)} of {expected_chunks} chunks!"
+
+            for key in chunk_keys:
+                ref = refs[key]
+                if not isinstance(ref, list) or len(ref) != 3:
+                    # Inline data or a whole file reference
+                    continue
+                _, offset, length = ref
+                if input_size is None:
+                    input_size = input_fs.size(input_url)
+                assert (
+                    offset >= 0 and length > 0 and offset + length <= input_size
+                ), f"HRRR {key} references bytes {offset}-{offset + length} of {input_size}!"
+
+
+DEFAULT_GRIB_VALIDATOR = DecodedTemperatureValidator()
+
+
+# Message keys that scan_grib records as attributes of the message variable, messages can be routed by these
+GRIB_ATTRIBUTE_KEYS = set(
+    cfgrib.dataset.DATA_ATTRIBUTES_KEYS + cfgrib.dataset.EXTRA_DATA_ATTRIBUTES_KEYS
+)
+
+
+def _matches(attributes: dict, selection: dict) -> bool:
+    """
+    Match the attributes of a message against a scan_grib filter
+    :param attributes: the message attributes
+    :param selection: the filter, each key must exist and have the exact value or be in the given set
+    :return: whether the message passes the filter
+    """
+    for key, value in selection.items():
+        if key not in attributes:
+            return False
+        if isinstance(value, (list, tuple, set)):
+            if attributes[key] not in value:
+                return False
+        elif attributes[key] != value:
+            return False
+    return True
+
+
+def _message_attributes(entry: dict) -> dict:
+    """
+    The attributes of the variable of a message scanned by scan_grib. Older kerchunk versions do not prefix them
+    with GRIB_.
+    :param entry: the references of the message
+    :return: the attributes, without the GRIB_ prefix
+    """
+    refs = entry.get("refs", entry)
+    for key, value in refs.items():
+        if not key.endswith("/.zattrs"):
+            continue
+        attributes = {
+            k[len("GRIB_") :] if k.startswith("GRIB_") else k: v
+            for k, v in ujson.loads(value).items()
+        }
+        if "paramId" in attributes:
+            return attributes
+    return {}
+
+
+def scan_grib_selections(
+    url: str, selections: Dict[str, dict], **kwargs
+) -> Dict[str, list]:
+    """
+    Scan a grib file once for several level selections. The messages are read with a single scan_grib pass using
+    the union of the selections, then each message is routed to every selection it matches. Selections that filter
+    on keys scan_grib does not keep as attributes are scanned separately.
+    :param url: the grib file url
+    :param selections: scan_grib filters by selection name
+    :param kwargs: other arguments for scan_grib, like storage_options
+    :return: the scan_grib entries of each selection by name
+    """
+    routed = {
+        name: selection
+        for name, selection in selections.items()
+        if set(selection).issubset(GRIB_ATTRIBUTE_KEYS)
+    }
+    results = {name: [] for name in selections}
+
+    if routed:
+        # Only keys used by every selection can be filtered on, with the union of their values
+        common_keys = set.intersection(
+            *(set(selection) for selection in routed.values())
+        )
+        union = {}
+        for key in common_keys:
+            values = set()
+            for selection in routed.values():
+                value = selection[key]
+                values.update(
+                    value if isinstance(value, (list, tuple, set)) else [value]
+                )
+            union[key] = values
+
+        for entry in scan_grib(url, filter=union, **kwargs):
+            attributes = _message_attributes(entry)
+            for name, selection in routed.items():
+                if _matches(attributes, selection):
+                    results[name].append(entry)
+
+    for name, selection in selections.items():
+        if name not in routed:
+            results[name] = scan_grib(url, filter=selection, **kwargs)
+
+    return results
 
 
 def extract_grib(
@@ -77,6 +288,7 @@ def extract_grib(
     input_object_path: PurePosixPath,
     output_fs: fsspec.spec.AbstractFileSystem,
     output_base_path: PurePosixPath,
+    validator: GribValidator = None,
 ) -> str:
     """
     This method extracts data from the original grib2 file using the kerchunk scan_grib method.
@@ -87,6 +299,7 @@ def extract_grib(
     :param input_object_path: the path to the object
     :param output_fs:
     :param output_base_path:
+    :param validator: checks the extracted references, DEFAULT_GRIB_VALIDATOR if None
     """
 
     input_path = input_base_path / input_object_path
@@ -99,11 +312,9 @@ def extract_grib(
 
     input_url = input_fs.open(input_path).full_name
 
-    # The scan method produces a list of entries
-    zarr_meta_surface = scan_grib(input_url, **SCAN_SURFACE_INSTANT_GRIB)
-
-    zarr_meta_height_above_ground = scan_grib(
-        input_url, **SCAN_HEIGHT_ABOVE_GROUND_INSTANT_GRIB
+    # The scan method produces a list of entries for each level selection
+    scanned = scan_grib_selections(
+        input_url, GRIB_LEVEL_SELECTIONS, storage_options=GRIB_STORAGE_OPTIONS
     )
 
     # Some filesystems have multiple string protocol names
@@ -113,7 +324,7 @@ def extract_grib(
 
     # The Multizarr To Zarr translate method produces a readable file from the aggregated metadata
     combined_zarr_meta = MultiZarrToZarr(
-        zarr_meta_surface + zarr_meta_height_above_ground,
+        [entry for name in GRIB_LEVEL_SELECTIONS for entry in scanned[name]],
         remote_protocol=protocol,
         remote_options={},
         concat_dims=["valid_time"],
@@ -121,27 +332,9 @@ def extract_grib(
     ).translate()
 
     # Check for valid data - sometimes the output is truncated so make sure we don't aggregate broken data
-    r_opts = {"anon": True}
-    fs = fsspec.filesystem(
-        protocol="reference",
-        fo=combined_zarr_meta,
-        remote_protocol=protocol,
-        remote_options={},
+    (validator or DEFAULT_GRIB_VALIDATOR).validate(
+        combined_zarr_meta, input_fs, input_url
     )
-    ds = xr.open_dataset(
-        fs.get_mapper(""),
-        engine="zarr",
-        backend_kwargs=dict(consolidated=False),
-        chunks={"valid_time": 1},
-        drop_variables=["heightAboveGround"],  # Why is does this break zarr?
-    )
-    temp_stats = ds.t.to_dataframe().describe()
-    # logger.info(temp_stats)
-    # Assert the count is the size of the gridded domain
-    assert (
-        temp_stats.loc["count", "t"] == 1059 * 1799
-    ), "HRRR Temperature values are nan!"
-    assert temp_stats.loc["mean", "t"] > 250.0, "HRRR Temperature values are too low!"
 
     # Parse the input path to get the output name
     # Example: gcs://high-resolution-rapid-refresh/hrrr.20221028/conus/hrrr.t00z.wrfsubhf01.grib2"
@@ -160,22 +353,151 @@ def extract_grib(
     return output_blob_path
 
 
-def filter_on_presence(paths: [str], fs: fsspec.spec.AbstractFileSystem) -> [str]:
+def list_directory(fs: fsspec.spec.AbstractFileSystem, directory: str) -> Set[str]:
+    """
+    List the paths in a directory with a single request
+    :param fs: the filesystem to list
+    :param directory: the directory path
+    :return: the set of paths in the directory, empty if the directory does not exist
+    """
+    try:
+        return {fs._strip_protocol(path) for path in fs.ls(directory, detail=False)}
+    except FileNotFoundError:
+        return set()
+
+
+class _Listings(OrderedDict):
+    """
+    Listings shared by the copies of a cache, least recently used first
+    """
+
+
+class DirectoryListingCache:
+    """
+    Short lived cache of directory listings, used to resolve the presence of aggregation inputs.
+    Each operator owns a cache so that a burst of messages for the same day shares one listing.
+    Copies of a cache that are sent to the same dask worker process share their listings.
+    Expired listings are evicted whenever the cache is used, and at most max_listings are kept.
+    """
+
+    # Listings of every cache in this process by cache name, dropped once no copy of the cache is left
+    _LISTINGS: "weakref.WeakValueDictionary[str, _Listings]" = weakref.WeakValueDictionary()
+    _LOCK = threading.Lock()
+
+    def __init__(self, ttl: float = 30.0, name: str = None, max_listings: int = 256):
+        """
+        :param ttl: seconds a listing is reused for
+        :param name: identifies the listings shared by the copies of the cache
+        :param max_listings: the number of listings kept, the least recently used listing is evicted first
+        """
+        self.ttl = ttl
+        self.name = name or uuid.uuid4().hex
+        self.max_listings = max_listings
+        with self._LOCK:
+            self._listings = self._LISTINGS.setdefault(self.name, _Listings())
+
+    def __reduce__(self):
+        return DirectoryListingCache, (self.ttl, self.name, self.max_listings)
+
+    def listing(
+        self, fs: fsspec.spec.AbstractFileSystem, directory: str, refresh: bool = False
+    ) -> tuple[Set[str], bool]:
+        """
+        Get the listing of a directory, from the cache if it is recent enough
+        :param fs: the filesystem to list
+        :param directory: the directory path
+        :param refresh: list the directory even if a recent listing is cached
+        :return: the set of paths in the directory and whether it was listed by this call
+        """
+        now = time.monotonic()
+        # The token identifies equivalent filesystem instances, including copies in other processes
+        key = (getattr(fs, "_fs_token", id(fs)), directory)
+        with self._LOCK:
+            self._evict_expired(now)
+            cached = self._listings.get(key)
+            if not refresh and cached is not None:
+                self._listings.move_to_end(key)
+                return cached[1], False
+
+        paths = list_directory(fs, directory)
+        with self._LOCK:
+            self._listings[key] = (now, paths)
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.max_listings:
+                self._listings.popitem(last=False)
+        return paths, True
+
+    def _evict_expired(self, now: float):
+        expired = [
+            key
+            for key, (listed_at, _) in self._listings.items()
+            if now - listed_at >= self.ttl
+        ]
+        for key in expired:
+            del self._listings[key]
+
+    def __len__(self):
+        return len(self._listings)
+
+    def clear(self):
+        with self._LOCK:
+            self._listings.clear()
+
+
+def resolve_presence(
+    paths: [str],
+    fs: fsspec.spec.AbstractFileSystem,
+    cache: DirectoryListingCache = None,
+) -> Set[str]:
+    """
+    Resolve which paths exist with one listing per parent directory instead of a request per path
+    :param paths: the paths to check
+    :param fs: the filesystem to check
+    :param cache: optional cache of recent listings. Paths that are missing from a cached listing are confirmed by
+    listing their directory again, so blobs written after the cached listing are not skipped
+    :return: the set of input paths that exist
+    """
+    by_directory = {}
+    for path in paths:
+        by_directory.setdefault(fs._parent(path), []).append(path)
+
+    present = set()
+    for directory, children in by_directory.items():
+        if cache is None:
+            listed = list_directory(fs, directory)
+        else:
+            listed, fresh = cache.listing(fs, directory)
+            if not fresh and any(
+                fs._strip_protocol(path) not in listed for path in children
+            ):
+                listed, _ = cache.listing(fs, directory, refresh=True)
+
+        present.update(path for path in children if fs._strip_protocol(path) in listed)
+    return present
+
+
+def filter_on_presence(
+    paths: [str],
+    fs: fsspec.spec.AbstractFileSystem,
+    presence_cache: DirectoryListingCache = None,
+) -> [str]:
     """
     Filter the input list of paths based on their presence in the file system
-    :param paths: the
-    :param fs:
-    :return:
+    :param paths: the paths to filter
+    :param fs: the filesystem to check
+    :param presence_cache: optional cache of recent directory listings
+    :return: the sorted paths that are present
     """
     fs = fs or gcsfs.GCSFileSystem(token=None)
 
     paths = sorted(paths)
+    present = resolve_presence(paths, fs, cache=presence_cache)
 
     missing = []
     absence = False
     gap = False
     for path in paths:
-        if not fs.exists(path):
+        if path not in present:
             missing.append(path)
             absence = True
         else:
@@ -207,7 +529,306 @@ def filter_on_presence(paths: [str], fs: fsspec.spec.AbstractFileSystem) -> [str
     return paths
 
 
-def multizarr(fs: fsspec.spec.AbstractFileSystem, blobs: [str], out_path: str) -> str:
+def _read_array(refs: dict, name: str, remote_protocol: str) -> np.ndarray:
+    """
+    Read the raw (not CF decoded) values of an array from zarr references
+    :param refs: the flat references
+    :param name: the array name
+    :param remote_protocol: the protocol of the referenced blobs
+    :return: the values of the array
+    """
+    fs = fsspec.filesystem(
+        "reference", fo=refs, remote_protocol=remote_protocol, remote_options={}
+    )
+    return zarr.open_array(fs.get_mapper(name), mode="r")[:]
+
+
+def _array_keys(refs: dict, name: str) -> [str]:
+    """
+    The keys of the metadata and chunks of an array in zarr references
+    :param refs: the flat references
+    :param name: the array name
+    :return: the keys of the array
+    """
+    prefix = f"{name}/"
+    return [k for k in refs if k.startswith(prefix) and "/" not in k[len(prefix) :]]
+
+
+def _hash_arrays(refs: dict, names: [str]) -> str:
+    """
+    Hash the references of a set of arrays, to compare them across aggregations without keeping them around
+    :param refs: the flat references
+    :param names: the array names
+    :return: the hex digest of the sorted keys and values of the arrays
+    """
+    digest = hashlib.sha256()
+    for name in sorted(names):
+        for key in sorted(_array_keys(refs, name)):
+            digest.update(key.encode())
+            digest.update(ujson.dumps(refs[key]).encode())
+    return digest.hexdigest()
+
+
+def merge_references(
+    references: Iterable[dict],
+    concat_dim: str,
+    identical_dims: [str] = (),
+    verify_identical: bool = True,
+    remote_protocol: str = None,
+) -> dict:
+    """
+    Concatenate aggregations along the concat dimension directly from their references, without reading their
+    members or decoding any coordinate but the concat coordinate. Chunk keys are renumbered with the offset of each
+    aggregation and the concat coordinate is written as a single inline chunk.
+    :param references: the aggregation references, in order. The concat values of each aggregation must be sorted
+    and follow all the values of the previous aggregations.
+    :param concat_dim: the dimension to concatenate along
+    :param identical_dims: arrays that are kept from the first aggregation, like MultiZarrToZarr does
+    :param verify_identical: check that the identical arrays of every aggregation match the first one. Other arrays
+    without the concat dimension must always match.
+    :param remote_protocol: the protocol of the referenced blobs
+    :return: the merged references
+    :raises ValueError: if the aggregations can not be merged, in which case they must be combined from their members
+    """
+    out = None
+    arrays = None
+    concat_arrays = {}
+    first_hashes = None
+    values = []
+    for refs in references:
+        refs = refs.get("refs", refs)
+
+        refs_values = _read_array(refs, concat_dim, remote_protocol)
+        if len(refs_values) == 0:
+            continue
+        if np.any(np.diff(refs_values) <= 0) or (
+            len(values) > 0 and refs_values[0] <= values[-1][-1]
+        ):
+            raise ValueError(
+                f"{concat_dim} values are not sorted and disjoint across the aggregations"
+            )
+        values.append(refs_values)
+
+        refs_arrays = {k[: -len("/.zarray")] for k in refs if k.endswith("/.zarray")}
+        if out is None:
+            # The first aggregation is the base, its metadata and identical arrays are kept
+            out = dict(refs)
+            arrays = refs_arrays
+            for name in sorted(arrays - {concat_dim}):
+                dims = ujson.loads(refs.get(f"{name}/.zattrs", "{}")).get(
+                    "_ARRAY_DIMENSIONS", []
+                )
+                if concat_dim in dims:
+                    concat_arrays[name] = (
+                        dims.index(concat_dim),
+                        ujson.loads(refs[f"{name}/.zarray"]),
+                    )
+            fixed = arrays - {concat_dim} - set(concat_arrays) - set(identical_dims)
+            first_hashes = (
+                _hash_arrays(refs, fixed),
+                _hash_arrays(refs, set(identical_dims) & arrays),
+            )
+            continue
+
+        if refs_arrays != arrays:
+            raise ValueError(
+                f"Arrays differ between the aggregations: {sorted(refs_arrays ^ arrays)}"
+            )
+        fixed = arrays - {concat_dim} - set(concat_arrays) - set(identical_dims)
+        if _hash_arrays(refs, fixed) != first_hashes[0]:
+            raise ValueError(f"Arrays {sorted(fixed)} differ between the aggregations")
+        if verify_identical and (
+            _hash_arrays(refs, set(identical_dims) & arrays) != first_hashes[1]
+        ):
+            raise ValueError(
+                f"Identical dims {sorted(identical_dims)} differ between the aggregations"
+            )
+
+        for name, (axis, zarray) in concat_arrays.items():
+            refs_zarray = ujson.loads(refs[f"{name}/.zarray"])
+            chunk = zarray["chunks"][axis]
+            same_layout = {**zarray, "shape": None} == {**refs_zarray, "shape": None}
+            if not same_layout or zarray["shape"][axis] % chunk != 0:
+                raise ValueError(
+                    f"Array {name} chunks do not line up between the aggregations"
+                )
+
+            offset = zarray["shape"][axis] // chunk
+            for key in _array_keys(refs, name):
+                chunk_key = key[len(name) + 1 :]
+                if chunk_key.startswith(".z"):
+                    continue
+                parts = chunk_key.split(".")
+                parts[axis] = str(int(parts[axis]) + offset)
+                out[f"{name}/{'.'.join(parts)}"] = refs[key]
+            zarray["shape"][axis] += refs_zarray["shape"][axis]
+
+    if out is None:
+        raise ValueError(f"None of the aggregations have {concat_dim} values")
+
+    for name, (axis, zarray) in concat_arrays.items():
+        out[f"{name}/.zarray"] = ujson.dumps(zarray)
+
+    # Write the concatenated coordinate values as one inline chunk
+    values = np.concatenate(values)
+    zarray = ujson.loads(out[f"{concat_dim}/.zarray"])
+    zarray["shape"] = [len(values)]
+    zarray["chunks"] = [len(values)]
+    store = {".zarray": ujson.dumps(zarray).encode()}
+    zarr.open_array(store, mode="r+")[:] = values
+    for key in _array_keys(out, concat_dim):
+        if not key.rsplit("/", 1)[-1].startswith(".z"):
+            del out[key]
+    out[f"{concat_dim}/.zarray"] = store[".zarray"].decode()
+    out[f"{concat_dim}/0"] = "base64:" + base64.b64encode(store["0"]).decode()
+
+    return {"version": 1, "refs": out}
+
+
+def _combine(fs: fsspec.spec.AbstractFileSystem, blobs: [str]) -> dict:
+    """
+    Combine zarr metadata blobs along valid_time with kerchunk MultiZarrToZarr
+    :param fs: filesystem to read from
+    :param blobs: the zarr metadata blobs
+    :return: the combined references
+    """
+    # Some filesystems have multiple string protocol names
+    protocol = fs.protocol
+    if isinstance(protocol, (list, tuple)):
+        protocol = protocol[0]
+
+    mzz = MultiZarrToZarr(
+        [f"{protocol}://{blob}" for blob in blobs],
+        remote_protocol=protocol,
+        remote_options={},
+        concat_dims=["valid_time"],
+        identical_dims=IDENTICAL_DIMS,
+    )
+    return mzz.translate()
+
+
+def get_aggregation_members(references: dict) -> Union[list, None]:
+    """
+    Get the input blobs of an aggregation from the attributes of its root group
+    :param references: the aggregation references
+    :return: the sorted input blobs, or None if the aggregation does not list them
+    """
+    zattrs = references.get("refs", references).get(".zattrs")
+    if zattrs is None:
+        return None
+    return ujson.loads(zattrs).get(consts.AGGREGATION_MEMBERS)
+
+
+def set_aggregation_members(references: dict, blobs: [str]):
+    """
+    List the input blobs of an aggregation in the attributes of its root group
+    :param references: the aggregation references, updated in place
+    :param blobs: the sorted input blobs
+    """
+    refs = references.get("refs", references)
+    zattrs = ujson.loads(refs.get(".zattrs", "{}"))
+    zattrs[consts.AGGREGATION_MEMBERS] = blobs
+    refs[".zattrs"] = ujson.dumps(zattrs)
+
+
+def _append_to_existing(
+    fs: fsspec.spec.AbstractFileSystem, blobs: [str], out_path: str
+) -> Union[dict, None]:
+    """
+    Append the blobs that are not yet part of the aggregation at out_path to it
+    :param fs: filesystem to read from
+    :param blobs: the sorted blobs of the aggregation
+    :param out_path: the path of the existing aggregation
+    :return: the appended references, the existing references if there is nothing to append, or None if the
+    aggregation has to be rebuilt from all of its blobs
+    """
+    if not fs.exists(out_path):
+        return None
+
+    with fs.open(out_path, "r") as f:
+        existing = ujson.load(f)
+
+    members = get_aggregation_members(existing)
+    if members is None:
+        logger.info("Rebuilding aggregation without a list of members: %s", out_path)
+        return None
+
+    if not set(members).issubset(blobs):
+        logger.info(
+            "Rebuilding aggregation with members that are missing: %s", out_path
+        )
+        return None
+
+    new_blobs = sorted(set(blobs) - set(members))
+    if len(new_blobs) == 0:
+        return existing
+
+    if len(members) > 0 and new_blobs[0] < members[-1]:
+        # A late blob belongs in the middle of the aggregation
+        logger.info(
+            "Rebuilding aggregation with out of order member %s: %s",
+            new_blobs[0],
+            out_path,
+        )
+        return None
+
+    protocol = fs.protocol
+    if isinstance(protocol, (list, tuple)):
+        protocol = protocol[0]
+
+    try:
+        # The step of the members of a forecast run differs, MultiZarrToZarr keeps the first one
+        return merge_references(
+            [existing, _combine(fs, new_blobs)],
+            "valid_time",
+            identical_dims=IDENTICAL_DIMS,
+            verify_identical=False,
+            remote_protocol=protocol,
+        )
+    except ValueError as e:
+        logger.info(
+            "Rebuilding aggregation that can not be appended to (%s): %s", e, out_path
+        )
+        return None
+
+
+def _merge_aggregations(
+    fs: fsspec.spec.AbstractFileSystem, blobs: [str]
+) -> Union[dict, None]:
+    """
+    Merge aggregations with disjoint valid_time ranges, like the daily aggregations of a month, from their references
+    :param fs: filesystem to read from
+    :param blobs: the sorted aggregation blobs
+    :return: the merged references, or None if the aggregations have to be combined from their members
+    """
+    protocol = fs.protocol
+    if isinstance(protocol, (list, tuple)):
+        protocol = protocol[0]
+
+    # Fetch all the blobs in one batch, concurrently on async filesystems
+    contents = fs.cat(blobs)
+    try:
+        return merge_references(
+            (ujson.loads(contents.pop(fs._strip_protocol(blob))) for blob in blobs),
+            "valid_time",
+            identical_dims=IDENTICAL_DIMS,
+            remote_protocol=protocol,
+        )
+    except ValueError as e:
+        logger.warning(
+            "Combining aggregations that can not be merged (%s): %s", e, blobs
+        )
+        return None
+
+
+def multizarr(
+    fs: fsspec.spec.AbstractFileSystem,
+    blobs: [str],
+    out_path: str,
+    presence_cache: DirectoryListingCache = None,
+    append: bool = False,
+    merge: bool = False,
+) -> str:
     """
     Given a set of input blob paths for zarr data, create an aggregation and store it in the specified output path
     This method is naive and should probably stay that way. Don't do fancy parallelization here.
@@ -215,30 +836,37 @@ def multizarr(fs: fsspec.spec.AbstractFileSystem, blobs: [str], out_path: str) -
     :param fs: filesystem to read and write to
     :param blobs: a list of zarr metadata blobs to aggregate
     :param out_path: the output key path for the aggregated zarr data
+    :param presence_cache: optional cache of recent directory listings shared by the aggregations of an operator
+    :param append: only add the blobs that follow the members of the existing aggregation to it. Out of order blobs
+    rebuild the aggregation from all the blobs.
+    :param merge: the blobs are aggregations with disjoint valid_time ranges, merge their references instead of
+    combining them with MultiZarrToZarr
     :return:
     """
 
     # MultiZarrToZarr will fail on missing blobs,
     # the error message is obtuse and hard to understand because the path is url encoded.
     # Better to explicitly check for the files that are present and ignore missing
-    filtered_blobs = filter_on_presence(blobs, fs=fs)
+    filtered_blobs = filter_on_presence(blobs, fs=fs, presence_cache=presence_cache)
 
     if len(filtered_blobs) == 0:
         raise RuntimeError("None of the aggregation blobs are present!")
 
-    # Some filesystems have multiple string protocol names
-    protocol = fs.protocol
-    if isinstance(protocol, (list, tuple)):
-        protocol = protocol[0]
+    combined_zarr_meta = None
+    if append:
+        combined_zarr_meta = _append_to_existing(fs, filtered_blobs, out_path)
+        if (
+            combined_zarr_meta is not None
+            and get_aggregation_members(combined_zarr_meta) == filtered_blobs
+        ):
+            logger.info("Aggregation is up to date: %s", out_path)
+            return out_path
 
-    mzz = MultiZarrToZarr(
-        [f"{protocol}://{blob}" for blob in filtered_blobs],
-        remote_protocol=protocol,
-        remote_options={},
-        concat_dims=["valid_time"],
-        identical_dims=["latitude", "longitude", "step"],
-    )
-    combined_zarr_meta = mzz.translate()
+    if combined_zarr_meta is None and merge:
+        combined_zarr_meta = _merge_aggregations(fs, filtered_blobs)
+    if combined_zarr_meta is None:
+        combined_zarr_meta = _combine(fs, filtered_blobs)
+    set_aggregation_members(combined_zarr_meta, filtered_blobs)
 
     with fs.open(out_path, "w") as f:
         ujson.dump(combined_zarr_meta, f, ensure_ascii=True)
@@ -345,6 +973,8 @@ class StorageEventsStreamOperator(StreamOperator):
         self.dask_client = client
         self._date_test_hook = date_test_hook
         self._fs = fs
+        # Recent listings of the aggregation input directories, shared by bursts of messages for the same day
+        self._presence_cache = DirectoryListingCache()
 
     @abstractmethod
     def transform(
@@ -488,7 +1118,12 @@ class HrrrForecastRunAggregator(StorageEventsStreamOperator):
             ]
 
             multizarr_future = self.dask_client.submit(
-                multizarr, self._fs, input_paths, output_path
+                multizarr,
+                self._fs,
+                input_paths,
+                output_path,
+                presence_cache=self._presence_cache,
+                append=True,
             )
             wrote_blob = multizarr_future.result()
             logger.info("Completed aggregation for 18 forecast: %s", wrote_blob)
@@ -515,7 +1150,12 @@ class HrrrForecastRunAggregator(StorageEventsStreamOperator):
             ]
 
             multizarr_future = self.dask_client.submit(
-                multizarr, self._fs, input_paths, output_path
+                multizarr,
+                self._fs,
+                input_paths,
+                output_path,
+                presence_cache=self._presence_cache,
+                append=True,
             )
             wrote_blob = multizarr_future.result()
             logger.info("Completed aggregation for 48 forecast: %s", wrote_blob)
@@ -680,7 +1320,12 @@ class HrrrDailyHorizonAggregator(StorageEventsStreamOperator):
             return
 
         multizarr_future = self.dask_client.submit(
-            multizarr, self._fs, input_paths, output_path
+            multizarr,
+            self._fs,
+            input_paths,
+            output_path,
+            presence_cache=self._presence_cache,
+            append=True,
         )
         wrote_blob = multizarr_future.result()
         logger.info("Completed daily aggregation forecast: %s", wrote_blob)
@@ -790,7 +1435,12 @@ class HrrrMonthlyHorizonAggregator(StorageEventsStreamOperator):
             date += datetime.timedelta(days=1)
 
         multizarr_future = self.dask_client.submit(
-            multizarr, self._fs, input_paths, output_path
+            multizarr,
+            self._fs,
+            input_paths,
+            output_path,
+            presence_cache=self._presence_cache,
+            merge=True,
         )
         wrote_blob = multizarr_future.result()
         logger.info("Completed monthly forecast aggregation: %s", wrote_blob)
@@ -893,7 +1543,12 @@ class HrrrAllTimeHorizonAggregator(StorageEventsStreamOperator):
             date = date.replace(day=1)
 
         multizarr_future = self.dask_client.submit(
-            multizarr, self._fs, input_paths, output_path
+            multizarr,
+            self._fs,
+            input_paths,
+            output_path,
+            presence_cache=self._presence_cache,
+            merge=True,
         )
         wrote_blob = multizarr_future.result()
         logger.info("Completed alltime forecast aggregation: %s", wrote_blob)
@@ -925,10 +1580,12 @@ class HrrrGrib2ZarrExtractor(StorageEventsStreamOperator):
         self,
         *args,
         output_path: PurePosixPath = PurePosixPath(consts.EXTRACTED_BUCKET),
+        validator: GribValidator = None,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
         self.output_path = output_path
+        self.validator = validator
 
     def emit_metrics(self, matched):
         forecast_horizon = matched.group("horizon")
@@ -985,6 +1642,7 @@ class HrrrGrib2ZarrExtractor(StorageEventsStreamOperator):
                 PurePosixPath(object_id),
                 self._fs,
                 self.output_path,
+                validator=self.validator,
             )
 
             output_blob_path = extract_future.result()
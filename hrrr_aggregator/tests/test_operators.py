@@ -23,12 +23,18 @@ SOFTWARE.
 """
 
 import datetime
+import gc
 import os.path
+import pickle
 import tempfile
 import unittest
 from pathlib import PurePosixPath
 from unittest.mock import Mock, patch
+import base64
 import fsspec
+import numpy as np
+import ujson
+import xarray as xr
 import aggregator.operators
 
 INTEGRATION_TEST = False
@@ -229,6 +235,273 @@ class FilterOnPresenceTest(unittest.TestCase):
             ["/test/dir/c"],
         )
 
+    def test_filter_on_presence_lists_each_directory_once(self):
+        with patch.object(self.fs, "ls", wraps=self.fs.ls) as mock_ls, patch.object(
+            self.fs, "exists", wraps=self.fs.exists
+        ) as mock_exists:
+            results = aggregator.operators.filter_on_presence(
+                self.test_files, fs=self.fs
+            )
+        self.assertListEqual(results, self.expected)
+        mock_ls.assert_called_once_with("/test/dir", detail=False)
+        mock_exists.assert_not_called()
+
+    def test_filter_on_presence_cached_listing(self):
+        cache = aggregator.operators.DirectoryListingCache(ttl=60)
+        with patch.object(self.fs, "ls", wraps=self.fs.ls) as mock_ls:
+            aggregator.operators.filter_on_presence(
+                self.test_files, fs=self.fs, presence_cache=cache
+            )
+            results = aggregator.operators.filter_on_presence(
+                self.test_files, fs=self.fs, presence_cache=cache
+            )
+        self.assertListEqual(results, self.expected)
+        # The second burst of the same inputs shares the listing
+        self.assertEqual(mock_ls.call_count, 1)
+
+    def test_filter_on_presence_cached_listing_new_blob(self):
+        cache = aggregator.operators.DirectoryListingCache(ttl=60)
+        self.fs.rm("/test/dir/i")
+        results = aggregator.operators.filter_on_presence(
+            self.test_files, fs=self.fs, presence_cache=cache
+        )
+        self.assertListEqual(results, self.expected[:-1])
+
+        # A blob written after the cached listing is not skipped
+        self.fs.touch("/test/dir/i")
+        results = aggregator.operators.filter_on_presence(
+            self.test_files, fs=self.fs, presence_cache=cache
+        )
+        self.assertListEqual(results, self.expected)
+
+    def test_directory_listing_cache_is_bounded(self):
+        cache = aggregator.operators.DirectoryListingCache(ttl=60, max_listings=2)
+        for directory in ["/test/a", "/test/b", "/test/dir"]:
+            cache.listing(self.fs, directory)
+        self.assertEqual(len(cache), 2)
+
+        # The least recently used listing was evicted
+        self.assertFalse(cache.listing(self.fs, "/test/dir")[1])
+        self.assertTrue(cache.listing(self.fs, "/test/a")[1])
+
+    def test_directory_listing_cache_evicts_expired_listings(self):
+        cache = aggregator.operators.DirectoryListingCache(ttl=60)
+        with patch("aggregator.operators.time.monotonic", return_value=0.0):
+            cache.listing(self.fs, "/test/a")
+            cache.listing(self.fs, "/test/b")
+        with patch("aggregator.operators.time.monotonic", return_value=61.0):
+            paths, listed = cache.listing(self.fs, "/test/dir")
+        self.assertTrue(listed)
+        self.assertEqual(len(cache), 1)
+
+    def test_directory_listing_cache_shared_by_copies(self):
+        cache = aggregator.operators.DirectoryListingCache(ttl=60)
+        cache.listing(self.fs, "/test/dir")
+        copied = pickle.loads(pickle.dumps(cache))
+        self.assertFalse(copied.listing(self.fs, "/test/dir")[1])
+
+        # The listings of a name are dropped once no copy of the cache is left
+        name = cache.name
+        del cache, copied
+        gc.collect()
+        self.assertNotIn(name, aggregator.operators.DirectoryListingCache._LISTINGS)
+
+
+def raw_zarr_references(run_time, horizon, latitude=1.0, temperature=None):
+    """
+    Create the inlined references of a small raw zarr blob with the coordinates of a HRRR forecast step
+    """
+    if temperature is None:
+        temperature = np.full((3, 4), 280.0 + horizon)
+    step = np.timedelta64(horizon, "h")
+    run_time = np.datetime64(run_time, "ns")
+    ds = xr.Dataset(
+        {"t": (("valid_time", "y", "x"), temperature[np.newaxis, :, :])},
+        coords=dict(
+            valid_time=[run_time + step],
+            time=run_time,
+            step=step.astype("timedelta64[ns]"),
+            latitude=(("y", "x"), np.full((3, 4), latitude)),
+            longitude=(("y", "x"), np.ones((3, 4))),
+        ),
+    )
+    store = {}
+    ds.to_zarr(
+        store,
+        consolidated=False,
+        encoding=dict(
+            t=dict(chunks=(1, 3, 4), compressor=None),
+            valid_time=dict(units="seconds since 1970-01-01", dtype="float64"),
+            time=dict(units="seconds since 1970-01-01", dtype="int64"),
+        ),
+    )
+    refs = {
+        k: (
+            v.decode()
+            if "/.z" in k or k.startswith(".z")
+            else "base64:" + base64.b64encode(v).decode()
+        )
+        for k, v in store.items()
+    }
+    return dict(version=1, refs=refs)
+
+
+def write_raw_zarr(fs, path, run_time, horizon, latitude=1.0):
+    """
+    Write a small raw zarr blob with the coordinates of a HRRR forecast step, the data is inlined
+    """
+    with fs.open(path, "w") as f:
+        ujson.dump(raw_zarr_references(run_time, horizon, latitude=latitude), f)
+
+
+def open_references(path):
+    fs = fsspec.filesystem("reference", fo=f"memory://{path}", remote_protocol="memory")
+    return xr.open_dataset(
+        fs.get_mapper(""), engine="zarr", backend_kwargs=dict(consolidated=False)
+    ).load()
+
+
+class MultizarrAppendTest(unittest.TestCase):
+    # Watch out for fsspec.filesystem("memory") - it is a global and can hold state between tests!
+    def setUp(self) -> None:
+        self.fs = fsspec.filesystem("memory")
+        self.inputs = [f"/test/raw/hrrr.t06z.wrfsfcf{i:02d}.zarr" for i in range(0, 6)]
+        self.output = "/test/run/hrrr.t06z.wrfsfcf.18_hour_forecast.zarr"
+
+    def tearDown(self) -> None:
+        self.fs.rm("/test", recursive=True)
+
+    def write_input(self, horizon):
+        write_raw_zarr(self.fs, self.inputs[horizon], "2022-08-01T06", horizon)
+
+    def test_multizarr_append(self):
+        for horizon in range(0, 3):
+            self.write_input(horizon)
+        aggregator.operators.multizarr(self.fs, self.inputs, self.output, append=True)
+
+        for horizon in range(3, 5):
+            self.write_input(horizon)
+        with patch(
+            "aggregator.operators._combine", wraps=aggregator.operators._combine
+        ) as mock_combine:
+            aggregator.operators.multizarr(
+                self.fs, self.inputs, self.output, append=True
+            )
+        # Only the new inputs are combined
+        mock_combine.assert_called_once_with(self.fs, self.inputs[3:5])
+
+        rebuilt = "/test/run/rebuilt.zarr"
+        aggregator.operators.multizarr(self.fs, self.inputs, rebuilt)
+        xr.testing.assert_identical(
+            open_references(self.output), open_references(rebuilt)
+        )
+        with self.fs.open(self.output) as f:
+            references = ujson.load(f)
+        # The members are listed in the root attributes of a standard version 1 reference set
+        self.assertListEqual(sorted(references), ["refs", "version"])
+        self.assertListEqual(
+            aggregator.operators.get_aggregation_members(references),
+            self.inputs[:5],
+        )
+        self.assertListEqual(
+            open_references(self.output).attrs[
+                aggregator.operators.consts.AGGREGATION_MEMBERS
+            ],
+            self.inputs[:5],
+        )
+
+    def test_multizarr_append_up_to_date(self):
+        for horizon in range(0, 3):
+            self.write_input(horizon)
+        aggregator.operators.multizarr(self.fs, self.inputs, self.output, append=True)
+
+        with patch("aggregator.operators._combine") as mock_combine, patch.object(
+            self.fs, "open", wraps=self.fs.open
+        ) as mock_open:
+            aggregator.operators.multizarr(
+                self.fs, self.inputs, self.output, append=True
+            )
+        mock_combine.assert_not_called()
+        # The existing aggregation is read but not rewritten
+        self.assertNotIn("w", [args[1] for args, kwargs in mock_open.call_args_list])
+
+    def test_multizarr_append_out_of_order(self):
+        for horizon in (0, 1, 3):
+            self.write_input(horizon)
+        aggregator.operators.multizarr(self.fs, self.inputs, self.output, append=True)
+
+        # A late input in the middle of the aggregation rebuilds it
+        self.write_input(2)
+        with patch(
+            "aggregator.operators._combine", wraps=aggregator.operators._combine
+        ) as mock_combine:
+            aggregator.operators.multizarr(
+                self.fs, self.inputs, self.output, append=True
+            )
+        mock_combine.assert_called_once_with(self.fs, self.inputs[:4])
+        self.assertEqual(open_references(self.output).valid_time.size, 4)
+
+
+class MultizarrMergeTest(unittest.TestCase):
+    # Watch out for fsspec.filesystem("memory") - it is a global and can hold state between tests!
+    def setUp(self) -> None:
+        self.fs = fsspec.filesystem("memory")
+        self.days = [f"/test/daily/hrrr.2022080{day}.zarr" for day in (1, 2, 3)]
+        self.output = "/test/monthly/hrrr.202208.zarr"
+
+    def tearDown(self) -> None:
+        self.fs.rm("/test", recursive=True)
+
+    def write_day(self, day, latitude=1.0):
+        """
+        Write the 5 hour horizon aggregation of a day from 4 forecast runs
+        """
+        inputs = [
+            f"/test/raw/{day}/hrrr.t{hour:02d}z.wrfsfcf05.zarr"
+            for hour in (0, 6, 12, 18)
+        ]
+        for hour, path in zip((0, 6, 12, 18), inputs):
+            write_raw_zarr(
+                self.fs, path, f"2022-08-0{day}T{hour:02d}", 5, latitude=latitude
+            )
+        aggregator.operators.multizarr(self.fs, inputs, self.days[day - 1])
+
+    def test_multizarr_merge(self):
+        for day in (1, 2, 3):
+            self.write_day(day)
+
+        with patch("aggregator.operators._combine") as mock_combine:
+            aggregator.operators.multizarr(self.fs, self.days, self.output, merge=True)
+        mock_combine.assert_not_called()
+
+        combined = "/test/monthly/combined.zarr"
+        aggregator.operators.multizarr(self.fs, self.days, combined)
+        merged = open_references(self.output)
+        xr.testing.assert_identical(merged, open_references(combined))
+        self.assertEqual(merged.valid_time.size, 12)
+
+    def test_multizarr_merge_identical_dims_differ(self):
+        self.write_day(1)
+        self.write_day(2, latitude=2.0)
+
+        with patch(
+            "aggregator.operators._combine", wraps=aggregator.operators._combine
+        ) as mock_combine, patch("aggregator.operators.logger") as mock_logger:
+            aggregator.operators.multizarr(self.fs, self.days, self.output, merge=True)
+        # The daily aggregations are combined with MultiZarrToZarr instead
+        mock_combine.assert_called_once_with(self.fs, self.days[:2])
+        mock_logger.warning.assert_called_once()
+
+    def test_merge_references_overlapping(self):
+        self.write_day(1)
+        with self.fs.open(self.days[0]) as f:
+            refs = ujson.load(f)
+
+        with self.assertRaises(ValueError):
+            aggregator.operators.merge_references(
+                [refs, refs], "valid_time", remote_protocol="memory"
+            )
+
 
 class HrrrForecastRunAggregatorTest(unittest.TestCase):
     def setUp(self) -> None:
@@ -323,6 +596,7 @@ class HrrrForecastRunAggregatorTest(unittest.TestCase):
         args, kwargs = self.mock_dask_client.submit.call_args
         self.assertIs(args[0], aggregator.operators.multizarr)
         self.assertIs(args[1], self.mock_fs)
+        self.assertTrue(kwargs["append"])
         self.assertEqual(len(args[2]), 19)
         self.assertListEqual(
             args[2],
@@ -662,6 +936,146 @@ class HrrrAllTimeHorizonAggregatorTest(unittest.TestCase):
         )
 
 
+class GribValidatorTest(unittest.TestCase):
+    # Watch out for fsspec.filesystem("memory") - it is a global and can hold state between tests!
+    def setUp(self) -> None:
+        self.fs = fsspec.filesystem("memory")
+        self.validator = aggregator.operators.DecodedTemperatureValidator(
+            grid_shape=(3, 4)
+        )
+
+    def tearDown(self) -> None:
+        if self.fs.exists("/test"):
+            self.fs.rm("/test", recursive=True)
+
+    def test_decoded_temperature(self):
+        references = raw_zarr_references("2022-08-01T06", 1)
+        self.validator.validate(references, self.fs, "memory:///test/input.grib2")
+
+    def test_decoded_temperature_nan(self):
+        temperature = np.full((3, 4), 280.0)
+        temperature[2, 3] = np.nan
+        references = raw_zarr_references("2022-08-01T06", 1, temperature=temperature)
+        with self.assertRaisesRegex(AssertionError, "nan"):
+            self.validator.validate(references, self.fs, "memory:///test/input.grib2")
+
+        # The sample skips the nan value
+        aggregator.operators.DecodedTemperatureValidator(
+            grid_shape=(3, 4), stride=2
+        ).validate(references, self.fs, "memory:///test/input.grib2")
+
+    def test_decoded_temperature_too_low(self):
+        temperature = np.full((3, 4), 200.0)
+        references = raw_zarr_references("2022-08-01T06", 1, temperature=temperature)
+        with self.assertRaisesRegex(AssertionError, "too low"):
+            self.validator.validate(references, self.fs, "memory:///test/input.grib2")
+
+    def test_decoded_temperature_wrong_shape(self):
+        references = raw_zarr_references("2022-08-01T06", 1)
+        with self.assertRaisesRegex(AssertionError, "shape"):
+            aggregator.operators.DecodedTemperatureValidator().validate(
+                references, self.fs, "memory:///test/input.grib2"
+            )
+
+    def test_references(self):
+        self.fs.pipe("/test/input.grib2", b"GRIB" * 100)
+        references = raw_zarr_references("2022-08-01T06", 1)
+        references["refs"]["t/0.0.0"] = ["memory:///test/input.grib2", 100, 300]
+        validator = aggregator.operators.ReferencesValidator()
+        validator.validate(references, self.fs, "memory:///test/input.grib2")
+
+        # A message past the end of the file
+        references["refs"]["t/0.0.0"] = ["memory:///test/input.grib2", 200, 300]
+        with self.assertRaisesRegex(AssertionError, "bytes 200-500 of 400"):
+            validator.validate(references, self.fs, "memory:///test/input.grib2")
+
+        # A missing message
+        del references["refs"]["t/0.0.0"]
+        with self.assertRaisesRegex(AssertionError, "0 of 1 chunks"):
+            validator.validate(references, self.fs, "memory:///test/input.grib2")
+
+
+class ScanGribSelectionsTest(unittest.TestCase):
+    MESSAGES = [
+        ("t", "surface", "instant"),
+        ("tp", "surface", "accum"),
+        ("t2m", "heightAboveGround", "instant"),
+        ("gh", "isobaricInhPa", "instant"),
+    ]
+
+    @staticmethod
+    def fake_scan_grib(url, filter=None, **kwargs):
+        """
+        Stands in for kerchunk scan_grib, one entry per message passing the filter
+        """
+        entries = []
+        for name, level, step_type in ScanGribSelectionsTest.MESSAGES:
+            attributes = dict(
+                paramId=hash(name) % 1000,
+                shortName=name,
+                typeOfLevel=level,
+                stepType=step_type,
+                level=0,
+            )
+            if not aggregator.operators._matches(attributes, filter or {}):
+                continue
+            zattrs = {f"GRIB_{k}": v for k, v in attributes.items() if k != "level"}
+            zattrs["_ARRAY_DIMENSIONS"] = ["y", "x"]
+            entries.append(
+                dict(
+                    version=1,
+                    refs={
+                        ".zgroup": '{"zarr_format":2}',
+                        f"{name}/.zattrs": ujson.dumps(zattrs),
+                        f"{level}/.zattrs": ujson.dumps(dict(long_name=level)),
+                    },
+                )
+            )
+        return entries
+
+    @patch("aggregator.operators.scan_grib")
+    def test_scan_once(self, mock_scan_grib):
+        mock_scan_grib.side_effect = self.fake_scan_grib
+
+        results = aggregator.operators.scan_grib_selections(
+            "memory:///test/input.grib2",
+            aggregator.operators.GRIB_LEVEL_SELECTIONS,
+            storage_options=dict(token=None),
+        )
+
+        mock_scan_grib.assert_called_once_with(
+            "memory:///test/input.grib2",
+            filter=dict(
+                typeOfLevel={"surface", "heightAboveGround"}, stepType={"instant"}
+            ),
+            storage_options=dict(token=None),
+        )
+        self.assertListEqual(
+            [list(entry["refs"])[1] for entry in results["surface"]], ["t/.zattrs"]
+        )
+        self.assertListEqual(
+            [list(entry["refs"])[1] for entry in results["height_above_ground"]],
+            ["t2m/.zattrs"],
+        )
+
+    @patch("aggregator.operators.scan_grib")
+    def test_scan_unrouted_selection(self, mock_scan_grib):
+        mock_scan_grib.side_effect = self.fake_scan_grib
+
+        # The level is not an attribute of the scanned messages, this selection is scanned on its own
+        results = aggregator.operators.scan_grib_selections(
+            "memory:///test/input.grib2",
+            dict(
+                surface=dict(typeOfLevel="surface"),
+                ground=dict(typeOfLevel="surface", level=0),
+            ),
+        )
+
+        self.assertEqual(mock_scan_grib.call_count, 2)
+        self.assertEqual(len(results["surface"]), 2)
+        self.assertEqual(len(results["ground"]), 2)
+
+
 class HrrrGrib2ZarrExtractorTest(unittest.TestCase):
     def setUp(self) -> None:
         self.mock_dask_client = Mock()
@@ -687,6 +1101,7 @@ class HrrrGrib2ZarrExtractorTest(unittest.TestCase):
         self.assertEqual(
             args[5], PurePosixPath(aggregator.operators.consts.EXTRACTED_BUCKET)
         )
+        self.assertIsNone(kwargs["validator"])
 
     def test_transform_not_selected(self):
         object = "hrrr.20220701/conus/hrrr.t00z.foobar18.grib2"
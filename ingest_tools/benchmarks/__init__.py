@@ -0,0 +1,3 @@
+'''
+Benchmarks of the ingest and aggregation latency against a local S3 server, see benchmarks.run
+'''
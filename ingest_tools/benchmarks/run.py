@@ -0,0 +1,369 @@
+'''
+Ingest and aggregation benchmarks against a local S3 stand in
+
+Seeds a local moto S3 server with synthetic ROMS, FVCOM, SELFE and RTOFS files (benchmarks.synthetic), kerchunks
+every file with its pipeline, and then builds and appends to the model run and best time series aggregations of
+a growing number of members. Every case runs in its own process, so its peak RSS is its own, and the S3 requests
+it makes are counted by the server. The results are written as JSON, and can be compared against a previous run:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --models roms,rtofs --members 1,10,100 --output new.json --compare results.json
+
+Requires moto[server], see requirements-dev.txt.
+'''
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import PackageNotFoundError, version
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ingest_tools.filesystems import clear_filesystems, get_write_filesystem
+from ingest_tools.metrics import InMemoryMetricsSink, KeyMetrics, set_metrics_sink
+from ingest_tools.pipeline import PipelineContext
+from ingest_tools.targets import aggregation_targets
+
+from .server import LocalS3Server, create_public_buckets
+from .synthetic import SYNTHETIC_MODELS, to_netcdf_bytes
+
+
+RESULTS_VERSION = 1
+
+REGION = 'us-east-1'
+SOURCE_BUCKET = 'bench-source'
+INGEST_BUCKET = 'bench-ingest'
+
+DEFAULT_MEMBERS = [1, 10, 100, 1000]
+DEFAULT_MODES = ['build', 'append']
+
+# The relative change in a metric above which compare reports a regression
+DEFAULT_TOLERANCE = 0.2
+
+# The number of synthetic files written to the server at once while seeding
+SEED_BATCH_SIZE = 100
+
+PACKAGES = ['kerchunk', 'fsspec', 's3fs', 'zarr', 'numcodecs', 'numpy', 'h5py', 'xarray', 'moto']
+
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        'min': float(np.min(values)),
+        'mean': float(np.mean(values)),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'max': float(np.max(values)),
+    }
+
+
+def _phase_seconds(records: List[KeyMetrics]) -> Dict[str, float]:
+    # The mean duration of every phase, over the records it ran in
+    durations: Dict[str, List[float]] = {}
+    for record in records:
+        for p in record.phases:
+            durations.setdefault(p.phase, []).append(p.duration_seconds)
+    return {name: float(np.mean(values)) for name, values in durations.items()}
+
+
+def _quiet(verbose: bool):
+    # The pipelines print several lines for every file, which would drown out the benchmark progress
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+
+def ingest_case(keys: List[str], verbose: bool = False) -> dict:
+    '''
+    Kerchunk every source file with its matching pipelines, one file after the other
+
+    :param keys: The source keys
+    :param verbose: Show the output of the pipelines
+    :returns: The latency of every file, the phase durations and the source reads
+    '''
+    sink = InMemoryMetricsSink()
+    set_metrics_sink(sink)
+    context = PipelineContext.from_entry_points(REGION, INGEST_BUCKET)
+    baseline_rss = _peak_rss_bytes()
+
+    latencies = []
+    with _quiet(verbose):
+        for key in keys:
+            start = time.perf_counter()
+            for pipeline in context.get_matching_pipelines(key):
+                pipeline.run(REGION, SOURCE_BUCKET, key, INGEST_BUCKET)
+            latencies.append(time.perf_counter() - start)
+
+    records = [r for r in sink.records if r.operation == 'ingest']
+    return {
+        'files': len(keys),
+        'failed': sum(not r.succeeded for r in records),
+        'total_seconds': float(sum(latencies)),
+        'first_file_seconds': latencies[0],
+        # The first file of every structure is fully scanned, the following ones reuse its template
+        'latency_seconds': _summarize(latencies[1:] or latencies),
+        'phase_seconds': _phase_seconds(records),
+        'source_bytes_read': _summarize([sum(p.bytes_read for p in r.phases) for r in records]),
+        'source_requests': _summarize([sum(p.requests for p in r.phases) for r in records]),
+        'baseline_rss_bytes': baseline_rss,
+        'peak_rss_bytes': _peak_rss_bytes(),
+    }
+
+
+def _aggregation_target(key: str, operation: str):
+    for target in aggregation_targets(key):
+        if _operation(target.key) == operation:
+            return target
+    raise ValueError(f'No {operation} aggregation for {key}')
+
+
+def _operation(aggregation_key: str) -> str:
+    return 'best_time_series' if '.best.' in aggregation_key else 'model_run'
+
+
+def aggregation_case(operation: str, bucket: str, keys: List[str], verbose: bool = False) -> dict:
+    '''
+    Add kerchunked files to an aggregation with a single update
+
+    :param operation: The aggregation, model_run or best_time_series
+    :param bucket: The bucket the kerchunked files and the aggregation are in
+    :param keys: The keys of the kerchunked files to add
+    :param verbose: Show the output of the aggregation
+    :returns: The latency, phase durations and output size of the update
+    '''
+    sink = InMemoryMetricsSink()
+    set_metrics_sink(sink)
+    target = _aggregation_target(keys[0], operation)
+    baseline_rss = _peak_rss_bytes()
+
+    start = time.perf_counter()
+    with _quiet(verbose):
+        target.aggregate(REGION, bucket, keys)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'aggregation_key': target.key,
+        'succeeded': len(sink.records) > 0 and all(r.succeeded for r in sink.records),
+        'seconds': elapsed,
+        'phase_seconds': _phase_seconds(sink.records),
+        'output_bytes': sum(p.output_bytes for r in sink.records for p in r.phases),
+        'baseline_rss_bytes': baseline_rss,
+        'peak_rss_bytes': _peak_rss_bytes(),
+    }
+
+
+def _run_in_process(fn, *args):
+    # A new process for every case, so the peak RSS of a case is not inflated by the cases before it
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def _seed_source_files(fs, model, run_time: datetime.datetime, members: int, file_format: str, scale: int) -> List[str]:
+    keys = [model.source_key(run_time, offset) for offset in range(members)]
+    for i in range(0, members, SEED_BATCH_SIZE):
+        fs.pipe({
+            f'{SOURCE_BUCKET}/{keys[offset]}': to_netcdf_bytes(model.build(run_time, offset, scale), file_format)
+            for offset in range(i, min(i + SEED_BATCH_SIZE, members))
+        })
+    return keys
+
+
+def _environment() -> dict:
+    packages = {}
+    for package in PACKAGES:
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            packages[package] = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'packages': packages,
+    }
+
+
+def run_benchmarks(
+    models: List[str],
+    members: List[int],
+    modes: List[str] = DEFAULT_MODES,
+    file_format: str = 'netcdf4',
+    scale: int = 1,
+    verbose: bool = False,
+) -> dict:
+    '''
+    Run the ingest and aggregation benchmarks against a new local S3 server
+
+    :param models: The synthetic models to benchmark, see SYNTHETIC_MODELS
+    :param members: The member counts of the aggregation cases
+    :param modes: build to create each aggregation from all of its members at once, append to time adding the last
+        member to an aggregation of all the others
+    :param file_format: The format of the synthetic files, netcdf4 or netcdf3
+    :param scale: Multiplier of the synthetic grid sizes
+    :param verbose: Show the output of the pipelines and aggregations
+    :returns: The results
+    '''
+    results = {
+        'version': RESULTS_VERSION,
+        'created': datetime.datetime.utcnow().isoformat(),
+        'environment': _environment(),
+        'config': {'models': models, 'members': members, 'modes': modes, 'file_format': file_format, 'scale': scale},
+        'ingest': [],
+        'aggregation': [],
+    }
+
+    # A recent model run, older runs are pruned from the best time series manifests
+    run_time = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=1)
+
+    with LocalS3Server() as server:
+        # Spawned case processes inherit the environment, so every filesystem they create points at the server
+        os.environ['AWS_ENDPOINT_URL'] = server.endpoint_url
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+        clear_filesystems()
+
+        fs = get_write_filesystem()
+        create_public_buckets(fs, [SOURCE_BUCKET, INGEST_BUCKET])
+        context = PipelineContext.from_entry_points(REGION, INGEST_BUCKET)
+
+        for name in models:
+            model = SYNTHETIC_MODELS[name]
+            print(f'Seeding {max(members)} synthetic {name} files...')
+            source_keys = _seed_source_files(fs, model, run_time, max(members), file_format, scale)
+
+            print(f'Kerchunking {len(source_keys)} {name} files...')
+            server.reset_counts()
+            result = _run_in_process(ingest_case, source_keys, verbose)
+            result = {'model': name, **result, 'requests': server.request_counts()}
+            results['ingest'].append(result)
+            print(f'Kerchunked {name} files in {result["latency_seconds"]["p50"]:.3f}s p50, {result["latency_seconds"]["p95"]:.3f}s p95')
+
+            dest_keys = [context.get_matching_pipelines(k)[0].generate_destination_key(k) for k in source_keys]
+            operations = [_operation(t.key) for t in aggregation_targets(dest_keys[0])]
+            for operation in operations:
+                for mode in modes:
+                    for count in members:
+                        result = _aggregation_benchmark(fs, server, name, operation, mode, dest_keys[:count], verbose)
+                        results['aggregation'].append(result)
+                        print(f'{name} {operation} {mode} with {count} members took {result["seconds"]:.3f}s')
+
+            fs.rm([f'{SOURCE_BUCKET}/{k}' for k in source_keys])
+
+    return results
+
+
+def _aggregation_benchmark(fs, server: LocalS3Server, model: str, operation: str, mode: str, keys: List[str], verbose: bool) -> dict:
+    # Every case aggregates in its own bucket, so the best time series manifest only sees the case's members
+    bucket = f'bench-{model}-{operation}-{mode}-{len(keys)}'.replace('_', '-')
+    create_public_buckets(fs, [bucket])
+
+    def copy(keys: List[str]):
+        fs.copy([f'{INGEST_BUCKET}/{k}' for k in keys], [f'{bucket}/{k}' for k in keys])
+
+    try:
+        if mode == 'append' and len(keys) > 1:
+            # The last member is only written once the aggregation of the others exists, as it is in production
+            copy(keys[:-1])
+            _run_in_process(aggregation_case, operation, bucket, keys[:-1], verbose)
+            new_keys = keys[-1:]
+        else:
+            new_keys = keys
+        copy(new_keys)
+
+        server.reset_counts()
+        result = _run_in_process(aggregation_case, operation, bucket, new_keys, verbose)
+        return {'model': model, 'operation': operation, 'mode': mode, 'members': len(keys), **result, 'requests': server.request_counts()}
+    finally:
+        fs.rm(bucket, recursive=True)
+
+
+def _case_id(section: str, case: dict) -> tuple:
+    return (section, case['model'], case.get('operation'), case.get('mode'), case.get('members'))
+
+
+def _case_metrics(section: str, case: dict) -> Dict[str, float]:
+    latency = case['latency_seconds']['p50'] if section == 'ingest' else case['seconds']
+    return {
+        'latency_seconds': latency,
+        'requests': case['requests']['total'],
+        'peak_rss_bytes': case['peak_rss_bytes'],
+    }
+
+
+def compare_results(previous: dict, current: dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    '''
+    Compare the latency, request count and peak RSS of every case that is in both results
+
+    :param previous: The results of the previous run
+    :param current: The results of the current run
+    :param tolerance: The relative increase above which a metric is reported
+    :returns: A description of every metric that increased by more than the tolerance
+    '''
+    previous_cases = {_case_id(s, c): _case_metrics(s, c) for s in ('ingest', 'aggregation') for c in previous.get(s, [])}
+
+    regressions = []
+    for section in ('ingest', 'aggregation'):
+        for case in current.get(section, []):
+            case_id = _case_id(section, case)
+            before = previous_cases.get(case_id)
+            if before is None:
+                continue
+            for metric, value in _case_metrics(section, case).items():
+                if before[metric] > 0 and (value - before[metric]) / before[metric] > tolerance:
+                    name = ' '.join(str(part) for part in case_id if part is not None)
+                    regressions.append(f'{name} {metric}: {before[metric]:.6g} -> {value:.6g}')
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description='Benchmark ingest and aggregation against a local S3 server')
+    parser.add_argument('--models', default=','.join(SYNTHETIC_MODELS), help='Comma separated synthetic models')
+    parser.add_argument('--members', default=','.join(str(m) for m in DEFAULT_MEMBERS), help='Comma separated aggregation member counts, at most 1000')
+    parser.add_argument('--modes', default=','.join(DEFAULT_MODES), help='Comma separated aggregation modes, build and append')
+    parser.add_argument('--format', default='netcdf4', choices=['netcdf4', 'netcdf3'], help='The format of the synthetic files')
+    parser.add_argument('--scale', type=int, default=1, help='Multiplier of the synthetic grid sizes')
+    parser.add_argument('--output', default='benchmark-results.json', help='The JSON file to write the results to')
+    parser.add_argument('--compare', help='A previous results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='The relative increase reported as a regression')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the pipelines and aggregations')
+    args = parser.parse_args(argv)
+
+    models = args.models.split(',')
+    members = sorted(int(m) for m in args.members.split(','))
+    unknown = [m for m in models if m not in SYNTHETIC_MODELS]
+    if len(unknown) > 0:
+        parser.error(f'Unknown models: {", ".join(unknown)}')
+    if members[0] < 1 or members[-1] > 1000:
+        # The offsets of the synthetic files are three digits in their keys
+        parser.error('Member counts must be between 1 and 1000')
+
+    results = run_benchmarks(models, members, args.modes.split(','), args.format, args.scale, args.verbose)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Wrote benchmark results to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+'''
+Local S3 stand in for the benchmarks
+
+Runs a moto server on a background thread and counts every request it serves, regardless of which process or
+client made it, so the benchmarks report the S3 requests of the kerchunk scanners, the aggregations and s3fs alike.
+Requires moto[server].
+'''
+
+import logging
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+from moto.server import DomainDispatcherApplication, create_backend_app
+from werkzeug.serving import make_server
+
+
+def s3_operation(environ: dict) -> str:
+    '''
+    The S3 operation of a request, from its method and query string
+
+    :param environ: The WSGI environ of the request
+    :returns: The operation, for example GetObject or ListObjectsV2
+    '''
+    method = environ['REQUEST_METHOD']
+    path = environ.get('PATH_INFO', '/').strip('/')
+    query = environ.get('QUERY_STRING', '')
+    is_object = '/' in path
+
+    if method == 'HEAD':
+        return 'HeadObject' if is_object else 'HeadBucket'
+    if method == 'GET':
+        if is_object:
+            return 'GetObject'
+        return 'ListObjectsV2' if 'list-type=2' in query else 'ListObjects'
+    if method == 'PUT':
+        if 'uploadId' in query:
+            return 'UploadPart'
+        if 'HTTP_X_AMZ_COPY_SOURCE' in environ:
+            return 'CopyObject'
+        return 'PutObject' if is_object else 'CreateBucket'
+    if method == 'POST':
+        if 'delete' in query:
+            return 'DeleteObjects'
+        return 'MultipartUpload'
+    if method == 'DELETE':
+        return 'DeleteObject' if is_object else 'DeleteBucket'
+    return method
+
+
+class LocalS3Server:
+    '''
+    A moto S3 server counting the requests it serves
+    '''
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        '''
+        :param host: The address to listen on
+        :param port: The port to listen on, any free port if 0
+        '''
+        self.host = host
+        self.port = port
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def _app(self, app):
+        def counting_app(environ, start_response):
+            operation = s3_operation(environ)
+            with self._lock:
+                self._counts[operation] += 1
+            return app(environ, start_response)
+        return counting_app
+
+    def start(self):
+        # The request log of every served request would drown out the benchmark output
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        app = DomainDispatcherApplication(create_backend_app)
+        self._server = make_server(self.host, self.port, self._app(app), threaded=True)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._server = None
+
+    def reset_counts(self):
+        with self._lock:
+            self._counts.clear()
+
+    def request_counts(self) -> Dict[str, int]:
+        '''
+        :returns: The number of requests served for each S3 operation since the last reset, and their total
+        '''
+        with self._lock:
+            counts = dict(sorted(self._counts.items()))
+        counts['total'] = sum(counts.values())
+        return counts
+
+    def __enter__(self) -> 'LocalS3Server':
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def create_public_buckets(fs, buckets: List[str]):
+    '''
+    Create buckets that can be read anonymously, the pipelines read the source files and the references without
+    credentials
+
+    :param fs: An authenticated S3 filesystem pointing at the server
+    :param buckets: The names of the buckets
+    '''
+    for bucket in buckets:
+        fs.mkdir(bucket, acl='public-read')
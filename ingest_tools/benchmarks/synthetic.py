@@ -0,0 +1,298 @@
+'''
+Synthetic model output files
+
+Small NetCDF files with the dimensions, coordinates, variable names and source keys of the ROMS, FVCOM and SELFE
+NOS OFS models and of RTOFS, so the pipelines and aggregations run on them exactly as they do on the NODD files.
+The grids are much smaller than the real models and the fields are smooth, so the files stay small and compress
+well, while the number of variables, their attributes and their chunking, which is what kerchunking reads, stay
+representative.
+'''
+
+import datetime
+import io
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+import h5netcdf
+import numpy as np
+from scipy.io import netcdf_file
+
+
+@dataclass
+class SyntheticDataset:
+    '''
+    The variables and attributes of a synthetic file. Unlike an xarray dataset, a variable can share its name with
+    a dimension without being its coordinate, like the siglay(siglay, node) variable of FVCOM.
+
+    :param variables: The dimensions, values and attributes of every variable, by name
+    :param attrs: The global attributes
+    :param unlimited: The record dimension, if any
+    '''
+    variables: Dict[str, Tuple[Tuple[str, ...], np.ndarray, dict]]
+    attrs: dict
+    unlimited: Optional[str] = None
+
+    def dimensions(self) -> Dict[str, int]:
+        sizes = {}
+        for dims, values, _ in self.variables.values():
+            sizes.update(zip(dims, values.shape))
+        return sizes
+
+
+@dataclass(frozen=True)
+class SyntheticModel:
+    '''
+    A synthetic model
+
+    :param name: The name of the model in the benchmark results
+    :param source_key: Function returning the source key of the file of a model run and offset
+    :param build: Function building the dataset of a model run and offset, at a grid scale
+    '''
+    name: str
+    source_key: Callable[[datetime.datetime, int], str]
+    build: Callable[[datetime.datetime, int, int], SyntheticDataset]
+
+
+def _field(shape, phase: float) -> np.ndarray:
+    # Smooth values that change with the offset, so every file has different but compressible data
+    values = np.sin(np.linspace(0, np.pi, int(np.prod(shape))) + phase)
+    return values.reshape(shape).astype('float32')
+
+
+def _dataset(data_vars: dict, coords: dict, attrs: dict, unlimited: str) -> SyntheticDataset:
+    variables = {}
+    for name, (dims, values, variable_attrs) in {**coords, **data_vars}.items():
+        variables[name] = ((dims,) if isinstance(dims, str) else tuple(dims), np.asarray(values), variable_attrs)
+    return SyntheticDataset(variables, attrs, unlimited)
+
+
+def _grid(ny: int, nx: int):
+    lat, lon = np.meshgrid(np.linspace(36, 40, ny), np.linspace(-77, -75, nx), indexing='ij')
+    return lat, lon
+
+
+def build_roms(run_time: datetime.datetime, offset: int, scale: int = 1) -> SyntheticDataset:
+    '''
+    A ROMS fields file, as written by cbofs, dbofs or wcofs
+    '''
+    ny, nx, nz = 16 * scale, 32 * scale, 5
+    time = (run_time + datetime.timedelta(hours=offset) - datetime.datetime(2016, 1, 1)).total_seconds()
+    lat_rho, lon_rho = _grid(ny, nx)
+    lat_u, lon_u = _grid(ny, nx - 1)
+    lat_v, lon_v = _grid(ny - 1, nx)
+    lat_psi, lon_psi = _grid(ny - 1, nx - 1)
+    s_rho = (np.arange(nz) - nz + 0.5) / nz
+    s_w = np.arange(nz + 1) / nz - 1
+
+    return _dataset(
+        {
+            'zeta': (('ocean_time', 'eta_rho', 'xi_rho'), _field((1, ny, nx), offset), {'long_name': 'free-surface', 'units': 'meter'}),
+            'temp': (('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), _field((1, nz, ny, nx), offset), {'long_name': 'potential temperature', 'units': 'Celsius'}),
+            'salt': (('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), _field((1, nz, ny, nx), offset + 1), {'long_name': 'salinity'}),
+            'u': (('ocean_time', 's_rho', 'eta_u', 'xi_u'), _field((1, nz, ny, nx - 1), offset), {'long_name': 'u-momentum component', 'units': 'meter second-1'}),
+            'v': (('ocean_time', 's_rho', 'eta_v', 'xi_v'), _field((1, nz, ny - 1, nx), offset), {'long_name': 'v-momentum component', 'units': 'meter second-1'}),
+            'h': (('eta_rho', 'xi_rho'), _field((ny, nx), 0), {'long_name': 'bathymetry at RHO-points', 'units': 'meter'}),
+            'mask_rho': (('eta_rho', 'xi_rho'), np.ones((ny, nx)), {'long_name': 'mask on RHO-points'}),
+            'Cs_r': (('s_rho',), s_rho, {'long_name': 'S-coordinate stretching curves at RHO-points'}),
+            'Cs_w': (('s_w',), s_w, {'long_name': 'S-coordinate stretching curves at W-points'}),
+            'hc': ((), 5.0, {'long_name': 'S-coordinate parameter, critical depth', 'units': 'meter'}),
+            'theta_s': ((), 4.5, {'long_name': 'S-coordinate surface control parameter'}),
+            'theta_b': ((), 0.95, {'long_name': 'S-coordinate bottom control parameter'}),
+            'Vtransform': ((), np.int32(2), {'long_name': 'vertical terrain-following transformation equation'}),
+            'Vstretching': ((), np.int32(4), {'long_name': 'vertical terrain-following stretching function'}),
+        },
+        coords={
+            'ocean_time': ('ocean_time', [time], {'long_name': 'time since initialization', 'units': 'seconds since 2016-01-01 00:00:00'}),
+            's_rho': ('s_rho', s_rho, {'long_name': 'S-coordinate at RHO-points'}),
+            's_w': ('s_w', s_w, {'long_name': 'S-coordinate at W-points'}),
+            'lat_rho': (('eta_rho', 'xi_rho'), lat_rho, {'units': 'degree_north'}),
+            'lon_rho': (('eta_rho', 'xi_rho'), lon_rho, {'units': 'degree_east'}),
+            'lat_u': (('eta_u', 'xi_u'), lat_u, {'units': 'degree_north'}),
+            'lon_u': (('eta_u', 'xi_u'), lon_u, {'units': 'degree_east'}),
+            'lat_v': (('eta_v', 'xi_v'), lat_v, {'units': 'degree_north'}),
+            'lon_v': (('eta_v', 'xi_v'), lon_v, {'units': 'degree_east'}),
+            'lat_psi': (('eta_psi', 'xi_psi'), lat_psi, {'units': 'degree_north'}),
+            'lon_psi': (('eta_psi', 'xi_psi'), lon_psi, {'units': 'degree_east'}),
+        },
+        attrs={'type': 'ROMS/TOMS history file', 'title': 'Synthetic ROMS benchmark file'},
+        unlimited='ocean_time',
+    )
+
+
+def build_fvcom(run_time: datetime.datetime, offset: int, scale: int = 1) -> SyntheticDataset:
+    '''
+    An FVCOM fields file, as written by ngofs2, leofs or sfbofs
+    '''
+    node, nele, nz = 512 * scale, 960 * scale, 5
+    valid_time = run_time + datetime.timedelta(hours=offset)
+    days = (valid_time - datetime.datetime(1858, 11, 17)).total_seconds() / 86400
+    siglay = np.repeat(((np.arange(nz) + 0.5) / -nz)[:, None], node, axis=1)
+    siglev = np.repeat((np.arange(nz + 1) / -nz)[:, None], node, axis=1)
+
+    return _dataset(
+        {
+            'zeta': (('time', 'node'), _field((1, node), offset), {'long_name': 'Water Surface Elevation', 'units': 'meters'}),
+            'temp': (('time', 'siglay', 'node'), _field((1, nz, node), offset), {'long_name': 'temperature', 'units': 'degrees_C'}),
+            'salinity': (('time', 'siglay', 'node'), _field((1, nz, node), offset + 1), {'long_name': 'salinity', 'units': '1e-3'}),
+            'u': (('time', 'siglay', 'nele'), _field((1, nz, nele), offset), {'long_name': 'Eastward Water Velocity', 'units': 'meters s-1'}),
+            'v': (('time', 'siglay', 'nele'), _field((1, nz, nele), offset + 1), {'long_name': 'Northward Water Velocity', 'units': 'meters s-1'}),
+            'h': (('node',), _field((node,), 0), {'long_name': 'Bathymetry', 'units': 'm'}),
+            'nv': (('three', 'nele'), np.arange(3 * nele, dtype='int32').reshape(3, nele) % node + 1, {'long_name': 'nodes surrounding element'}),
+            'Itime': (('time',), np.array([int(days)], dtype='int32'), {'units': 'days since 1858-11-17 00:00:00'}),
+            'Itime2': (('time',), np.array([int(round((days % 1) * 86400000))], dtype='int32'), {'units': 'msec since 00:00:00'}),
+        },
+        coords={
+            'time': ('time', [days], {'long_name': 'time', 'units': 'days since 1858-11-17 00:00:00'}),
+            'lon': (('node',), np.linspace(-97, -81, node).astype('float32'), {'units': 'degrees_east'}),
+            'lat': (('node',), np.linspace(24, 31, node).astype('float32'), {'units': 'degrees_north'}),
+            'lonc': (('nele',), np.linspace(-97, -81, nele).astype('float32'), {'units': 'degrees_east'}),
+            'latc': (('nele',), np.linspace(24, 31, nele).astype('float32'), {'units': 'degrees_north'}),
+            'siglay': (('siglay', 'node'), siglay.astype('float32'), {'long_name': 'Sigma Layers'}),
+            'siglev': (('siglev', 'node'), siglev.astype('float32'), {'long_name': 'Sigma Levels'}),
+        },
+        attrs={'source': 'FVCOM_3.0', 'title': 'Synthetic FVCOM benchmark file'},
+        unlimited='time',
+    )
+
+
+def build_selfe(run_time: datetime.datetime, offset: int, scale: int = 1) -> SyntheticDataset:
+    '''
+    A SELFE fields file, as written by creofs
+    '''
+    node, nz = 768 * scale, 5
+    time = (run_time + datetime.timedelta(hours=offset) - run_time.replace(hour=0)).total_seconds()
+
+    return _dataset(
+        {
+            'elev': (('time', 'node'), _field((1, node), offset), {'long_name': 'water surface elevation', 'units': 'm'}),
+            'temp': (('time', 'sigma', 'node'), _field((1, nz, node), offset), {'long_name': 'water temperature', 'units': 'C'}),
+            'salt': (('time', 'sigma', 'node'), _field((1, nz, node), offset + 1), {'long_name': 'salinity', 'units': 'psu'}),
+            'u': (('time', 'sigma', 'node'), _field((1, nz, node), offset + 2), {'long_name': 'eastward velocity', 'units': 'm/s'}),
+            'v': (('time', 'sigma', 'node'), _field((1, nz, node), offset + 3), {'long_name': 'northward velocity', 'units': 'm/s'}),
+            'depth': (('node',), _field((node,), 0), {'long_name': 'bathymetry', 'units': 'm'}),
+        },
+        coords={
+            'time': ('time', [time], {'long_name': 'Time', 'units': f'seconds since {run_time:%Y-%m-%d} 00:00:00'}),
+            'lon': (('node',), np.linspace(-124.5, -122, node), {'units': 'degrees_east'}),
+            'lat': (('node',), np.linspace(45.5, 46.8, node), {'units': 'degrees_north'}),
+            'sigma': (('sigma',), (np.arange(nz) + 0.5) / -nz, {'long_name': 'S coordinates at whole levels'}),
+        },
+        attrs={'title': 'Synthetic SELFE benchmark file'},
+        unlimited='time',
+    )
+
+
+def build_rtofs(run_time: datetime.datetime, offset: int, scale: int = 1) -> SyntheticDataset:
+    '''
+    An RTOFS global 2d prognostic file
+    '''
+    ny, nx = 64 * scale, 128 * scale
+    valid_time = run_time + datetime.timedelta(hours=offset)
+    mt = (valid_time - datetime.datetime(1900, 12, 31)).total_seconds() / 86400
+    latitude, longitude = np.meshgrid(np.linspace(-80, 90, ny), np.linspace(74, 434, nx), indexing='ij')
+    fields = {
+        'u_velocity': 'eastward_sea_water_velocity',
+        'v_velocity': 'northward_sea_water_velocity',
+        'sst': 'sea_surface_temperature',
+        'sss': 'sea_surface_salinity',
+        'layer_density': 'sea_water_potential_density',
+        'ssh': 'sea_surface_elevation',
+        'mixed_layer_thickness': 'ocean_mixed_layer_thickness',
+    }
+
+    data_vars = {
+        name: (('MT', 'Layer', 'Y', 'X') if name != 'ssh' else ('MT', 'Y', 'X'), _field((1, 1, ny, nx) if name != 'ssh' else (1, ny, nx), offset + i), {'standard_name': standard_name})
+        for i, (name, standard_name) in enumerate(fields.items())
+    }
+    data_vars['Date'] = (('MT',), [float(valid_time.strftime('%Y%m%d')) + valid_time.hour / 24], {'long_name': 'date', 'units': 'day as %Y%m%d.%f'})
+
+    return _dataset(
+        data_vars,
+        coords={
+            'MT': ('MT', [mt], {'long_name': 'time', 'units': 'days since 1900-12-31 00:00:00', 'calendar': 'standard'}),
+            'Layer': ('Layer', [1], {'units': 'layer', 'positive': 'down'}),
+            'Latitude': (('Y', 'X'), latitude.astype('float32'), {'standard_name': 'latitude', 'units': 'degrees_north'}),
+            'Longitude': (('Y', 'X'), longitude.astype('float32'), {'standard_name': 'longitude', 'units': 'degrees_east'}),
+        },
+        attrs={'title': 'Synthetic RTOFS benchmark file', 'experiment': '93.0'},
+        unlimited='MT',
+    )
+
+
+def nos_source_key(model: str) -> Callable[[datetime.datetime, int], str]:
+    '''
+    :param model: The NOS OFS model name
+    :returns: Function returning the NODD source key of a fields file, for example
+        'cbofs.20231022/nos.cbofs.fields.f001.20231022.t00z.nc'
+    '''
+    return lambda run_time, offset: f'{model}.{run_time:%Y%m%d}/nos.{model}.fields.f{offset:03d}.{run_time:%Y%m%d}.t{run_time:%H}z.nc'
+
+
+def rtofs_source_key(run_time: datetime.datetime, offset: int) -> str:
+    '''
+    :returns: The NODD source key of an RTOFS global 2d prognostic file, for example
+        'rtofs.20231022/rtofs_glo_2ds_f001_prog.nc'
+    '''
+    return f'rtofs.{run_time:%Y%m%d}/rtofs_glo_2ds_f{offset:03d}_prog.nc'
+
+
+SYNTHETIC_MODELS: Dict[str, SyntheticModel] = {
+    'roms': SyntheticModel('roms', nos_source_key('cbofs'), build_roms),
+    'fvcom': SyntheticModel('fvcom', nos_source_key('ngofs2'), build_fvcom),
+    'selfe': SyntheticModel('selfe', nos_source_key('creofs'), build_selfe),
+    'rtofs': SyntheticModel('rtofs', rtofs_source_key, build_rtofs),
+}
+
+
+def to_netcdf_bytes(ds: SyntheticDataset, file_format: str = 'netcdf4') -> bytes:
+    '''
+    Serialize a synthetic dataset the way the models write it
+
+    :param ds: The dataset
+    :param file_format: netcdf4 for an HDF5 file with compressed fields, or netcdf3 for a classic file
+    :returns: The bytes of the file
+    '''
+    if file_format == 'netcdf3':
+        return _to_netcdf3_bytes(ds)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'synthetic.nc')
+        with h5netcdf.File(path, 'w') as f:
+            sizes = ds.dimensions()
+            f.dimensions = {name: None if name == ds.unlimited else size for name, size in sizes.items()}
+            if ds.unlimited is not None:
+                f.resize_dimension(ds.unlimited, sizes[ds.unlimited])
+            f.attrs.update(ds.attrs)
+            for name, (dims, values, attrs) in ds.variables.items():
+                options = {}
+                if values.ndim >= 2:
+                    options = {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True, 'chunks': values.shape}
+                variable = f.create_variable(name, dims, data=values, **options)
+                variable.attrs.update(attrs)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def _to_netcdf3_bytes(ds: SyntheticDataset) -> bytes:
+    buffer = io.BytesIO()
+    f = netcdf_file(buffer, 'w', version=2)
+    for name, size in ds.dimensions().items():
+        f.createDimension(name, None if name == ds.unlimited else size)
+    for key, value in ds.attrs.items():
+        setattr(f, key, value)
+    for name, (dims, values, attrs) in ds.variables.items():
+        # NetCDF3 has no 64 bit integers
+        values = values.astype('int32') if values.dtype.kind == 'i' else values
+        variable = f.createVariable(name, values.dtype, dims)
+        if values.ndim == 0:
+            variable[...] = values
+        else:
+            variable[:] = values
+        for key, value in attrs.items():
+            setattr(variable, key, value)
+    f.flush()
+    data = buffer.getvalue()
+    f.close()
+    return data
@@ -0,0 +1,226 @@
+'''
+Incremental multizarr aggregation of kerchunked files
+
+Rebuilding an aggregation from scratch reads every member reference set again, so updating an aggregation one
+file at a time gets more expensive with every file that lands. When the new file sorts after the existing
+aggregation along the concat dimension, its chunks can be appended to the existing aggregation instead.
+'''
+
+from typing import Callable, List, MutableMapping, Optional
+
+import fsspec
+import numpy as np
+import zarr
+from fsspec.implementations.reference import LazyReferenceMapper
+from kerchunk.combine import MultiZarrToZarr
+
+from .metrics import phase
+from .references import ReferenceFormat, inline_whole_variables, read_many_references, read_references
+
+
+def read_concat_dim_values(refs: MutableMapping, concat_dim: str, remote_options: dict) -> np.ndarray:
+    '''
+    Read the values of the concat dimension coordinate from a reference set
+
+    :param refs: The reference set
+    :param concat_dim: The name of the concat dimension coordinate
+    :param remote_options: Options for reading the referenced chunks, only used if the coordinate is not inlined
+    :returns: The flattened coordinate values
+    '''
+    fs = fsspec.filesystem('reference', fo=refs, remote_protocol='s3', remote_options=remote_options)
+    group = zarr.open_group(fs.get_mapper(''), mode='r')
+    return np.ravel(group[concat_dim][:])
+
+
+def contains_kerchunked_references(aggregation_refs: MutableMapping, new_refs: MutableMapping, concat_dims: List[str], remote_options: dict) -> bool:
+    '''
+    Check whether a reference set is already part of an aggregation, for example because the notification for
+    the file was delivered more than once. This is the case when every chunk reference and every concat dimension
+    value of the reference set is already in the aggregation.
+
+    :param aggregation_refs: The existing aggregation
+    :param new_refs: The reference set to look for
+    :param concat_dims: The dimensions the aggregation is concatenated along
+    :param remote_options: Options for reading the referenced chunks
+    :returns: True if the reference set is already part of the aggregation
+    '''
+    if isinstance(aggregation_refs, LazyReferenceMapper):
+        # Checking would load every reference of a lazy aggregation, appending is cheaper
+        return False
+
+    new_chunks = {tuple(v) for v in new_refs.get('refs', new_refs).values() if isinstance(v, list)}
+    if len(new_chunks) == 0:
+        return False
+
+    existing_chunks = {tuple(v) for v in aggregation_refs.get('refs', aggregation_refs).values() if isinstance(v, list)}
+    if not new_chunks.issubset(existing_chunks):
+        return False
+
+    for concat_dim in concat_dims:
+        existing_values = read_concat_dim_values(aggregation_refs, concat_dim, remote_options)
+        new_values = read_concat_dim_values(new_refs, concat_dim, remote_options)
+        if not np.isin(new_values, existing_values).all():
+            return False
+
+    return True
+
+
+def is_expected_length(aggregation_refs: MutableMapping, concat_dims: List[str], remote_options: dict, expected_length: Optional[int]) -> bool:
+    '''
+    Check whether an aggregation has the expected length along its concat dimensions
+
+    :param aggregation_refs: The existing aggregation
+    :param concat_dims: The dimensions the aggregation is concatenated along
+    :param remote_options: Options for reading the referenced chunks
+    :param expected_length: The expected length of the concat dimensions, any length is expected if None
+    :returns: True if every concat dimension has the expected length
+    '''
+    if expected_length is None:
+        return True
+
+    for concat_dim in concat_dims:
+        length = len(read_concat_dim_values(aggregation_refs, concat_dim, remote_options))
+        if length != expected_length:
+            print(f'The aggregation has {length} {concat_dim} values, expected {expected_length}')
+            return False
+
+    return True
+
+
+def append_kerchunked_aggregation(
+    aggregation_refs: MutableMapping,
+    new_refs: List[MutableMapping],
+    concat_dims: List[str],
+    identical_dims: List[str],
+    remote_options: dict,
+    expected_length: Optional[int] = None,
+) -> Optional[MutableMapping]:
+    '''
+    Append new reference sets to an existing aggregation along its concat dimension
+
+    Only the new reference sets are translated, the chunks of the existing aggregation are kept as they are.
+    This is only possible when every new value of the concat dimension sorts after the existing values.
+    A lazy parquet aggregation is amended in place, so only its changed record blocks are rewritten.
+
+    :param aggregation_refs: The existing aggregation
+    :param new_refs: The reference sets to append
+    :param concat_dims: The dimensions the aggregation is concatenated along
+    :param identical_dims: The dimensions that are identical across the aggregated files
+    :param remote_options: Options for reading the referenced chunks
+    :param expected_length: The expected length of the concat dimension after appending, if known
+    :returns: The updated aggregation, or None if the new reference sets cannot be appended
+    '''
+    for concat_dim in concat_dims:
+        existing_values = read_concat_dim_values(aggregation_refs, concat_dim, remote_options)
+        new_values = np.concatenate([read_concat_dim_values(r, concat_dim, remote_options) for r in new_refs])
+
+        if len(existing_values) and new_values.min() <= existing_values.max():
+            print(f'New {concat_dim} values do not sort after the existing aggregation')
+            return None
+
+        if expected_length is not None and len(existing_values) + len(new_values) != expected_length:
+            print(f'Appending would result in {len(existing_values) + len(new_values)} {concat_dim} values, expected {expected_length}')
+            return None
+
+    mzz = MultiZarrToZarr.append(
+        new_refs,
+        aggregation_refs,
+        remote_protocol='s3',
+        remote_options=remote_options,
+        concat_dims=concat_dims,
+        identical_dims=identical_dims,
+    )
+
+    return mzz.translate()
+
+
+def generate_kerchunked_aggregation(
+    fs: fsspec.AbstractFileSystem,
+    outurl: str,
+    new_files: List[str],
+    member_files: Callable[[], List[str]],
+    concat_dims: List[str],
+    identical_dims: List[str],
+    remote_options: dict,
+    expected_length: Optional[int] = None,
+    reference_format: ReferenceFormat = ReferenceFormat.JSON,
+) -> Optional[MutableMapping]:
+    '''
+    Generate the updated aggregation for new member files. The new files are appended to the existing aggregation
+    when possible, otherwise the aggregation is rebuilt from all of its member files. The concat dimension
+    coordinates are then consolidated into a single inline chunk each, so opening the aggregation does not read
+    them chunk by chunk.
+
+    :param fs: The filesystem to read the existing aggregation and the member files' references from
+    :param outurl: The url of the aggregation
+    :param new_files: The urls of the new member files' references, in concat dimension order
+    :param member_files: Function returning the urls of all of the member files, only called for a full rebuild
+    :param concat_dims: The dimensions the aggregation is concatenated along
+    :param identical_dims: The dimensions that are identical across the aggregated files
+    :param remote_options: Options for reading the referenced chunks
+    :param expected_length: The expected length of the concat dimension after appending, if known
+    :param reference_format: The format the aggregation is stored in
+    :returns: The aggregation reference set, or None if the new files are already part of the aggregation
+    '''
+    with phase('read'):
+        aggregation_refs = read_references(fs, outurl, reference_format)
+        new_refs = [read_references(fs, f) for f in new_files] if aggregation_refs is not None else []
+
+    if aggregation_refs is not None:
+        if all(r is not None for r in new_refs):
+            with phase('contains'):
+                new_refs = [r for r in new_refs if not contains_kerchunked_references(aggregation_refs, r, concat_dims, remote_options)]
+            if len(new_refs) == 0:
+                if is_expected_length(aggregation_refs, concat_dims, remote_options, expected_length):
+                    print(f'{", ".join(new_files)} are already part of the aggregation {outurl}')
+                    return None
+                # A member written by a concurrent update was lost, for example
+                d = None
+            else:
+                try:
+                    with phase('append'):
+                        d = append_kerchunked_aggregation(
+                            aggregation_refs,
+                            new_refs,
+                            concat_dims=concat_dims,
+                            identical_dims=identical_dims,
+                            remote_options=remote_options,
+                            expected_length=expected_length,
+                        )
+                except Exception as e:
+                    print(f'Failed to append {len(new_refs)} files to {outurl}: {e}')
+                    d = None
+
+            if d is not None:
+                print(f'Appended {len(new_refs)} files to the existing aggregation')
+                return _inline_aggregation(d, concat_dims, remote_options)
+
+        print(f'Rebuilding aggregation {outurl} from all of its member files...')
+
+    with phase('list'):
+        files = member_files()
+    print(f'Aggregating {len(files)} model files...')
+
+    with phase('read_members'):
+        # Read through the filesystem, so compressed member references are decompressed
+        member_refs = read_many_references(fs, files)
+
+    with phase('combine'):
+        mzz = MultiZarrToZarr(
+            files,
+            indicts=member_refs,
+            remote_protocol='s3',
+            remote_options=remote_options,
+            concat_dims=concat_dims,
+            identical_dims=identical_dims
+        )
+        d = mzz.translate()
+
+    return _inline_aggregation(d, concat_dims, remote_options)
+
+
+def _inline_aggregation(refs: MutableMapping, names: List[str], remote_options: dict) -> MutableMapping:
+    # Only the coordinates are consolidated, MultiZarrToZarr.append rewrites them but expects every other
+    # variable to keep the chunking of the member files
+    with phase('inline'):
+        return inline_whole_variables(refs, names, remote_options)
@@ -0,0 +1,328 @@
+'''
+Resumable backfill of a historical date range
+
+Lists the source bucket for a model prefix and date range, routes every key through the pipelines and kerchunks
+the matching keys on a process pool, each process kerchunking several keys at once. Progress is recorded in a local
+sqlite checkpoint, so running the same command again after an interruption only processes the keys that did not
+finish. Keys that a pipeline skips, for example files in an unsupported format, are recorded as skipped and are
+not retried. Once every key is kerchunked, each aggregation is updated once with all of its new files instead of
+once per file.
+
+    python -m ingest_tools.backfill --bucket noaa-nos-ofs-pds --prefix cbofs --start 2023-10-01 --end 2023-10-07
+
+Writing to a destination bucket with aggregation notifications configured also triggers the aggregation lambda for
+every written file. With --staging-prefix, the references and the aggregations are written under a staging prefix
+of the destination bucket instead, outside of the prefixes the notifications are configured for.
+'''
+
+import argparse
+import datetime
+import multiprocessing
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+import fsspec
+import ujson
+
+from .engine import IngestEngine
+from .filesystems import get_read_filesystem, get_write_filesystem
+from .pipeline import PipelineContext
+from .scheduler import AggregationScheduler, AggregationTarget
+from .targets import aggregation_targets
+
+
+DEFAULT_REGION = 'us-east-1'
+DEFAULT_DEST_BUCKET = 'nextgen-dmac-cloud-ingest'
+DEFAULT_CHECKPOINT = 'backfill.sqlite'
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_CONCURRENCY = 8
+
+PENDING = 'pending'
+KERCHUNKED = 'kerchunked'
+AGGREGATED = 'aggregated'
+FAILED = 'failed'
+# Terminal, the pipelines do not kerchunk the key so there are no references to aggregate
+SKIPPED = 'skipped'
+
+
+class Checkpoint:
+    '''
+    Local sqlite record of the status of every key in a backfill
+    '''
+
+    def __init__(self, path: str) -> None:
+        '''
+        :param path: The path of the sqlite database, created if it does not exist
+        '''
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS keys ('
+            'key TEXT PRIMARY KEY, '
+            'status TEXT NOT NULL, '
+            'output_keys TEXT NOT NULL DEFAULT \'[]\', '
+            'error TEXT, '
+            'updated_at TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, keys: List[str]) -> int:
+        '''
+        Add keys as pending, keys that are already in the checkpoint keep their status
+
+        :param keys: The source keys
+        :returns: The number of keys that were added
+        '''
+        now = datetime.datetime.utcnow().isoformat()
+        before = self.connection.total_changes
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO keys (key, status, updated_at) VALUES (?, ?, ?)',
+            [(key, PENDING, now) for key in keys],
+        )
+        self.connection.commit()
+        return self.connection.total_changes - before
+
+    def set_status(self, key: str, status: str, output_keys: Optional[List[str]] = None, error: Optional[str] = None):
+        '''
+        Record the status of a key
+
+        :param key: The source key
+        :param status: The new status
+        :param output_keys: The destination keys the references of the key were written to, kept if None
+        :param error: The error message of a failed key
+        '''
+        now = datetime.datetime.utcnow().isoformat()
+        if output_keys is None:
+            self.connection.execute('UPDATE keys SET status = ?, error = ?, updated_at = ? WHERE key = ?', (status, error, now, key))
+        else:
+            self.connection.execute(
+                'UPDATE keys SET status = ?, output_keys = ?, error = ?, updated_at = ? WHERE key = ?',
+                (status, ujson.dumps(output_keys), error, now, key),
+            )
+        self.connection.commit()
+
+    def keys(self, *statuses: str) -> List[str]:
+        '''
+        :returns: The source keys with any of the given statuses, in key order
+        '''
+        placeholders = ', '.join('?' for _ in statuses)
+        rows = self.connection.execute(f'SELECT key FROM keys WHERE status IN ({placeholders}) ORDER BY key', statuses)
+        return [row[0] for row in rows]
+
+    def output_keys(self, *statuses: str) -> Dict[str, List[str]]:
+        '''
+        :returns: The destination keys of every source key with any of the given statuses
+        '''
+        placeholders = ', '.join('?' for _ in statuses)
+        rows = self.connection.execute(f'SELECT key, output_keys FROM keys WHERE status IN ({placeholders}) ORDER BY key', statuses)
+        return {key: ujson.loads(output_keys) for key, output_keys in rows}
+
+    def counts(self) -> Dict[str, int]:
+        '''
+        :returns: The number of keys with each status
+        '''
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM keys GROUP BY status'))
+
+
+def list_backfill_keys(fs: fsspec.AbstractFileSystem, bucket: str, prefix: str, start: datetime.date, end: datetime.date) -> List[str]:
+    '''
+    List the source keys of a model for every day in a date range, given the NODD layout of one directory per
+    model and day:
+        'cbofs.20231022/nos.cbofs.fields.n006.20231022.t00z.nc'
+
+    :param fs: The filesystem to list the source bucket with
+    :param bucket: The source bucket
+    :param prefix: The model prefix, for example cbofs or rtofs
+    :param start: The first day of the range
+    :param end: The last day of the range, inclusive
+    :returns: The source keys, relative to the bucket
+    '''
+    keys = []
+    day = start
+    while day <= end:
+        directory = f'{bucket}/{prefix}.{day:%Y%m%d}'
+        try:
+            files = fs.ls(directory, detail=False)
+        except FileNotFoundError:
+            files = []
+
+        if len(files) == 0:
+            print(f'No files found in {directory}')
+        keys.extend(f.lstrip('/')[len(bucket) + 1:] for f in files)
+        day += datetime.timedelta(days=1)
+
+    return sorted(keys)
+
+
+def stage_pipelines(context: PipelineContext, staging_prefix: str):
+    '''
+    Write the references of every pipeline of the context under a staging prefix of the destination bucket. The
+    aggregations of staged references are resolved from their keys, so they are written under the staging prefix
+    too.
+
+    :param context: The pipeline context
+    :param staging_prefix: The staging prefix, for example backfill
+    '''
+    for pipeline in context.pipelines.values():
+        pipeline.dest_prefix = f'{staging_prefix.strip("/")}/{pipeline.dest_prefix}'
+
+
+_engine: Optional[IngestEngine] = None
+
+
+def _init_worker(region: str, dest_bucket: str, concurrency: int, staging_prefix: Optional[str]):
+    global _engine
+    context = PipelineContext.from_entry_points(region, dest_bucket)
+    if staging_prefix:
+        stage_pipelines(context, staging_prefix)
+    _engine = IngestEngine(lambda _: context, region, max_concurrent=concurrency)
+
+
+def _kerchunk_keys(bucket: str, keys: List[str]) -> List[Tuple[str, str, List[str], Optional[str]]]:
+    fs_write = get_write_filesystem()
+    dest_bucket = _engine.get_context(_engine.region).get_dest_bucket()
+
+    results = []
+    for result in _engine.run([(bucket, key) for key in keys]):
+        if result.error is not None:
+            results.append((result.key, FAILED, result.output_keys, result.error))
+            continue
+
+        if result.skipped:
+            results.append((result.key, SKIPPED, [], None))
+            continue
+
+        missing = [k for k in result.output_keys if not fs_write.exists(f's3://{dest_bucket}/{k}')]
+        if len(missing) > 0:
+            results.append((result.key, FAILED, result.output_keys, f'No references were written to {", ".join(missing)}'))
+        else:
+            results.append((result.key, KERCHUNKED, result.output_keys, None))
+    return results
+
+
+def kerchunk_backfill(
+    checkpoint: Checkpoint,
+    bucket: str,
+    region: str,
+    dest_bucket: str,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    staging_prefix: Optional[str] = None,
+):
+    '''
+    Kerchunk every pending or failed key of the checkpoint on a process pool, each process kerchunking several
+    keys at once
+
+    :param checkpoint: The backfill checkpoint
+    :param bucket: The source bucket
+    :param region: The region of the buckets
+    :param dest_bucket: The bucket to write the references to
+    :param max_workers: The number of worker processes
+    :param concurrency: The number of keys each worker process kerchunks at once
+    :param staging_prefix: The prefix of the destination bucket to write the references under, see stage_pipelines,
+        the pipelines' own prefixes if None
+    '''
+    keys = checkpoint.keys(PENDING, FAILED)
+    if len(keys) == 0:
+        return
+
+    print(f'Kerchunking {len(keys)} keys with {max_workers} processes, {concurrency} keys at once each...')
+
+    # Every batch keeps a worker's engine busy, and its keys are recorded in the checkpoint once it is done
+    batch_size = concurrency * 2
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+
+    # Spawned workers create their own S3 filesystems, the event loop of a forked filesystem is not usable
+    mp_context = multiprocessing.get_context('spawn')
+    done = 0
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_worker, initargs=(region, dest_bucket, concurrency, staging_prefix)) as executor:
+        futures = [executor.submit(_kerchunk_keys, bucket, batch) for batch in batches]
+        for future in as_completed(futures):
+            for key, status, output_keys, error in future.result():
+                if status == FAILED:
+                    print(f'Failed to kerchunk {key}: {error}')
+                checkpoint.set_status(key, status, output_keys, error)
+
+                done += 1
+                if done % 100 == 0:
+                    print(f'Kerchunked {done} of {len(keys)} keys')
+
+
+def aggregate_backfill(
+    checkpoint: Checkpoint,
+    region: str,
+    dest_bucket: str,
+    resolve_targets: Callable[[str], List[AggregationTarget]],
+    max_workers: int = DEFAULT_MAX_WORKERS,
+):
+    '''
+    Update every aggregation of the kerchunked keys of the checkpoint once, with all of its new files
+
+    :param checkpoint: The backfill checkpoint
+    :param region: The region of the destination bucket
+    :param dest_bucket: The bucket the references were written to
+    :param resolve_targets: Function returning the aggregations a destination key is added to
+    :param max_workers: The maximum number of aggregations updated concurrently
+    '''
+    source_output_keys = checkpoint.output_keys(KERCHUNKED)
+    if len(source_output_keys) == 0:
+        return
+
+    scheduler = AggregationScheduler(resolve_targets, max_workers=max_workers)
+    for output_keys in source_output_keys.values():
+        for output_key in output_keys:
+            scheduler.add_key(output_key, region, dest_bucket, output_key)
+
+    print(f'Updating {len(scheduler.pending)} aggregations with {len(source_output_keys)} new files...')
+    _, failed = scheduler.run_due(force=True)
+    failed = set(failed)
+
+    for key, output_keys in source_output_keys.items():
+        failed_output_keys = [k for k in output_keys if k in failed]
+        if len(failed_output_keys) == 0:
+            checkpoint.set_status(key, AGGREGATED)
+        else:
+            # The key stays kerchunked, so the next run retries its aggregations
+            print(f'Failed to aggregate {", ".join(failed_output_keys)}')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m ingest_tools.backfill', description='Kerchunk and aggregate a historical date range')
+    parser.add_argument('--bucket', required=True, help='The source bucket, for example noaa-nos-ofs-pds')
+    parser.add_argument('--prefix', required=True, help='The model prefix, for example cbofs or rtofs')
+    parser.add_argument('--start', required=True, type=datetime.date.fromisoformat, help='The first day, YYYY-MM-DD')
+    parser.add_argument('--end', required=True, type=datetime.date.fromisoformat, help='The last day, inclusive, YYYY-MM-DD')
+    parser.add_argument('--dest-bucket', default=DEFAULT_DEST_BUCKET, help='The bucket to write the references to')
+    parser.add_argument('--region', default=DEFAULT_REGION)
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help='The sqlite checkpoint database')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS, help='The number of kerchunking processes')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='The number of keys each process kerchunks at once')
+    parser.add_argument('--no-aggregate', action='store_true', help='Only kerchunk, without updating the aggregations')
+    parser.add_argument('--staging-prefix', help='Write the references and aggregations under this prefix of the destination bucket, so no aggregation notifications are sent')
+    args = parser.parse_args(argv)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        context = PipelineContext.from_entry_points(args.region, args.dest_bucket)
+        keys = list_backfill_keys(get_read_filesystem(), args.bucket, args.prefix, args.start, args.end)
+        routed = [key for key in keys if len(context.get_matching_pipelines(key)) > 0]
+        added = checkpoint.add(routed)
+        print(f'Found {len(keys)} keys, {len(routed)} with a matching pipeline, {added} new to the checkpoint')
+
+        kerchunk_backfill(checkpoint, args.bucket, args.region, args.dest_bucket, args.workers, args.concurrency, args.staging_prefix)
+        if not args.no_aggregate:
+            aggregate_backfill(checkpoint, args.region, args.dest_bucket, aggregation_targets, args.workers)
+
+        counts = checkpoint.counts()
+        print(f'Backfill status: {", ".join(f"{count} {status}" for status, count in sorted(counts.items()))}')
+        return 1 if counts.get(FAILED, 0) > 0 else 0
+    finally:
+        checkpoint.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+'''
+Model run cadences
+
+Each model writes a known set of nowcast and forecast offsets every model run, so the member files of a model run
+can be enumerated directly instead of listing the model's prefix and matching keys client side. Whether each
+expected member exists yet is checked with concurrent HEAD requests.
+'''
+
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, List, Sequence
+
+import fsspec
+from fsspec.asyn import sync
+
+from .generic import ModelRunType
+from .metrics import count_requests
+
+
+# The maximum number of HEAD requests in flight at once
+MAX_CONCURRENT_HEADS = 32
+
+OFFSET_GLOB_EXPRESSION = '[0-9][0-9][0-9]'
+
+
+@dataclass(frozen=True)
+class ModelCadence:
+    '''
+    The offsets, in hours, of the files written for every model run
+
+    :param nowcast_offsets: The offsets of the nowcast files
+    :param forecast_offsets: The offsets of the forecast files
+    '''
+    nowcast_offsets: Sequence[int]
+    forecast_offsets: Sequence[int]
+
+    def offsets(self, model_run_type: ModelRunType) -> Sequence[int]:
+        if model_run_type == ModelRunType.NOWCAST:
+            return self.nowcast_offsets
+        elif model_run_type == ModelRunType.FORECAST:
+            return self.forecast_offsets
+        return []
+
+
+# https://tidesandcurrents.noaa.gov/models.html
+NOS_OFS_CADENCES: Dict[str, ModelCadence] = {
+    'cbofs': ModelCadence(range(1, 7), range(1, 49)),
+    'ciofs': ModelCadence(range(1, 7), range(1, 49)),
+    'creofs': ModelCadence(range(1, 7), range(1, 49)),
+    'dbofs': ModelCadence(range(1, 7), range(1, 49)),
+    'gomofs': ModelCadence(range(3, 7, 3), range(3, 73, 3)),
+    'leofs': ModelCadence(range(1, 7), range(1, 121)),
+    'lmhofs': ModelCadence(range(1, 7), range(1, 121)),
+    'loofs': ModelCadence(range(1, 7), range(1, 121)),
+    'lsofs': ModelCadence(range(1, 7), range(1, 121)),
+    'ngofs2': ModelCadence(range(1, 7), range(1, 49)),
+    'sfbofs': ModelCadence(range(1, 7), range(1, 49)),
+    'tbofs': ModelCadence(range(1, 7), range(1, 49)),
+    'wcofs': ModelCadence(range(3, 25, 3), range(3, 73, 3)),
+}
+
+
+def model_run_member_keys(model_run_glob: str, offsets: Sequence[int]) -> List[str]:
+    '''
+    Enumerate the expected member keys of a model run from its glob expression:
+        'nos/dbofs/nos.dbofs.fields.f[0-9][0-9][0-9].20230315.t00z.nc.zarr'
+    With offsets 1 and 2 the following keys will be created:
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr', 'nos/dbofs/nos.dbofs.fields.f002.20230315.t00z.nc.zarr'
+
+    :param model_run_glob: The glob expression matching the model run files
+    :param offsets: The offsets of the model run files
+    :returns: The expected keys, in offset order
+    '''
+    return [model_run_glob.replace(OFFSET_GLOB_EXPRESSION, f'{offset:03d}', 1) for offset in offsets]
+
+
+async def _head_all(fs: fsspec.AbstractFileSystem, urls: List[str], max_concurrent: int) -> List[bool]:
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def head(url: str) -> bool:
+        bucket, key, _ = fs.split_path(url)
+        async with semaphore:
+            try:
+                await fs._call_s3('head_object', Bucket=bucket, Key=key)
+                return True
+            except FileNotFoundError:
+                return False
+
+    return await asyncio.gather(*[head(url) for url in urls])
+
+
+def find_existing_files(fs: fsspec.AbstractFileSystem, urls: List[str], max_concurrent: int = MAX_CONCURRENT_HEADS) -> List[str]:
+    '''
+    Find which of the given files exist. S3 files are checked with concurrent HEAD requests, so unlike an existence
+    check through the filesystem a missing file never falls back to listing its prefix.
+
+    :param fs: The filesystem the files are in
+    :param urls: The urls of the files
+    :param max_concurrent: The maximum number of HEAD requests in flight at once
+    :returns: The urls of the files that exist, in the given order
+    '''
+    if hasattr(fs, '_call_s3'):
+        exists = sync(fs.loop, _head_all, fs, urls, max_concurrent)
+    else:
+        exists = [fs.exists(url) for url in urls]
+    count_requests(len(urls))
+
+    return [url for url, e in zip(urls, exists) if e]
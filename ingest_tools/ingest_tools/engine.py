@@ -0,0 +1,172 @@
+'''
+Concurrent ingestion of many keys in one process
+
+Kerchunking a key spends most of its time waiting on S3: the HEAD requests of the duplicate check, the reads of the
+format detection and the metadata scan, and the write of the references. IngestEngine runs many keys at once as
+coroutines on fsspec's event loop, which the shared s3fs filesystems make their requests on, with a limit on the
+number of keys in flight. Pipelines implementing generate_kerchunk_async, like the NOS OFS and RTOFS pipelines,
+await the HEAD request, the duplicate check, the format detection and the write of the references on the loop.
+The kerchunk scanners read through synchronous file objects, h5py and scipy cannot await their reads, so only the
+scan and translation of a file, and the serialization of its references, run on a worker thread. Other pipelines
+run entirely on a worker thread.
+
+    engine = IngestEngine(lambda region: context, max_concurrent=16)
+    results = engine.run([(bucket, key) for key in keys])
+
+From async code, await engine.ingest(...) instead. In a lambda, handle_batch processes a whole SQS batch and
+reports the records that failed.
+'''
+
+import asyncio
+import traceback
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fsspec.asyn import get_loop, sync
+
+from .aws import parse_s3_sqs_payload
+from .pipeline import KerchunkResult, PipelineContext
+
+
+# The default number of keys kerchunked at once
+DEFAULT_MAX_CONCURRENT_KEYS = 16
+
+
+@dataclass
+class IngestResult:
+    '''
+    The result of ingesting a single key
+
+    :param bucket: The source bucket
+    :param key: The source key
+    :param output_keys: The destination keys of every pipeline that wrote references for the key
+    :param skipped_keys: The destination keys of every pipeline that skipped the key without writing references
+    :param error: The error message if any pipeline failed, None on success
+    '''
+    bucket: str
+    key: str
+    output_keys: List[str] = field(default_factory=list)
+    skipped_keys: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+    @property
+    def skipped(self) -> bool:
+        '''
+        Whether every pipeline skipped the key, so no references exist for it
+        '''
+        return self.succeeded and len(self.output_keys) == 0 and len(self.skipped_keys) > 0
+
+
+class IngestEngine:
+    '''
+    Kerchunks many keys concurrently with every matching pipeline
+    '''
+
+    def __init__(
+        self,
+        get_context: Callable[[str], PipelineContext],
+        region: str = 'us-east-1',
+        max_concurrent: int = DEFAULT_MAX_CONCURRENT_KEYS,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        '''
+        :param get_context: Function returning the pipeline context of a region
+        :param region: The region of keys ingested without one
+        :param max_concurrent: The maximum number of keys in flight at once
+        :param executor: The executor the blocking work of the pipelines runs on, a thread pool of max_concurrent threads
+            by default
+        '''
+        self.get_context = get_context
+        self.region = region
+        self.max_concurrent = max_concurrent
+        self.executor = executor
+
+    async def _run_pipelines(self, region: str, bucket: str, key: str, executor: Executor) -> IngestResult:
+        context = self.get_context(region)
+        result = IngestResult(bucket, key)
+        for pipeline in context.get_matching_pipelines(key):
+            try:
+                if await pipeline.run_async(context.get_region(), bucket, key, context.get_dest_bucket(), executor) == KerchunkResult.SKIPPED:
+                    result.skipped_keys.append(pipeline.generate_destination_key(key))
+                else:
+                    result.output_keys.append(pipeline.generate_destination_key(key))
+            except Exception as e:
+                print(f'Failed to ingest {key}: {e}')
+                traceback.print_exc()
+                result.error = str(e)
+        return result
+
+    async def ingest(self, items: Iterable[Tuple[str, str]], region: Optional[str] = None) -> List[IngestResult]:
+        '''
+        Kerchunk every key with its matching pipelines, at most max_concurrent keys at once
+
+        :param items: The (bucket, key) of every source file
+        :param region: The region of the buckets, defaults to the engine's region
+        :returns: The result of every key, in the given order
+        '''
+        coroutine = self._ingest([(region or self.region, bucket, key) for bucket, key in items])
+        loop = get_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coroutine
+
+        # The requests of the shared filesystems can only be awaited on fsspec's event loop
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+
+    async def _ingest(self, items: List[Tuple[str, str, str]]) -> List[IngestResult]:
+        if len(items) == 0:
+            return []
+
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        executor = self.executor or ThreadPoolExecutor(max_workers=min(self.max_concurrent, len(items)))
+
+        async def ingest_one(region: str, bucket: str, key: str) -> IngestResult:
+            async with semaphore:
+                return await self._run_pipelines(region, bucket, key, executor)
+
+        try:
+            return await asyncio.gather(*[ingest_one(*item) for item in items])
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(wait=False)
+
+    def run(self, items: Iterable[Tuple[str, str]], region: Optional[str] = None) -> List[IngestResult]:
+        '''
+        Kerchunk every key from synchronous code, see ingest
+
+        :param items: The (bucket, key) of every source file
+        :param region: The region of the buckets, defaults to the engine's region
+        :returns: The result of every key, in the given order
+        '''
+        return sync(get_loop(), self._ingest, [(region or self.region, bucket, key) for bucket, key in items])
+
+    def handle_batch(self, records: List[dict]) -> Dict[str, List[Dict[str, str]]]:
+        '''
+        Kerchunk the keys of every record of an SQS batch of new object notifications. Records for the same key are
+        kerchunked once.
+
+        :param records: The SQS records
+        :returns: The partial batch response, listing the message ids of the failed records as batchItemFailures
+        '''
+        failures = []
+        message_ids: Dict[Tuple[str, str, str], List[str]] = {}
+        for record in records:
+            try:
+                item = parse_s3_sqs_payload(record['body'])
+            except Exception as e:
+                print(f"Failed to parse SQS message {record['messageId']}: {e}")
+                failures.append(record['messageId'])
+                continue
+            message_ids.setdefault(item, []).append(record['messageId'])
+
+        print(f'Ingesting {len(message_ids)} keys from {len(records)} SQS records...')
+        results = sync(get_loop(), self._ingest, list(message_ids))
+        for item, result in zip(message_ids, results):
+            if not result.succeeded:
+                failures.extend(message_ids[item])
+
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
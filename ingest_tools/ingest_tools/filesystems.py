@@ -0,0 +1,108 @@
+'''
+Shared S3 filesystems for warm containers
+
+Creating an S3 filesystem creates a new botocore session and client, and the first request made with it pays for
+a new TLS connection. A lambda container is reused across invocations, so the filesystems are kept in a module level
+registry keyed by their options and their pooled keep-alive connections are reused by every file the container
+processes.
+
+The S3 filesystems run their requests on fsspec's shared event loop, fsspec.asyn.get_loop(). Coroutines running on
+that loop, like the ones of IngestEngine, await the filesystems' requests directly with call_async instead of
+blocking a thread on each of them.
+'''
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import Executor
+from typing import Any, Dict, Optional, Tuple
+
+import fsspec
+
+
+# The maximum number of pooled connections each S3 filesystem keeps open, botocore defaults to 10
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+
+_filesystems: Dict[Tuple, fsspec.AbstractFileSystem] = {}
+_filesystems_lock = threading.Lock()
+
+
+def _filesystem_key(anon: bool, max_pool_connections: int, options: dict) -> Tuple:
+    return (anon, max_pool_connections, tuple(sorted((k, repr(v)) for k, v in options.items())))
+
+
+def get_s3_filesystem(anon: bool, max_pool_connections: Optional[int] = None, refresh: bool = False, **options) -> fsspec.AbstractFileSystem:
+    '''
+    Get the shared S3 filesystem for the given options, creating it the first time it is requested
+
+    Listings are not cached, since the filesystem outlives a single invocation and the bucket contents change
+    between invocations.
+
+    :param anon: Whether to access the bucket anonymously
+    :param max_pool_connections: The maximum number of pooled connections, defaults to DEFAULT_MAX_POOL_CONNECTIONS
+    :param refresh: Replace the shared filesystem with a new one, for example to pick up refreshed credentials
+    :param options: Any other options to pass to the S3 filesystem
+    :returns: The shared S3 filesystem
+    '''
+    max_pool_connections = max_pool_connections or DEFAULT_MAX_POOL_CONNECTIONS
+    key = _filesystem_key(anon, max_pool_connections, options)
+
+    with _filesystems_lock:
+        fs = _filesystems.get(key)
+        if fs is None or refresh:
+            fs = fsspec.filesystem(
+                's3',
+                anon=anon,
+                skip_instance_cache=True,
+                use_listings_cache=False,
+                config_kwargs={'max_pool_connections': max_pool_connections},
+                **options,
+            )
+            _filesystems[key] = fs
+        return fs
+
+
+def get_read_filesystem(**options) -> fsspec.AbstractFileSystem:
+    '''
+    Get the shared anonymous S3 filesystem used to read from public buckets
+
+    :param options: Options to pass to get_s3_filesystem
+    :returns: The shared S3 filesystem
+    '''
+    return get_s3_filesystem(anon=True, **options)
+
+
+def get_write_filesystem(**options) -> fsspec.AbstractFileSystem:
+    '''
+    Get the shared authenticated S3 filesystem used to write to the ingest bucket
+
+    :param options: Options to pass to get_s3_filesystem
+    :returns: The shared S3 filesystem
+    '''
+    return get_s3_filesystem(anon=False, **options)
+
+
+def clear_filesystems():
+    '''
+    Drop every shared filesystem, so the next request creates new filesystems with fresh credentials
+    '''
+    with _filesystems_lock:
+        _filesystems.clear()
+
+
+async def call_async(fs: fsspec.AbstractFileSystem, method: str, *args, executor: Optional[Executor] = None, **kwargs) -> Any:
+    '''
+    Call a filesystem method from a coroutine running on fsspec's event loop. The requests of async filesystems,
+    like the shared S3 filesystems, are awaited on the loop, the blocking method of any other filesystem runs on the
+    executor.
+
+    :param fs: The filesystem
+    :param method: The name of the blocking method, for example info, cat_file or pipe_file
+    :param executor: The executor blocking methods run on, the event loop's default executor if None
+    :returns: The result of the method
+    '''
+    if getattr(fs, 'async_impl', False):
+        return await getattr(fs, f'_{method}')(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(getattr(fs, method), *args, **kwargs))
@@ -1,9 +1,25 @@
+from concurrent.futures import Executor
 from enum import Enum
-from typing import Any, List
+from typing import Any, List, Optional
+
 import fsspec
-import ujson
-from kerchunk.hdf import SingleHdf5ToZarr
-from kerchunk.netCDF3 import NetCDF3ToZarr
+
+from .filesystems import call_async, get_read_filesystem, get_write_filesystem
+from .metrics import count_requests, phase, read_counts, run_in_executor, track_reads
+from .netcdf3 import SharedFileNetCDF3ToZarr
+from .pipeline import KerchunkResult
+from .references import (
+    ReferenceFormat,
+    inline_whole_variables,
+    is_same_source,
+    read_references_metadata,
+    read_references_metadata_async,
+    source_metadata,
+    subchunk_references,
+    write_references,
+    write_references_async,
+)
+from .templates import TemplatedHdf5ToZarr
 
 
 class ModelRunType(Enum):
@@ -46,44 +62,189 @@ class FileFormat(Enum):
             return FileFormat.UNKNOWN
 
 
-def generate_kerchunked(bucket: str, key: str, dest_key: str, dest_bucket: str, dest_prefix: str):
+# Source files are read through an LRU cache of small blocks. Scanning HDF5 and NetCDF3 files only reads their
+# metadata, the NetCDF3 header at the start of the file and the HDF5 object headers and chunk indexes spread
+# through it, so small blocks fetch little more than the metadata while still serving the many tiny sequential
+# reads of a header walk from memory.
+SCAN_BLOCK_SIZE = 256 * 1024
+SCAN_MAX_BLOCKS = 64
+
+
+def open_for_scan(fs: fsspec.AbstractFileSystem, url: str, details: Optional[dict] = None):
+    '''
+    Open a source file for format detection and scanning, with a block cache tuned for reading metadata and
+    its reads counted by track_reads
+
+    :param fs: The filesystem the file is in
+    :param url: The url of the file
+    :param details: The info of the file if it is already known, otherwise the file requests it
+    :returns: The open file
+    '''
+    options = {} if details is None else {'size': details['size']}
+    f = fs.open(url, block_size=SCAN_BLOCK_SIZE, cache_type='blockcache', cache_options={'maxblocks': SCAN_MAX_BLOCKS}, **options)
+    if details is not None:
+        # Newer s3fs releases read the ETag from the details to make every ranged read conditional
+        f.details = details
+    return track_reads(f)
+
+
+def generate_kerchunked(
+    bucket: str,
+    key: str,
+    dest_key: str,
+    dest_bucket: str,
+    dest_prefix: str,
+    output_format: ReferenceFormat = ReferenceFormat.JSON,
+    inline_threshold: Optional[int] = None,
+    inline_variables: Optional[List[str]] = None,
+    subchunk_bytes: Optional[int] = None,
+) -> KerchunkResult:
     '''
     Generate a kerchunked zarr file from a file in s3
 
-    Automatically determines the file format and uses the appropriate kerchunker processor
+    Automatically determines the file format and uses the appropriate kerchunker processor. The source file is
+    opened once, and its format detected and its metadata scanned through the same handle and block cache. The
+    references are written as JSON by default, or as a partitioned parquet reference set
+
+    Duplicate notifications for a source object that has already been kerchunked, with the same ETag and size,
+    are skipped. Keys without a netcdf postfix and files in unsupported formats are not kerchunked, and
+    KerchunkResult.SKIPPED is returned for them
+
+    Chunks smaller than inline_threshold bytes are inlined, kerchunk's default for the file format is used if it
+    is None, and the variables in inline_variables are always inlined as a single chunk
+
+    If subchunk_bytes is set, the uncompressed chunks of NetCDF3 variables and contiguous HDF5 datasets are split
+    into row blocks of at most that many bytes, so spatial subsets are read without fetching whole fields
     '''
     if not key.endswith('.nc'):
         print(f'File {key} does not have a netcdf file postfix. Skipping...')
-        return
+        return KerchunkResult.SKIPPED
 
-    fs_read = fsspec.filesystem('s3', anon=True, skip_instance_cache=True)
-    fs_write = fsspec.filesystem('s3', anon=False, skip_instance_cache=True)
+    fs_read = get_read_filesystem()
+    fs_write = get_write_filesystem()
 
     url = f"s3://{bucket}/{key}"
     outurl = f"s3://{dest_bucket}/{dest_prefix}/{dest_key}"
 
-    with fs_read.open(url) as ifile:
+    with phase('open'):
+        ifile = open_for_scan(fs_read, url)
+
+    with ifile:
+        with phase('check'):
+            etag, size = ifile.details['ETag'], ifile.size
+            if is_same_source(read_references_metadata(fs_write, outurl), etag, size):
+                print(f'{url} has already been kerchunked to {outurl}. Skipping...')
+                return KerchunkResult.WRITTEN
+
         print(f'Identifying file at {url}')
-        raw = ifile.read(5)
-        fmt = FileFormat.from_startbytes(raw)
+        with phase('sniff'):
+            raw = ifile.read(5)
+            fmt = FileFormat.from_startbytes(raw)
 
         if fmt == FileFormat.UNKNOWN or fmt == FileFormat.GRIB2:
             print(f'File format {fmt} for {url} not supported. Skipping...')
-            return
+            return KerchunkResult.SKIPPED
 
-        print(f'Kerchunking {url}...')
-        try:
-            if fmt == FileFormat.NETCDF or fmt == FileFormat.NETCDF_64BIT:
-                chunks = NetCDF3ToZarr(url, storage_options={'anon': True})
-            elif fmt == FileFormat.HDF:
-                chunks = SingleHdf5ToZarr(ifile, url)
-        except Exception as e:
-            print(f'Failed to kerchunk {url}: {e}')
-            return
-
-        print(f"Writing kerchunked json to {outurl}")
-        with fs_write.open(outurl, mode="w") as ofile:
-            data = ujson.dumps(chunks.translate())
-            ofile.write(data)
+        refs = _scan(ifile, url, fmt, inline_threshold, inline_variables, subchunk_bytes)
+
+        print(f"Writing kerchunked {output_format.name.lower()} references to {outurl}")
+        write_references(fs_write, outurl, refs, output_format, metadata=source_metadata(etag, size))
     
     print(f'Successfully processed {url}')
+    return KerchunkResult.WRITTEN
+
+
+async def generate_kerchunked_async(
+    bucket: str,
+    key: str,
+    dest_key: str,
+    dest_bucket: str,
+    dest_prefix: str,
+    output_format: ReferenceFormat = ReferenceFormat.JSON,
+    inline_threshold: Optional[int] = None,
+    inline_variables: Optional[List[str]] = None,
+    subchunk_bytes: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> KerchunkResult:
+    '''
+    generate_kerchunked for a coroutine running on fsspec's event loop, see IngestEngine
+
+    The HEAD request of the source file, the duplicate check, the format detection and the write of the references
+    are awaited on the event loop. Only scanning the file, which the kerchunk scanners read through a synchronous
+    file, and serializing the references run on the executor.
+
+    :param executor: The executor the file is scanned on, the event loop's default executor if None
+    '''
+    if not key.endswith('.nc'):
+        print(f'File {key} does not have a netcdf file postfix. Skipping...')
+        return KerchunkResult.SKIPPED
+
+    fs_read = get_read_filesystem()
+    fs_write = get_write_filesystem()
+
+    url = f"s3://{bucket}/{key}"
+    outurl = f"s3://{dest_bucket}/{dest_prefix}/{dest_key}"
+
+    with phase('open'):
+        info = await call_async(fs_read, 'info', url, executor=executor)
+        count_requests()
+
+    with phase('check'):
+        etag, size = info['ETag'], info['size']
+        if is_same_source(await read_references_metadata_async(fs_write, outurl, executor), etag, size):
+            print(f'{url} has already been kerchunked to {outurl}. Skipping...')
+            return KerchunkResult.WRITTEN
+
+    print(f'Identifying file at {url}')
+    with phase('sniff'):
+        raw = await call_async(fs_read, 'cat_file', url, start=0, end=5, executor=executor)
+        count_requests(bytes_read=len(raw))
+        fmt = FileFormat.from_startbytes(raw)
+
+    if fmt == FileFormat.UNKNOWN or fmt == FileFormat.GRIB2:
+        print(f'File format {fmt} for {url} not supported. Skipping...')
+        return KerchunkResult.SKIPPED
+
+    def scan():
+        # The info is already known, so the file makes no HEAD request of its own
+        with open_for_scan(fs_read, url, details=info) as ifile:
+            return _scan(ifile, url, fmt, inline_threshold, inline_variables, subchunk_bytes)
+
+    refs = await run_in_executor(executor, scan)
+
+    print(f"Writing kerchunked {output_format.name.lower()} references to {outurl}")
+    await write_references_async(fs_write, outurl, refs, output_format, metadata=source_metadata(etag, size), executor=executor)
+
+    print(f'Successfully processed {url}')
+    return KerchunkResult.WRITTEN
+
+
+def _scan(ifile, url: str, fmt: FileFormat, inline_threshold: Optional[int], inline_variables: Optional[List[str]], subchunk_bytes: Optional[int]) -> dict:
+    print(f'Kerchunking {url}...')
+    try:
+        with phase('scan'):
+            if fmt == FileFormat.NETCDF or fmt == FileFormat.NETCDF_64BIT:
+                options = {} if inline_threshold is None else {'inline_threshold': inline_threshold}
+                chunks = SharedFileNetCDF3ToZarr(ifile, url, **options)
+            elif fmt == FileFormat.HDF:
+                options = {} if inline_threshold is None else {'inline_threshold': inline_threshold}
+                chunks = TemplatedHdf5ToZarr(ifile, url, **options)
+    except Exception as e:
+        # Raised so the record is reported as failed and redelivered
+        print(f'Failed to kerchunk {url}: {e}')
+        raise
+
+    with phase('translate'):
+        refs = chunks.translate()
+
+    if inline_variables:
+        with phase('inline'):
+            refs = inline_whole_variables(refs, inline_variables, {'anon': True})
+
+    if subchunk_bytes is not None:
+        with phase('subchunk'):
+            refs = subchunk_references(refs, subchunk_bytes)
+
+    counts = read_counts(ifile)
+    print(f'Read {counts.bytes_read} bytes of {url} in {counts.requests} requests')
+    return refs
@@ -0,0 +1,370 @@
+'''
+GRIB2 ingest from NODD .idx sidecars
+
+Every GRIB2 file on NODD is published with an .idx sidecar listing the offset, reference date and attributes of
+each of its messages:
+
+    1:0:d=2023110401:REFC:entire atmosphere:5 hour fcst:
+    2:449315:d=2023110401:RETOP:cloud top:5 hour fcst:
+
+Files of the same forecast horizon of a model, for example every HRRR conus wrfsfcf05 file, contain the same messages
+in the same order. Once one file of a horizon has been fully scanned with scan_grib, the references of each of its
+messages are kept as a mapping from the message attributes to the message references. The references of the next
+file of that horizon are then built from its .idx sidecar alone: each message's references are copied from the
+mapping, pointed at the new message's offset and length, and its run time and valid time coordinates shifted to the
+new reference date. None of the message bodies are downloaded.
+
+The mappings are kept in memory per container and written next to the references, so other containers and later
+runs reuse them. A file whose .idx sidecar is missing or does not match the mapping is scanned with scan_grib, and
+its mapping replaced.
+'''
+
+import base64
+import datetime
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import fsspec
+import numpy as np
+import pandas as pd
+import ujson
+
+from .filemetadata import FileMetadata
+from .filesystems import get_read_filesystem, get_write_filesystem
+from .metrics import phase
+from .pipeline import Pipeline
+from .references import ReferenceFormat, is_same_source, read_references_metadata, source_metadata, write_references
+
+
+GRIB_IDX_SUFFIX = '.idx'
+
+# The mappings are written under this prefix of the pipeline's destination prefix. The keys do not end in .zarr,
+# so writing them does not trigger the aggregation notifications.
+GRIB_MAPPING_PREFIX = 'grib-mappings'
+
+GRIB_MAPPING_VERSION = 1
+
+# The number of mappings kept per container, one per model horizon
+MAX_MAPPINGS = 256
+
+# The inlined coordinates that depend on the reference date of the file, shifted when a mapping is applied
+GRIB_TIME_COORDINATES = ['time', 'valid_time']
+
+IDX_DATE_FORMAT = '%Y%m%d%H'
+
+CYCLE_PATTERN = re.compile(r'\.t\d{2}z')
+
+DATE_DIRECTORY_PATTERN = re.compile(r'\d{8}')
+
+_mappings: 'OrderedDict[str, dict]' = OrderedDict()
+_mappings_lock = threading.Lock()
+
+
+def _grib2():
+    try:
+        from kerchunk import grib2
+    except ImportError:
+        raise ImportError('cfgrib is required to kerchunk GRIB2 files')
+    return grib2
+
+
+def parse_grib_idx(text: str, size: int) -> pd.DataFrame:
+    '''
+    Parse a NODD .idx sidecar into a table with one row per message:
+
+        idx          the message number, counted from 1
+        offset       the offset of the message in the GRIB2 file
+        length       the length of the message, up to the next message or the end of the file
+        date         the reference date of the message, for example 2023110401
+        attrs        the message attributes, for example REFC:entire atmosphere:5 hour fcst:
+        message_key  the attributes, suffixed with #n for the nth repeat of the same attributes in the file
+
+    :param text: The contents of the .idx sidecar
+    :param size: The size of the GRIB2 file
+    :returns: The message table
+    :raises ValueError: If a line of the sidecar cannot be parsed
+    '''
+    rows = []
+    for line in text.splitlines():
+        if len(line.strip()) == 0:
+            continue
+        try:
+            idx, offset, date, attrs = line.split(':', maxsplit=3)
+            rows.append([int(idx), int(offset), date.strip()[len('d='):], attrs])
+        except ValueError:
+            raise ValueError(f'Could not parse .idx line: {line}')
+
+    table = pd.DataFrame(rows, columns=['idx', 'offset', 'date', 'attrs'])
+    table['length'] = table['offset'].shift(-1, fill_value=size) - table['offset']
+    repeat = table.groupby('attrs').cumcount()
+    table['message_key'] = table['attrs'].where(repeat == 0, table['attrs'] + '#' + repeat.astype(str))
+    return table[['idx', 'offset', 'length', 'date', 'attrs', 'message_key']]
+
+
+def grib_horizon(key: str) -> str:
+    '''
+    The forecast horizon of a GRIB2 file key, shared by every file of the same model, domain, product and forecast
+    hour regardless of the model run:
+        'hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2'
+    results in conus.hrrr.wrfsfcf05.grib2
+
+    :param key: The key of the GRIB2 file
+    :returns: The horizon
+    '''
+    components = key.split('/')
+    directories = [c for c in components[:-1] if not DATE_DIRECTORY_PATTERN.search(c) and not c.isdigit()]
+    return '.'.join(directories + [CYCLE_PATTERN.sub('', components[-1])])
+
+
+def _chunk_references(refs: dict) -> Dict[str, list]:
+    return {k: v for k, v in refs.items() if isinstance(v, list)}
+
+
+def _decode_inline(value: str) -> bytes:
+    if value.startswith('base64:'):
+        return base64.b64decode(value[len('base64:'):])
+    return value.encode()
+
+
+def _shift_time_coordinates(refs: dict, seconds: int) -> dict:
+    shifted = dict(refs)
+    for name in GRIB_TIME_COORDINATES:
+        if f'{name}/.zarray' not in refs:
+            continue
+
+        zarray = ujson.loads(refs[f'{name}/.zarray'])
+        zattrs = ujson.loads(refs.get(f'{name}/.zattrs', '{}'))
+        chunk_key = f'{name}/' + ('.'.join('0' for _ in zarray['shape']) or '0')
+        value = refs.get(chunk_key)
+        if not isinstance(value, str) or zarray.get('compressor') is not None or zarray.get('filters'):
+            raise ValueError(f'The {name} coordinate is not inlined')
+        if not str(zattrs.get('units', '')).startswith('seconds since'):
+            raise ValueError(f'The {name} coordinate is not in seconds')
+
+        data = np.frombuffer(_decode_inline(value), dtype=zarray['dtype']) + seconds
+        shifted[chunk_key] = 'base64:' + base64.b64encode(data.astype(zarray['dtype']).tobytes()).decode()
+    return shifted
+
+
+def build_grib_mapping(horizon: str, idx: pd.DataFrame, messages: List[dict]) -> dict:
+    '''
+    Build the mapping of a horizon from the .idx table and the scan_grib references of one of its files
+
+    :param horizon: The horizon of the file
+    :param idx: The parsed .idx table of the file
+    :param messages: The scan_grib references of every message of the file, in file order
+    :returns: The mapping
+    :raises ValueError: If the messages do not line up with the .idx table
+    '''
+    if len(messages) != len(idx):
+        raise ValueError(f'scan_grib found {len(messages)} messages, the .idx sidecar lists {len(idx)}')
+    if idx['date'].nunique() != 1:
+        raise ValueError('The .idx sidecar lists more than one reference date')
+
+    mapped = {}
+    for row, message in zip(idx.itertuples(), messages):
+        refs = message['refs']
+        chunks = _chunk_references(refs)
+        if any(v[1:] != [row.offset, row.length] for v in chunks.values()):
+            raise ValueError(f'The references of message {row.idx} do not match its .idx offset {row.offset} and length {row.length}')
+        # Fails early if the time coordinates cannot be shifted
+        _shift_time_coordinates(refs, 0)
+        mapped[row.message_key] = {
+            'refs': {k: v for k, v in refs.items() if not isinstance(v, list)},
+            'chunks': sorted(chunks),
+        }
+
+    return {
+        'version': GRIB_MAPPING_VERSION,
+        'horizon': horizon,
+        'date': idx['date'].iloc[0],
+        'messages': mapped,
+    }
+
+
+def references_from_mapping(mapping: dict, idx: pd.DataFrame, url: str) -> Optional[List[dict]]:
+    '''
+    Build the references of every message of a GRIB2 file from the mapping of its horizon and its .idx table,
+    without reading the file
+
+    :param mapping: The mapping of the file's horizon
+    :param idx: The parsed .idx table of the file
+    :param url: The url of the file
+    :returns: The references of every message, in file order, or None if the mapping does not match the file
+    '''
+    messages = mapping['messages']
+    if mapping.get('version') != GRIB_MAPPING_VERSION or len(messages) != len(idx) or idx['date'].nunique() != 1:
+        return None
+    if not idx['message_key'].isin(list(messages)).all():
+        return None
+
+    date = datetime.datetime.strptime(idx['date'].iloc[0], IDX_DATE_FORMAT)
+    seconds = int((date - datetime.datetime.strptime(mapping['date'], IDX_DATE_FORMAT)).total_seconds())
+
+    result = []
+    for row in idx.itertuples():
+        template = messages[row.message_key]
+        refs = _shift_time_coordinates(template['refs'], seconds)
+        for chunk in template['chunks']:
+            refs[chunk] = [url, int(row.offset), int(row.length)]
+        result.append({'version': 1, 'refs': refs})
+    return result
+
+
+def get_mapping(horizon: str) -> Optional[dict]:
+    '''
+    :returns: The mapping of a horizon kept in this container, or None
+    '''
+    with _mappings_lock:
+        mapping = _mappings.get(horizon)
+        if mapping is not None:
+            _mappings.move_to_end(horizon)
+        return mapping
+
+
+def put_mapping(horizon: str, mapping: dict):
+    '''
+    Keep the mapping of a horizon in this container
+
+    :param horizon: The horizon
+    :param mapping: The mapping
+    '''
+    with _mappings_lock:
+        _mappings[horizon] = mapping
+        _mappings.move_to_end(horizon)
+        while len(_mappings) > MAX_MAPPINGS:
+            _mappings.popitem(last=False)
+
+
+def clear_mappings():
+    '''
+    Drop every mapping kept in this container
+    '''
+    with _mappings_lock:
+        _mappings.clear()
+
+
+def read_grib_mapping(fs: fsspec.AbstractFileSystem, url: str) -> Optional[dict]:
+    '''
+    Read a written mapping
+
+    :param fs: The filesystem the mapping is in
+    :param url: The url of the mapping
+    :returns: The mapping, or None if it does not exist or cannot be parsed
+    '''
+    try:
+        return ujson.loads(fs.cat(url))
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f'Failed to parse the GRIB mapping {url}: {e}')
+        return None
+
+
+def write_grib_mapping(fs: fsspec.AbstractFileSystem, url: str, mapping: dict):
+    '''
+    Write a mapping so other containers reuse it
+
+    :param fs: The filesystem to write the mapping to
+    :param url: The url of the mapping
+    :param mapping: The mapping
+    '''
+    fs.pipe(url, ujson.dumps(mapping).encode())
+
+
+def generate_kerchunked_grib(bucket: str, key: str, dest_key: str, dest_bucket: str, dest_prefix: str, output_format: ReferenceFormat = ReferenceFormat.JSON):
+    '''
+    Generate a kerchunked zarr file from a GRIB2 file in s3, from its .idx sidecar and the mapping of its horizon
+    when possible, otherwise by scanning the file
+
+    Duplicate notifications for a source object that has already been kerchunked, with the same ETag and size,
+    are skipped
+    '''
+    fs_read = get_read_filesystem()
+    fs_write = get_write_filesystem()
+
+    url = f's3://{bucket}/{key}'
+    outurl = f's3://{dest_bucket}/{dest_prefix}/{dest_key}'
+    horizon = grib_horizon(key)
+    mapping_url = f's3://{dest_bucket}/{dest_prefix}/{GRIB_MAPPING_PREFIX}/{horizon}.json'
+
+    with phase('check'):
+        info = fs_read.info(url)
+        etag, size = info['ETag'], info['size']
+        if is_same_source(read_references_metadata(fs_write, outurl), etag, size):
+            print(f'{url} has already been kerchunked to {outurl}. Skipping...')
+            return
+
+    with phase('index'):
+        try:
+            idx = parse_grib_idx(fs_read.cat(f'{url}{GRIB_IDX_SUFFIX}').decode(), size)
+        except (FileNotFoundError, ValueError) as e:
+            print(f'Failed to read the .idx sidecar of {url}: {e}')
+            idx = None
+
+    messages = None
+    if idx is not None:
+        with phase('mapping'):
+            mapping = get_mapping(horizon) or read_grib_mapping(fs_write, mapping_url)
+            if mapping is not None:
+                messages = references_from_mapping(mapping, idx, url)
+                if messages is None:
+                    print(f'The {horizon} mapping does not match {url}')
+                else:
+                    put_mapping(horizon, mapping)
+
+    if messages is None:
+        print(f'Scanning {url}...')
+        try:
+            with phase('scan'):
+                messages = _grib2().scan_grib(url, storage_options={'anon': True})
+        except Exception as e:
+            # Raised so the record is reported as failed and redelivered
+            print(f'Failed to kerchunk {url}: {e}')
+            raise
+
+        if idx is not None:
+            try:
+                mapping = build_grib_mapping(horizon, idx, messages)
+            except ValueError as e:
+                print(f'Failed to build the {horizon} mapping from {url}: {e}')
+            else:
+                put_mapping(horizon, mapping)
+                write_grib_mapping(fs_write, mapping_url, mapping)
+
+    with phase('translate'):
+        refs = _grib2().grib_tree(messages)
+
+    print(f'Writing kerchunked {output_format.name.lower()} references to {outurl}')
+    write_references(fs_write, outurl, refs, output_format, metadata=source_metadata(etag, size))
+
+    print(f'Successfully processed {url}')
+
+
+class HRRR_Pipeline(Pipeline):
+
+    def __init__(self, output_format: ReferenceFormat = ReferenceFormat.JSON) -> None:
+        super().__init__('.grib2', ['wrfsfcf'], 'hrrr', output_format)
+
+    def read_file_metadata(self, key: str) -> FileMetadata:
+        '''
+        Parse the metadata of a HRRR key:
+            'hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2'
+        where the model date is 20231104, the model hour 01 and the offset 5
+        '''
+        model_date, model_hour, offset = re.search(r'hrrr\.(\d{8})/.*\.t(\d{2})z\.[a-z]+f(\d{2})', key).groups()
+        return FileMetadata(key, 'hrrr', model_date, model_hour, int(offset), self.generate_kerchunk_output_key(key))
+
+    def generate_kerchunk_output_key(self, key: str) -> str:
+        '''
+        Generate the output file key for a given input key, following the raw zarr layout of the HRRR aggregations:
+            'hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2'
+        The following output key will be generated: conus/hrrr.20231104/hrrr.t01z.wrfsfcf05.zarr
+        '''
+        date_directory, domain, filename = key.split('/')[-3:]
+        return f'{domain}/{date_directory}/{filename[:-len(self.fileformat)]}.zarr'
+
+    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str):
+        generate_kerchunked_grib(src_bucket, src_key, dest_key, dest_bucket, dest_prefix, self.output_format)
@@ -0,0 +1,99 @@
+'''
+Bulk key parsing
+
+Parses whole lists of model file keys at once into a table with one row per key, using compiled patterns and
+vectorized datetime arithmetic instead of a regular expression search and strptime call per key. This matters
+when bootstrapping a best time series from a listing of every file of a model, or when routing a backfill.
+
+The table has the following columns:
+
+    key             the key that was parsed
+    model           the model name, for example dbofs
+    model_date      the date of the model run, for example 20230315
+    model_hour      the cycle hour of the model run, for example 00
+    run_type        the offset prefix, f for forecast files and n for nowcast files
+    offset          the offset of the file from the model run in hours
+    model_run_time  the time of the model run
+    valid_time      the time the file is valid for, the model run time plus the offset
+'''
+
+import re
+from typing import Sequence
+
+import pandas as pd
+
+
+NOS_KEY_PATTERN = re.compile(r'nos\.(?P<model>[^./]+)\.[^/]*?(?P<run_type>[fn])(?P<offset>\d{3})\.(?P<model_date>\d{8})\.t(?P<model_hour>\d{2})z')
+
+RTOFS_KEY_PATTERN = re.compile(r'(?P<model>rtofs)\.(?P<model_date>\d{8}).*(?P<run_type>f)(?P<offset>\d{3})')
+
+# The columns of a parsed key table, in order
+KEY_TABLE_COLUMNS = ['key', 'model', 'model_date', 'model_hour', 'run_type', 'offset', 'model_run_time', 'valid_time']
+
+VALID_TIME_KEY_FORMAT = '%Y%m%dT%H'
+
+
+def _parse_keys(keys: Sequence[str], pattern: re.Pattern) -> pd.DataFrame:
+    keys = list(keys)
+    table = pd.Series(keys, dtype=object).str.extract(pattern)
+    unparsed = table['offset'].isna()
+    if unparsed.any():
+        raise ValueError(f'Failed to parse {unparsed.sum()} keys, for example {keys[unparsed.to_numpy().argmax()]}')
+
+    if 'model_hour' not in table:
+        table['model_hour'] = '00'
+
+    table.insert(0, 'key', keys)
+    table['offset'] = table['offset'].astype(int)
+    table['model_run_time'] = pd.to_datetime(table['model_date'] + table['model_hour'], format='%Y%m%d%H')
+    table['valid_time'] = table['model_run_time'] + pd.to_timedelta(table['offset'], unit='h')
+    return table[KEY_TABLE_COLUMNS]
+
+
+def parse_nos_keys(keys: Sequence[str]) -> pd.DataFrame:
+    '''
+    Parse a list of keys following the NOS naming convention, either the source or the zarr single file keys:
+        'cbofs.20231022/nos.cbofs.fields.n006.20231022.t00z.nc'
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr'
+
+    :param keys: The keys to parse
+    :returns: The parsed key table
+    :raises ValueError: If any of the keys does not follow the naming convention
+    '''
+    return _parse_keys(keys, NOS_KEY_PATTERN)
+
+
+def parse_rtofs_keys(keys: Sequence[str]) -> pd.DataFrame:
+    '''
+    Parse a list of keys following the RTOFS naming convention, either the source or the zarr single file keys:
+        'rtofs.20230922/rtofs_glo_2ds_f001_diag.nc'
+        'rtofs/rtofs.20230922.rtofs_glo_2ds_f001_diag.nc.zarr'
+    RTOFS runs once a day, so the model hour is always 00
+
+    :param keys: The keys to parse
+    :returns: The parsed key table
+    :raises ValueError: If any of the keys does not follow the naming convention
+    '''
+    return _parse_keys(keys, RTOFS_KEY_PATTERN)
+
+
+def select_best_time_series(table: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Select the file with the smallest offset for every valid time from a parsed key table. Ties are broken by
+    the key, so the result does not depend on the order of the table.
+
+    :param table: The parsed key table
+    :returns: The rows of the best files, ordered by valid time
+    '''
+    ordered = table.sort_values(['valid_time', 'offset', 'key'], kind='stable')
+    return ordered.drop_duplicates('valid_time', keep='first').reset_index(drop=True)
+
+
+def valid_time_keys(table: pd.DataFrame) -> pd.Series:
+    '''
+    Format the valid times of a parsed key table as valid time keys, for example 20230315T01
+
+    :param table: The parsed key table
+    :returns: The valid time keys
+    '''
+    return table['valid_time'].dt.strftime(VALID_TIME_KEY_FORMAT)
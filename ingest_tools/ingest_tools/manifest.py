@@ -0,0 +1,270 @@
+'''
+Best time series manifests
+
+A manifest is a small JSON object stored next to a best time series aggregation that maps each valid time in
+the best time series to the (offset, key) of the file that currently provides it, for example:
+
+    {"20230315T01": [1, "s3://nextgen-dmac-cloud-ingest/nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr"]}
+
+Keeping it up to date as files arrive means the aggregation does not have to list the whole model prefix on
+every new file to decide whether that file belongs to the best time series.
+'''
+
+import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import fsspec
+import pandas as pd
+import ujson
+
+from .keys import select_best_time_series, valid_time_keys
+from .metrics import count_requests
+
+
+# The ingest bucket expires model files after 29 days, prune manifest entries a day before that so
+# the best time series never references a member that no longer exists
+BEST_TIME_SERIES_RETENTION_DAYS = 28
+
+MANIFEST_POSTFIX = '.manifest.json'
+
+# How many times a manifest update is retried when another invocation wrote the manifest first
+MANIFEST_WRITE_ATTEMPTS = 5
+
+# The S3 error codes of a conditional write that lost to a concurrent write
+CONDITIONAL_WRITE_CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+BestTimeSeriesManifest = Dict[str, List]
+
+
+def generate_best_time_series_manifest_key(best_time_series_key: str) -> str:
+    '''
+    Create the manifest key for a given best time series aggregation key:
+        'nos/dbofs/nos.dbofs.fields.best.nc.zarr'
+    The following key will be generated: nos/dbofs/nos.dbofs.fields.best.nc.zarr.manifest.json'
+
+    The manifest key intentionally does not end with .zarr so writing it does not trigger another aggregation
+    '''
+    return f'{best_time_series_key}{MANIFEST_POSTFIX}'
+
+
+def read_best_time_series_manifest(fs: fsspec.AbstractFileSystem, url: str) -> Optional[BestTimeSeriesManifest]:
+    '''
+    Read the best time series manifest at the given url
+
+    :param fs: The filesystem to read the manifest from
+    :param url: The url of the manifest
+    :returns: The manifest, or None if there is no manifest at the given url yet
+    '''
+    try:
+        with fs.open(url, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        count_requests()
+        return None
+    count_requests(bytes_read=len(data))
+    return ujson.loads(data)
+
+
+def read_best_time_series_manifest_version(fs: fsspec.AbstractFileSystem, url: str) -> Tuple[Optional[BestTimeSeriesManifest], Optional[str]]:
+    '''
+    Read the best time series manifest at the given url together with its ETag, so it can be written back only if
+    no other invocation has written it in the meantime
+
+    :param fs: The filesystem to read the manifest from
+    :param url: The url of the manifest
+    :returns: The manifest and its ETag, the manifest is None if it does not exist yet and the ETag is None if the
+        filesystem does not report one
+    '''
+    # The ETag is read before the manifest, a manifest written in between fails the conditional write
+    fs.invalidate_cache(url)
+    count_requests()
+    try:
+        etag = fs.info(url).get('ETag')
+    except FileNotFoundError:
+        return None, None
+    return read_best_time_series_manifest(fs, url), etag
+
+
+def write_best_time_series_manifest(fs: fsspec.AbstractFileSystem, url: str, manifest: BestTimeSeriesManifest, etag: Optional[str] = None, create: bool = False):
+    '''
+    Write the best time series manifest to the given url
+
+    :param fs: The filesystem to write the manifest to
+    :param url: The url of the manifest
+    :param manifest: The manifest to write
+    :param etag: Only replace the manifest if it still has this ETag
+    :param create: Only write the manifest if it does not exist yet
+    :raises OSError: If the manifest was written by someone else, see is_conditional_write_conflict
+    '''
+    conditions = {}
+    if etag is not None:
+        conditions['IfMatch'] = etag
+    elif create:
+        conditions['IfNoneMatch'] = '*'
+
+    with fs.open(url, 'w', **conditions) as f:
+        f.write(ujson.dumps(manifest))
+
+
+def is_conditional_write_conflict(error: OSError) -> bool:
+    '''
+    Check whether a failed write was a conditional write that lost to a concurrent write
+
+    :param error: The error raised by the write
+    :returns: True if the condition of the write did not hold
+    '''
+    response = getattr(error.__cause__, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in CONDITIONAL_WRITE_CONFLICT_CODES
+
+
+def update_best_time_series_manifest(manifest: BestTimeSeriesManifest, model_date_key: str, offset: int, key: str) -> bool:
+    '''
+    Update the manifest with a single file, in place. The file replaces the current entry for its valid time when
+    there is no entry yet or when it has a smaller forecast offset than the current entry.
+
+    :param manifest: The manifest to update
+    :param model_date_key: The valid time key of the file, for example 20230315T01
+    :param offset: The forecast offset of the file in hours
+    :param key: The key of the file
+    :returns: True if the file is part of the best time series after the update, False otherwise
+    '''
+    entry = manifest.get(model_date_key)
+    if entry is None or offset < entry[0] or entry[1] == key:
+        manifest[model_date_key] = [offset, key]
+        return True
+    return False
+
+
+def build_best_time_series_manifest(keys: Iterable[str], parse_datestamp_offset: Callable[[str], Tuple[str, int]]) -> BestTimeSeriesManifest:
+    '''
+    Build a manifest from scratch for a list of files, for example the result of globbing the model prefix
+
+    :param keys: The keys of the files to build the manifest from
+    :param parse_datestamp_offset: Function parsing the valid time key and offset from a key
+    :returns: The manifest
+    '''
+    manifest = {}
+    for key in sorted(keys):
+        model_date_key, offset = parse_datestamp_offset(key)
+        update_best_time_series_manifest(manifest, model_date_key, offset, key)
+    return manifest
+
+
+def build_best_time_series_manifest_from_table(table: pd.DataFrame) -> BestTimeSeriesManifest:
+    '''
+    Build a manifest from scratch for a parsed key table, selecting the best file for every valid time with a
+    single vectorized group by instead of updating the manifest one file at a time
+
+    :param table: The parsed key table of the files to build the manifest from
+    :returns: The manifest
+    '''
+    best = select_best_time_series(table)
+    return {k: [int(offset), key] for k, offset, key in zip(valid_time_keys(best), best['offset'], best['key'])}
+
+
+def prune_best_time_series_manifest(manifest: BestTimeSeriesManifest, retention_days: int = BEST_TIME_SERIES_RETENTION_DAYS, now: Optional[datetime.datetime] = None) -> List[str]:
+    '''
+    Remove entries from the manifest, in place, whose model run is older than the retention period
+
+    :param manifest: The manifest to prune
+    :param retention_days: The number of days model runs are kept for
+    :param now: The current time, defaults to utcnow
+    :returns: The valid time keys that were removed
+    '''
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(days=retention_days)
+
+    expired = []
+    for model_date_key, (offset, _) in manifest.items():
+        model_run_date = datetime.datetime.strptime(model_date_key, '%Y%m%dT%H') - datetime.timedelta(hours=offset)
+        if model_run_date < cutoff:
+            expired.append(model_date_key)
+
+    for model_date_key in expired:
+        del manifest[model_date_key]
+
+    return expired
+
+
+def best_time_series_manifest_files(manifest: BestTimeSeriesManifest) -> List[str]:
+    '''
+    Get the files in the best time series, ordered by valid time
+
+    :param manifest: The manifest
+    :returns: The keys of the files in the best time series
+    '''
+    return [manifest[model_date_key][1] for model_date_key in sorted(manifest)]
+
+
+def resolve_best_time_series_files(
+    fs_read: fsspec.AbstractFileSystem,
+    fs_write: fsspec.AbstractFileSystem,
+    bucket: str,
+    keys: List[str],
+    best_time_series_glob: str,
+    best_time_series_key: str,
+    parse_datestamp_offset: Callable[[str], Tuple[str, int]],
+    parse_keys: Optional[Callable[[List[str]], pd.DataFrame]] = None,
+) -> Optional[List[str]]:
+    '''
+    Update the persisted manifest of a best time series with new files and resolve the files in the best time series.
+
+    The bucket is only listed to bootstrap the manifest the first time a best time series is aggregated, after that
+    each new file updates the manifest directly. The manifest is written back only if it has not changed since it
+    was read, otherwise the update is retried on the new manifest, so concurrent updates do not drop each other's
+    files.
+
+    :param fs_read: The filesystem to list the model files with when bootstrapping the manifest
+    :param fs_write: The filesystem to read and write the manifest with
+    :param bucket: The bucket containing the model files and the best time series
+    :param keys: The keys of the new files
+    :param best_time_series_glob: The glob expression matching all of the files of the model
+    :param best_time_series_key: The key of the best time series aggregation
+    :param parse_datestamp_offset: Function parsing the valid time key and offset from a key
+    :param parse_keys: Function parsing a list of keys into a key table, used to bootstrap the manifest in bulk
+    :returns: The files in the best time series ordered by valid time, or None if none of the new files are part of it
+    '''
+    target_keys = [f's3://{bucket}/{key}' for key in keys]
+    manifest_url = f's3://{bucket}/{generate_best_time_series_manifest_key(best_time_series_key)}'
+
+    for attempt in range(MANIFEST_WRITE_ATTEMPTS):
+        manifest, etag = read_best_time_series_manifest_version(fs_write, manifest_url)
+        create = manifest is None
+        if create:
+            print(f'No best time series manifest found at {manifest_url}, building it from the model files...')
+            model_files = fs_read.glob(f's3://{bucket}/{best_time_series_glob}')
+            count_requests()
+            model_files = ['s3://' + f for f in model_files]
+            if parse_keys is not None:
+                manifest = build_best_time_series_manifest_from_table(parse_keys(model_files))
+            else:
+                manifest = build_best_time_series_manifest(model_files, parse_datestamp_offset)
+            changed = True
+        else:
+            changed = False
+            for key, target_key in zip(keys, target_keys):
+                model_date_key, offset = parse_datestamp_offset(key)
+                previous = manifest.get(model_date_key)
+                if update_best_time_series_manifest(manifest, model_date_key, offset, target_key) and previous != [offset, target_key]:
+                    changed = True
+
+        expired = prune_best_time_series_manifest(manifest)
+        if not changed and len(expired) == 0:
+            break
+
+        print(f'Writing best time series manifest with {len(manifest)} entries to {manifest_url}')
+        try:
+            write_best_time_series_manifest(fs_write, manifest_url, manifest, etag=etag, create=create)
+            break
+        except OSError as e:
+            if not is_conditional_write_conflict(e):
+                raise
+            print(f'{manifest_url} was written by another update, retrying ({attempt + 1} of {MANIFEST_WRITE_ATTEMPTS})...')
+    else:
+        raise RuntimeError(f'Failed to update {manifest_url} after {MANIFEST_WRITE_ATTEMPTS} attempts')
+
+    model_best_files = best_time_series_manifest_files(manifest)
+    if not any(target_key in model_best_files for target_key in target_keys):
+        return None
+
+    return model_best_files
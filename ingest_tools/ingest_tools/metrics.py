@@ -0,0 +1,306 @@
+'''
+Per phase timing and metrics
+
+Kerchunking a file or updating an aggregation goes through several phases, for example sniffing the file format,
+scanning the file, translating it, serializing the references and writing them. Each key that is processed is
+recorded with the duration, bytes read, request count and output size of every phase, and handed to the configured
+metrics sink once the key is done.
+
+    with record_metrics('ingest', key):
+        with phase('translate'):
+            refs = h5chunks.translate()
+
+Outside of record_metrics, phase does nothing, so instrumented functions can be called on their own. In a lambda
+the metrics are printed as CloudWatch Embedded Metric Format lines, which CloudWatch turns into metrics from the
+function's logs without any extra API calls. Tests install an InMemoryMetricsSink to capture the numbers.
+'''
+
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, List, Optional
+
+
+EMF_NAMESPACE = 'ingest_tools'
+
+
+@dataclass
+class PhaseMetrics:
+    '''
+    The metrics of a single phase of processing a key
+
+    :param phase: The name of the phase
+    :param duration_seconds: How long the phase took
+    :param bytes_read: The number of bytes read during the phase, from the source file or from existing references
+    :param requests: The number of read, list and HEAD requests made during the phase
+    :param output_bytes: The number of bytes the phase produced, for example the size of the serialized references
+    '''
+    phase: str
+    duration_seconds: float = 0.0
+    bytes_read: int = 0
+    requests: int = 0
+    output_bytes: int = 0
+
+
+@dataclass
+class KeyMetrics:
+    '''
+    The metrics of processing a single key
+
+    :param operation: The operation the key was processed with, for example ingest or model_run_aggregation
+    :param key: The key that was processed
+    :param phases: The metrics of each phase, in the order they ran
+    :param duration_seconds: How long processing the key took
+    :param succeeded: False if processing the key raised an exception
+    '''
+    operation: str
+    key: str
+    phases: List[PhaseMetrics] = field(default_factory=list)
+    duration_seconds: float = 0.0
+    succeeded: bool = True
+
+    def phase(self, name: str) -> Optional[PhaseMetrics]:
+        '''
+        :returns: The metrics of the first phase with the given name, or None if the phase did not run
+        '''
+        return next((p for p in self.phases if p.phase == name), None)
+
+
+class MetricsSink:
+    '''
+    Receives the metrics of every processed key
+    '''
+
+    def emit(self, metrics: KeyMetrics):
+        pass
+
+
+class InMemoryMetricsSink(MetricsSink):
+    '''
+    Keeps the metrics of every processed key, for tests and local runs
+    '''
+
+    def __init__(self) -> None:
+        self.records: List[KeyMetrics] = []
+        self._lock = threading.Lock()
+
+    def emit(self, metrics: KeyMetrics):
+        with self._lock:
+            self.records.append(metrics)
+
+
+class EmbeddedMetricFormatSink(MetricsSink):
+    '''
+    Prints the metrics of every processed key as CloudWatch Embedded Metric Format lines, one per phase plus one
+    with the total duration. The operation and phase are the metric dimensions, the key is only logged.
+    '''
+
+    def __init__(self, namespace: str = EMF_NAMESPACE) -> None:
+        self.namespace = namespace
+
+    def _line(self, metrics: KeyMetrics, phase: PhaseMetrics) -> str:
+        return json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Operation', 'Phase']],
+                    'Metrics': [
+                        {'Name': 'Duration', 'Unit': 'Milliseconds'},
+                        {'Name': 'BytesRead', 'Unit': 'Bytes'},
+                        {'Name': 'Requests', 'Unit': 'Count'},
+                        {'Name': 'OutputBytes', 'Unit': 'Bytes'},
+                    ],
+                }],
+            },
+            'Operation': metrics.operation,
+            'Phase': phase.phase,
+            'Key': metrics.key,
+            'Succeeded': metrics.succeeded,
+            'Duration': phase.duration_seconds * 1000,
+            'BytesRead': phase.bytes_read,
+            'Requests': phase.requests,
+            'OutputBytes': phase.output_bytes,
+        })
+
+    def emit(self, metrics: KeyMetrics):
+        total = PhaseMetrics(
+            'total',
+            duration_seconds=metrics.duration_seconds,
+            bytes_read=sum(p.bytes_read for p in metrics.phases),
+            requests=sum(p.requests for p in metrics.phases),
+            output_bytes=sum(p.output_bytes for p in metrics.phases),
+        )
+        for phase in metrics.phases + [total]:
+            print(self._line(metrics, phase), flush=True)
+
+
+def _default_sink() -> MetricsSink:
+    if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+        return EmbeddedMetricFormatSink()
+    return MetricsSink()
+
+
+_sink: MetricsSink = _default_sink()
+
+_current_key: 'contextvars.ContextVar[Optional[KeyMetrics]]' = contextvars.ContextVar('current_key', default=None)
+_current_phase: 'contextvars.ContextVar[Optional[PhaseMetrics]]' = contextvars.ContextVar('current_phase', default=None)
+
+
+def set_metrics_sink(sink: MetricsSink) -> MetricsSink:
+    '''
+    Set the sink that receives the metrics of every processed key
+
+    :param sink: The new metrics sink
+    :returns: The previous metrics sink, so it can be restored
+    '''
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def get_metrics_sink() -> MetricsSink:
+    '''
+    :returns: The sink that receives the metrics of every processed key
+    '''
+    return _sink
+
+
+@contextmanager
+def record_metrics(operation: str, key: str) -> Iterator[KeyMetrics]:
+    '''
+    Record the metrics of processing a key, and emit them to the metrics sink once the key is done, including
+    when processing returns early or raises
+
+    :param operation: The operation the key is processed with
+    :param key: The key that is processed
+    '''
+    metrics = KeyMetrics(operation, key)
+    key_token = _current_key.set(metrics)
+    phase_token = _current_phase.set(None)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    except BaseException:
+        metrics.succeeded = False
+        raise
+    finally:
+        metrics.duration_seconds = time.perf_counter() - start
+        _current_phase.reset(phase_token)
+        _current_key.reset(key_token)
+        _sink.emit(metrics)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[PhaseMetrics]:
+    '''
+    Time a phase of processing the current key. Reads from files passed to track_reads and requests passed to
+    count_requests are counted towards the innermost running phase.
+
+    :param name: The name of the phase
+    '''
+    metrics = PhaseMetrics(name)
+    key_metrics = _current_key.get()
+    if key_metrics is not None:
+        key_metrics.phases.append(metrics)
+
+    token = _current_phase.set(metrics)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.duration_seconds = time.perf_counter() - start
+        _current_phase.reset(token)
+
+
+def count_requests(requests: int = 1, bytes_read: int = 0):
+    '''
+    Count requests made directly through a filesystem, for example reading whole reference sets, listing a prefix
+    or HEAD requests, towards the innermost running phase. Reads through files passed to track_reads are counted
+    automatically.
+
+    :param requests: The number of requests made
+    :param bytes_read: The number of bytes the requests fetched
+    '''
+    metrics = _current_phase.get()
+    if metrics is not None:
+        metrics.requests += requests
+        metrics.bytes_read += bytes_read
+
+
+async def run_in_executor(executor: Optional[Executor], func: Callable, *args, **kwargs) -> Any:
+    '''
+    Run a blocking function on an executor from a coroutine. The function runs in a copy of the coroutine's context,
+    so the phases it records and the reads it makes are counted towards the key the coroutine is processing.
+
+    :param executor: The executor, the event loop's default executor if None
+    :param func: The blocking function
+    :returns: The result of the function
+    '''
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def current_phase() -> Optional[PhaseMetrics]:
+    '''
+    :returns: The metrics of the innermost running phase, or None if no phase is running
+    '''
+    return _current_phase.get()
+
+
+@dataclass
+class ReadCounts:
+    '''
+    The reads fetched by a tracked file over its whole lifetime
+
+    :param requests: The number of read requests
+    :param bytes_read: The number of bytes fetched
+    '''
+    requests: int = 0
+    bytes_read: int = 0
+
+
+def track_reads(f):
+    '''
+    Count the requests and bytes fetched by a buffered fsspec file towards the phase running when they are made,
+    and towards the file's own totals returned by read_counts. Reads served from the file's cache are not counted.
+
+    :param f: The open file
+    :returns: The same file
+    '''
+    cache = getattr(f, 'cache', None)
+    fetcher = getattr(cache, 'fetcher', None)
+    if fetcher is None or getattr(fetcher, '_tracked', False):
+        return f
+
+    counts = ReadCounts()
+
+    def tracked_fetcher(start, end):
+        data = fetcher(start, end)
+        counts.requests += 1
+        counts.bytes_read += len(data)
+        metrics = _current_phase.get()
+        if metrics is not None:
+            metrics.requests += 1
+            metrics.bytes_read += len(data)
+        return data
+
+    tracked_fetcher._tracked = True
+    cache.fetcher = tracked_fetcher
+    # Kept on the file, closing a file drops its cache
+    f._read_counts = counts
+    return f
+
+
+def read_counts(f) -> ReadCounts:
+    '''
+    :returns: The requests and bytes fetched by a file passed to track_reads so far, zero for untracked files
+    '''
+    return getattr(f, '_read_counts', ReadCounts())
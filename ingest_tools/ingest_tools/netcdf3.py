@@ -0,0 +1,122 @@
+'''
+Kerchunking NetCDF3 files from an already open file
+
+NetCDF3ToZarr opens its own file from a url, so a file that was already opened to detect its format would be
+opened a second time, with a new connection, and its header fetched again. SharedFileNetCDF3ToZarr hands
+NetCDF3ToZarr the url together with storage options selecting SharedFileFileSystem, a filesystem serving every
+path from the open file. The header is then parsed through the open file, and the small arrays inlined are read
+through it too, so the blocks fetched while detecting the format are reused and no second connection is opened.
+'''
+
+import fsspec
+import numpy as np
+import ujson
+from fsspec.spec import AbstractBufferedFile
+from kerchunk.netCDF3 import NetCDF3ToZarr
+from kerchunk.utils import _encode_for_JSON, inline_array
+
+from .references import inline_chunk
+
+
+SHARED_FILE_PROTOCOL = 'sharedfile'
+
+
+class _SharedFile(AbstractBufferedFile):
+    '''
+    Read only view of an open file. Closing it leaves the open file, which belongs to the caller, open.
+    '''
+
+    def __init__(self, fs: 'SharedFileFileSystem', path: str, **kwargs) -> None:
+        super().__init__(fs, path, mode='rb', cache_type='none', size=fs.fp.size, **kwargs)
+
+    def _fetch_range(self, start, end):
+        # Served by the open file's own cache
+        self.fs.fp.seek(start)
+        return self.fs.fp.read(end - start)
+
+
+class SharedFileFileSystem(fsspec.AbstractFileSystem):
+    '''
+    Read only filesystem serving every path from a single open file, so a file that is opened or referenced by
+    its url is read through the open file
+    '''
+    protocol = SHARED_FILE_PROTOCOL
+    cachable = False
+
+    def __init__(self, fp, **kwargs) -> None:
+        '''
+        :param fp: The open file, a buffered fsspec file
+        '''
+        super().__init__(**kwargs)
+        self.fp = fp
+
+    def info(self, path, **kwargs):
+        return {'name': path, 'size': self.fp.size, 'type': 'file'}
+
+    def _open(self, path, mode='rb', block_size=None, autocommit=True, cache_options=None, **kwargs):
+        if mode != 'rb':
+            raise NotImplementedError(f'{SHARED_FILE_PROTOCOL} files can only be read')
+        return _SharedFile(self, path)
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        start = start or 0
+        self.fp.seek(start)
+        return self.fp.read(-1 if end is None else end - start)
+
+
+fsspec.register_implementation(SHARED_FILE_PROTOCOL, SharedFileFileSystem, clobber=True)
+
+
+class SharedFileNetCDF3ToZarr:
+    '''
+    NetCDF3ToZarr reading the header and the inlined arrays from an open file
+    '''
+
+    def __init__(self, fp, url: str, inline_threshold: int = 100, max_chunk_size: int = 0, out=None) -> None:
+        '''
+        :param fp: The open file, positioned anywhere
+        :param url: The url of the file, used in the references
+        :param inline_threshold: Byte size below which an array is inlined, 0 to disable inlining
+        :param max_chunk_size: How big a chunk can be before it is split by kerchunk, 0 to disable
+        :param out: The mapping to store the references in
+        '''
+        fp.seek(0)
+        if fp.read(3) != b'CDF':
+            raise ValueError(f'{url} is not a NetCDF3 file')
+
+        self.fs = SharedFileFileSystem(fp)
+        self.threshold = inline_threshold
+        # NetCDF3ToZarr inlines small arrays by opening the url again with its storage options, passing them on as
+        # remote options. They are inlined from the open file by translate instead.
+        self.scanner = NetCDF3ToZarr(
+            url,
+            storage_options={'protocol': SHARED_FILE_PROTOCOL, 'fp': fp},
+            inline_threshold=0,
+            max_chunk_size=max_chunk_size,
+            out=out,
+        )
+
+    def translate(self):
+        refs = self.scanner.translate()
+        if not self.threshold or not isinstance(refs, dict):
+            return refs
+
+        inlined = dict(refs['refs'])
+        names = []
+        for key, value in refs['refs'].items():
+            if not key.endswith('/.zarray'):
+                continue
+            name = key[:-len('/.zarray')]
+            zarray = ujson.loads(value)
+            if int(np.prod(zarray['shape'])) * np.dtype(zarray['dtype']).itemsize >= self.threshold:
+                continue
+            if zarray['shape'] == []:
+                # inline_array cannot read scalar variables, their single chunk is copied as it is instead
+                inline_chunk(inlined, f'{name}/0', fs=self.fs)
+            else:
+                names.append(name)
+
+        if len(names) > 0:
+            protocol = fsspec.utils.get_protocol(self.scanner.filename)
+            inlined = inline_array({'version': 1, 'refs': inlined}, threshold=0, names=names, remote_options={'fs': {protocol: self.fs}})
+        return {'version': 1, 'refs': _encode_for_JSON(dict(inlined))}
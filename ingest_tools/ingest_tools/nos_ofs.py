@@ -1,20 +1,46 @@
 import re
 import datetime
-from typing import List, Tuple
+from concurrent.futures import Executor
+from typing import List, Optional, Tuple, Union
 
-import fsspec
-import ujson
-from ingest_tools.pipeline import Pipeline
+from ingest_tools.pipeline import KerchunkResult, Pipeline
 from ingest_tools.filemetadata import FileMetadata
-from kerchunk.combine import MultiZarrToZarr
+from ingest_tools.manifest import resolve_best_time_series_files
 
-from .generic import ModelRunType, generate_kerchunked
+from .aggregation import generate_kerchunked_aggregation
+from .cadence import NOS_OFS_CADENCES, find_existing_files, model_run_member_keys
+from .filesystems import get_read_filesystem, get_write_filesystem
+from .keys import parse_nos_keys
+from .metrics import count_requests, phase, record_metrics
+from .references import ReferenceCompression, ReferenceFormat, write_references
+from .generic import ModelRunType, generate_kerchunked, generate_kerchunked_async
+
+
+# The time and vertical coordinates of the ROMS, FVCOM and SELFE models, which every client reads when opening a dataset
+NOS_INLINE_VARIABLES = [
+    'ocean_time', 's_rho', 's_w', 'Cs_r', 'Cs_w', 'hc', 'theta_s', 'theta_b', 'Tcline', 'Vtransform', 'Vstretching',
+    'time', 'Itime', 'Itime2', 'sigma',
+]
 
 
 class NOS_Pipeline(Pipeline):
 
-    def __init__(self) -> None:
-        super().__init__('.nc', ['cbofs', 'ciofs', 'creofs', 'dbofs', 'gomofs', 'leofs', 'lmhofs', 'loofs', 'lsofs', 'ngofs2', 'sfbofs', 'tbofs', 'wcofs'], 'nos')
+    def __init__(
+        self,
+        output_format: ReferenceFormat = ReferenceFormat.JSON,
+        inline_threshold: Optional[int] = None,
+        inline_variables: Optional[List[str]] = None,
+        subchunk_bytes: Optional[int] = None,
+    ) -> None:
+        super().__init__(
+            '.nc',
+            ['cbofs', 'ciofs', 'creofs', 'dbofs', 'gomofs', 'leofs', 'lmhofs', 'loofs', 'lsofs', 'ngofs2', 'sfbofs', 'tbofs', 'wcofs'],
+            'nos',
+            output_format,
+            inline_threshold,
+            NOS_INLINE_VARIABLES if inline_variables is None else inline_variables,
+            subchunk_bytes,
+        )
 
     def read_file_metadata(self, key: str) -> FileMetadata:
         # this will be specific per pipeline
@@ -37,8 +63,11 @@ class NOS_Pipeline(Pipeline):
         model_name = parts[0].split('.')[0]
         return f'{model_name}/{parts[1]}.zarr'
 
-    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str):
-        generate_kerchunked(src_bucket, src_key, dest_key, dest_bucket, dest_prefix)
+    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str) -> KerchunkResult:
+        return generate_kerchunked(src_bucket, src_key, dest_key, dest_bucket, dest_prefix, self.output_format, self.inline_threshold, self.inline_variables, self.subchunk_bytes)
+
+    async def generate_kerchunk_async(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str, executor: Optional[Executor] = None) -> KerchunkResult:
+        return await generate_kerchunked_async(src_bucket, src_key, dest_key, dest_bucket, dest_prefix, self.output_format, self.inline_threshold, self.inline_variables, self.subchunk_bytes, executor)
 
 
 def parse_nos_model_run_datestamp(key: str) -> Tuple[str, str]:
@@ -76,6 +105,22 @@ def generate_nos_model_run_glob_expression(key: str, model_date: str, model_hour
     return f'{prefix}.{run_type}{glob_expression}.{model_date}.t{model_hour}z.{postfix}', model_run_type
 
 
+def generate_nos_model_run_member_keys(key: str, model_date: str, model_hour: str) -> Optional[List[str]]:
+    '''
+    Enumerate the expected member keys of the model run that the zarr single file key belongs to, from the cadence of its model:
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr'
+    The following keys will be created: nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr ... nos/dbofs/nos.dbofs.fields.f048.20230315.t00z.nc.zarr
+    Returns None if the cadence of the model is not known
+    '''
+    model_name = key.split('/')[1]
+    cadence = NOS_OFS_CADENCES.get(model_name)
+    if cadence is None:
+        return None
+
+    model_run_glob, model_run_type = generate_nos_model_run_glob_expression(key, model_date, model_hour)
+    return model_run_member_keys(model_run_glob, cadence.offsets(model_run_type))
+
+
 def generate_nos_best_time_series_glob_expression(key: str) -> str:
     '''
     Parse the glob prefix and postfix given the zarr single file key: 
@@ -87,50 +132,93 @@ def generate_nos_best_time_series_glob_expression(key: str) -> str:
     return f'{prefix}.{glob_expression}.*.t*z.{postfix}'
 
 
-def generate_kerchunked_nos_model_run(region: str, bucket: str, key: str, concat_dims=List[str], identical_dims=List[str]):
+def generate_nos_model_run_key(key: str) -> str:
     '''
-    Generate or update the multizarr kerchunked aggregation for the model run that the specified file belongs to
+    Create the model run aggregation key for the zarr single file key:
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr'
+    The following key will be created: nos/dbofs/nos.dbofs.fields.forecast.20230315.t00z.nc.zarr'
     '''
-    try:
-        model_date, model_hour = parse_nos_model_run_datestamp(key)
-        model_run_glob, model_run_type = generate_nos_model_run_glob_expression(key, model_date, model_hour)
-    except Exception as e:
-        print(f'Failed to parse model run date and hour from key {key}: {e}. Skipping...')
-        return
-
-    # For now SSL false is solving my cert issues **shrug**
-    fs_read = fsspec.filesystem('s3', anon=True, skip_instance_cache=True)
-    fs_write = fsspec.filesystem('s3', anon=False, skip_instance_cache=True)
-
-    model_run_files = fs_read.glob(f's3://{bucket}/{model_run_glob}')
-    model_run_files = sorted(['s3://'+f for f in model_run_files])
-
-    model_run_file_count = len(model_run_files)
-    print(f'Aggregating {model_run_file_count} model files for model run {model_date} t{model_hour}z...')
-
-    mzz = MultiZarrToZarr(
-        model_run_files, 
-        remote_protocol='s3', 
-        remote_options={'anon': True},
-        concat_dims=concat_dims,
-        identical_dims=identical_dims
-    )
+    model_date, model_hour = parse_nos_model_run_datestamp(key)
+    model_run_glob, model_run_type = generate_nos_model_run_glob_expression(key, model_date, model_hour)
+    model_run_type_name = model_run_type.name.lower()
+    return model_run_glob.replace('f[0-9][0-9][0-9]', model_run_type_name).replace('n[0-9][0-9][0-9]', model_run_type_name)
 
-    d = mzz.translate()
 
-    model_run_type_name = model_run_type.name.lower()
-    outkey = model_run_glob.replace('f[0-9][0-9][0-9]', model_run_type_name).replace('n[0-9][0-9][0-9]', model_run_type_name)
+def generate_nos_best_time_series_key(best_time_series_glob: str) -> str:
+    '''
+    Create the best time series aggregation key for a given glob expression:
+        'nos/dbofs/nos.dbofs.fields.f[0-9][0-9][0-9].*.t*z.nc.zarr'
+    The following key will be created: nos/dbofs/nos.dbofs.fields.best.nc.zarr'
+    '''
+    return best_time_series_glob.replace('f[0-9][0-9][0-9]', 'best').replace('.*.t*z', '')
 
-    outurl = f's3://{bucket}/{outkey}'
 
-    print(f'Writing zarr model aggregation to {outurl}')
-    with fs_write.open(outurl, 'w') as ofile:
-        ofile.write(ujson.dumps(d))
-    
-    print(f'Successfully updated {outurl} NOS aggregation')
+def generate_kerchunked_nos_model_run(region: str, bucket: str, key: Union[str, List[str]], concat_dims=List[str], identical_dims=List[str], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
+    '''
+    Generate or update the multizarr kerchunked aggregation for the model run that the specified file belongs to.
+    A list of keys from the same model run can be given to add all of them with a single update
+    '''
+    keys = [key] if isinstance(key, str) else sorted(key)
 
+    try:
+        model_date, model_hour = parse_nos_model_run_datestamp(keys[0])
+        model_run_glob, _ = generate_nos_model_run_glob_expression(keys[0], model_date, model_hour)
+        outkey = generate_nos_model_run_key(keys[0])
+    except Exception as e:
+        print(f'Failed to parse model run date and hour from key {keys[0]}: {e}. Skipping...')
+        return
 
-def generate_kerchunked_nos_roms_model_run(region: str, bucket: str, key: str):
+    with record_metrics('model_run_aggregation', outkey):
+        fs_read = get_read_filesystem()
+        fs_write = get_write_filesystem()
+
+        outurl = f's3://{bucket}/{outkey}'
+
+        def model_run_files() -> List[str]:
+            expected_keys = generate_nos_model_run_member_keys(keys[0], model_date, model_hour)
+            if expected_keys is None or any(k not in expected_keys for k in keys):
+                # The cadence of the model is not known, or does not match the new files, so list the model run instead
+                files = fs_read.glob(f's3://{bucket}/{model_run_glob}')
+                count_requests()
+                return sorted(['s3://'+f for f in files])
+
+            expected_files = [f's3://{bucket}/{k}' for k in expected_keys]
+            files = find_existing_files(fs_read, expected_files)
+            missing = [k for k, f in zip(expected_keys, expected_files) if f not in files]
+            if len(missing) > 0:
+                missing_offsets = [re.search(r'\.([f|n]\d{3})\.\d{8}', k).group(1) for k in missing]
+                print(f'Model run {model_date} t{model_hour}z is missing {len(missing)} of {len(expected_keys)} expected files: {", ".join(missing_offsets)}')
+            return sorted(files)
+
+        print(f'Updating model run aggregation for model run {model_date} t{model_hour}z...')
+
+        # The members are resolved up front, so an aggregation that lost a member to a concurrent update is
+        # rebuilt instead of appended to
+        with phase('members'):
+            member_files = model_run_files()
+
+        d = generate_kerchunked_aggregation(
+            fs_write,
+            outurl,
+            [f's3://{bucket}/{k}' for k in keys],
+            lambda: member_files,
+            concat_dims=concat_dims,
+            identical_dims=identical_dims,
+            remote_options={'anon': True},
+            expected_length=len(member_files),
+            reference_format=output_format,
+        )
+        if d is None:
+            print(f'{outurl} is already up to date. Skipping...')
+            return
+
+        print(f'Writing zarr model aggregation to {outurl}')
+        write_references(fs_write, outurl, d, output_format, compression=compression)
+
+        print(f'Successfully updated {outurl} NOS aggregation')
+
+
+def generate_kerchunked_nos_roms_model_run(region: str, bucket: str, key: Union[str, List[str]], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the multizarr kerchunked aggregation for the model run that the specified file belongs to
     '''
@@ -158,10 +246,13 @@ def generate_kerchunked_nos_roms_model_run(region: str, bucket: str, key: str):
             'lon_psi', 
             'lon_u', 
             'lon_v'
-        ])
+        ],
+        output_format=output_format,
+        compression=compression,
+    )
 
 
-def generate_kerchunked_nos_fvcom_model_run(region: str, bucket: str, key: str):
+def generate_kerchunked_nos_fvcom_model_run(region: str, bucket: str, key: Union[str, List[str]], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the multizarr kerchunked aggregation for the model run that the specified file belongs to
     '''
@@ -170,11 +261,13 @@ def generate_kerchunked_nos_fvcom_model_run(region: str, bucket: str, key: str):
         bucket=bucket,
         key=key,
         concat_dims=['time'],
-        identical_dims=['lon', 'lat', 'lonc', 'latc', 'siglay', 'siglev', 'nele', 'node']
+        identical_dims=['lon', 'lat', 'lonc', 'latc', 'siglay', 'siglev', 'nele', 'node'],
+        output_format=output_format,
+        compression=compression,
     )
 
 
-def generate_kerchunked_nos_selfe_model_run(region: str, bucket: str, key: str):
+def generate_kerchunked_nos_selfe_model_run(region: str, bucket: str, key: Union[str, List[str]], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the multizarr kerchunked aggregation for the model run that the specified file belongs to
     '''
@@ -183,71 +276,76 @@ def generate_kerchunked_nos_selfe_model_run(region: str, bucket: str, key: str):
         bucket=bucket,
         key=key,
         concat_dims=['time'],
-        identical_dims=['lon', 'lat', 'sigma']
+        identical_dims=['lon', 'lat', 'sigma'],
+        output_format=output_format,
+        compression=compression,
     )
 
 
-def generate_kerchunked_nos_best_time_series(region: str, bucket: str, key: str, concat_dims=List[str], identical_dims=List[str]):
+def generate_kerchunked_nos_best_time_series(region: str, bucket: str, key: Union[str, List[str]], concat_dims=List[str], identical_dims=List[str], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the best time series kerchunked aggregation for the model run. If the specified file is not in the best time series, 
-    then the best time series aggregation will not be updated
+    then the best time series aggregation will not be updated. A list of keys from the same model can be given to add all of them with
+    a single update
     '''
-    print(f'Generating best time series multizarr aggregation for key: {key}')
+    keys = [key] if isinstance(key, str) else sorted(key)
+
+    print(f'Generating best time series multizarr aggregation for keys: {", ".join(keys)}')
 
     try:
-        best_time_series_glob = generate_nos_best_time_series_glob_expression(key)
+        best_time_series_glob = generate_nos_best_time_series_glob_expression(keys[0])
     except Exception as e: 
-        print(f'Failed to parse model run date and hour from key {key}: {e}. Skipping...')
-        return
-
-    fs_read = fsspec.filesystem('s3', anon=True, skip_instance_cache=True)
-    fs_write = fsspec.filesystem('s3', anon=False, skip_instance_cache=True)
-
-    model_files = fs_read.glob(f's3://{bucket}/{best_time_series_glob}')
-    model_files = sorted(['s3://'+f for f in model_files])
-
-    indexes = {}
-
-    for f in model_files:
-        model_date_key, offset = parse_nos_model_run_datestamp_offset(f)
-        if model_date_key not in indexes:
-            indexes[model_date_key] = [offset, f]
-        else: 
-            if offset < indexes[model_date_key][0]:
-                indexes[model_date_key] = [offset, f]
-
-    model_best_files = [x[1] for x in list(indexes.values())]
-    
-    target_key = f's3://{bucket}/{key}'
-    if target_key not in model_best_files:
-        print(f'{key} is not a part of the current best time series for its model. Skipping...')
+        print(f'Failed to parse model run date and hour from key {keys[0]}: {e}. Skipping...')
         return
 
-    model_run_file_count = len(model_best_files)
-    print(f'Aggregating {model_run_file_count} model files for best time series aggregation...')
-
-    # TODO: Generalize this somehow? 
-    mzz = MultiZarrToZarr(
-        model_best_files, 
-        remote_protocol='s3', 
-        remote_options={'anon': True},
-        concat_dims=concat_dims,
-        identical_dims=identical_dims
-    )
-
-    d = mzz.translate()
-
-    outkey = best_time_series_glob.replace('f[0-9][0-9][0-9]', 'best').replace('.*.t*z', '')
-    outurl = f's3://{bucket}/{outkey}'
-
-    print(f'Writing zarr best time series aggregation to {outurl}')
-    with fs_write.open(outurl, 'w') as ofile:
-        ofile.write(ujson.dumps(d))
-    
-    print(f'Successfully updated {outurl} NOS best time series aggregation')
-
-
-def generate_kerchunked_nos_roms_best_time_series(region: str, bucket: str, key: str):
+    outkey = generate_nos_best_time_series_key(best_time_series_glob)
+
+    with record_metrics('best_time_series_aggregation', outkey):
+        fs_read = get_read_filesystem()
+        fs_write = get_write_filesystem()
+
+        with phase('manifest'):
+            model_best_files = resolve_best_time_series_files(
+                fs_read,
+                fs_write,
+                bucket,
+                keys,
+                best_time_series_glob,
+                outkey,
+                parse_nos_model_run_datestamp_offset,
+                parse_nos_keys,
+            )
+        if model_best_files is None:
+            print(f'{", ".join(keys)} are not a part of the current best time series for its model. Skipping...')
+            return
+
+        outurl = f's3://{bucket}/{outkey}'
+        new_files = [f for f in (f's3://{bucket}/{k}' for k in keys) if f in model_best_files]
+
+        print(f'Updating best time series aggregation with {len(model_best_files)} model files...')
+
+        d = generate_kerchunked_aggregation(
+            fs_write,
+            outurl,
+            sorted(new_files, key=model_best_files.index),
+            lambda: model_best_files,
+            concat_dims=concat_dims,
+            identical_dims=identical_dims,
+            remote_options={'anon': True},
+            expected_length=len(model_best_files),
+            reference_format=output_format,
+        )
+        if d is None:
+            print(f'{outurl} is already up to date. Skipping...')
+            return
+
+        print(f'Writing zarr best time series aggregation to {outurl}')
+        write_references(fs_write, outurl, d, output_format, compression=compression)
+
+        print(f'Successfully updated {outurl} NOS best time series aggregation')
+
+
+def generate_kerchunked_nos_roms_best_time_series(region: str, bucket: str, key: Union[str, List[str]], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the best time series kerchunked aggregation for the model run. If the specified file is not in the best time series, 
     then the best time series aggregation will not be updated
@@ -276,11 +374,13 @@ def generate_kerchunked_nos_roms_best_time_series(region: str, bucket: str, key:
             'lon_psi', 
             'lon_u', 
             'lon_v'
-        ]
+        ],
+        output_format=output_format,
+        compression=compression,
     )
 
 
-def generate_kerchunked_nos_fvcom_best_time_series(region: str, bucket: str, key: str):
+def generate_kerchunked_nos_fvcom_best_time_series(region: str, bucket: str, key: Union[str, List[str]], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the best time series kerchunked aggregation for the model run. If the specified file is not in the best time series, 
     then the best time series aggregation will not be updated
@@ -290,11 +390,13 @@ def generate_kerchunked_nos_fvcom_best_time_series(region: str, bucket: str, key
         bucket=bucket,
         key=key,
         concat_dims=['time'],
-        identical_dims=['lon', 'lat', 'lonc', 'latc', 'siglay', 'siglev', 'nele', 'node']
+        identical_dims=['lon', 'lat', 'lonc', 'latc', 'siglay', 'siglev', 'nele', 'node'],
+        output_format=output_format,
+        compression=compression,
     )
 
 
-def generate_kerchunked_nos_selfe_best_time_series(region: str, bucket: str, key: str):
+def generate_kerchunked_nos_selfe_best_time_series(region: str, bucket: str, key: Union[str, List[str]], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the best time series kerchunked aggregation for the model run. If the specified file is not in the best time series, 
     then the best time series aggregation will not be updated
@@ -304,5 +406,7 @@ def generate_kerchunked_nos_selfe_best_time_series(region: str, bucket: str, key
         bucket=bucket,
         key=key,
         concat_dims=['time'],
-        identical_dims=['lon', 'lat', 'sigma']
+        identical_dims=['lon', 'lat', 'sigma'],
+        output_format=output_format,
+        compression=compression,
     )
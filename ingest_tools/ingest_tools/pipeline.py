@@ -1,16 +1,58 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from enum import Enum
+from importlib.metadata import entry_points
+import re
 import typing
 
 from ingest_tools.filemetadata import FileMetadata
 from .filters import key_contains
+from .metrics import record_metrics, run_in_executor
+from .references import ReferenceFormat
+
+
+PIPELINE_ENTRY_POINT_GROUP = 'ingest_tools.pipelines'
+
+
+class KerchunkResult(Enum):
+    '''
+    The outcome of kerchunking a key with a pipeline
+    '''
+    # The references were written, or were already written for the same source object
+    WRITTEN = 1
+    # The pipeline does not kerchunk the key, for example because its file format is not supported, so no
+    # references exist for it
+    SKIPPED = 2
 
 
 class Pipeline(ABC):
 
-    def __init__(self, fileformat: str, filters: typing.List[str], dest_prefix: str) -> None:
+    def __init__(
+        self,
+        fileformat: str,
+        filters: typing.List[str],
+        dest_prefix: str,
+        output_format: ReferenceFormat = ReferenceFormat.JSON,
+        inline_threshold: typing.Optional[int] = None,
+        inline_variables: typing.Optional[typing.List[str]] = None,
+        subchunk_bytes: typing.Optional[int] = None,
+    ) -> None:
+        '''
+        :param fileformat: The file postfix the pipeline accepts
+        :param filters: The pipeline accepts keys containing any of these strings
+        :param dest_prefix: The prefix the references are written under in the destination bucket
+        :param output_format: The format the references are written in
+        :param inline_threshold: Chunks smaller than this many bytes are inlined, defaults to kerchunk's default for the file format
+        :param inline_variables: Variables that are always inlined as a single chunk, regardless of their size
+        :param subchunk_bytes: Split uncompressed contiguous chunks into row blocks of at most this many bytes, not split if None
+        '''
         self.fileformat = fileformat
         self.filters = filters
         self.dest_prefix = dest_prefix
+        self.output_format = output_format
+        self.inline_threshold = inline_threshold
+        self.inline_variables = inline_variables or []
+        self.subchunk_bytes = subchunk_bytes
     
     def accepts(self, key) -> bool:
         # The pipeline must accept the fileformat input
@@ -24,12 +66,36 @@ class Pipeline(ABC):
         
         return False
     
-    def run(self, region: str, src_bucket: str, src_key: str, dest_bucket: str):
+    def run(self, region: str, src_bucket: str, src_key: str, dest_bucket: str) -> KerchunkResult:
         # TODO: More of a listener pattern might work better
         #self.filemetadata = self.read_file_metadata(src_key)
         # status.log(filemetadata)
-        output_key = self.generate_kerchunk_output_key(src_key)
-        self.generate_kerchunk(region, src_bucket, src_key, dest_bucket, output_key, self.dest_prefix)
+        with record_metrics('ingest', src_key):
+            output_key = self.generate_kerchunk_output_key(src_key)
+            return self.generate_kerchunk(region, src_bucket, src_key, dest_bucket, output_key, self.dest_prefix) or KerchunkResult.WRITTEN
+
+    async def run_async(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, executor: typing.Optional[Executor] = None) -> KerchunkResult:
+        '''
+        run for a coroutine running on fsspec's event loop, see IngestEngine
+
+        :param executor: The executor blocking work runs on, the event loop's default executor if None
+        '''
+        with record_metrics('ingest', src_key):
+            output_key = self.generate_kerchunk_output_key(src_key)
+            return await self.generate_kerchunk_async(region, src_bucket, src_key, dest_bucket, output_key, self.dest_prefix, executor) or KerchunkResult.WRITTEN
+
+    async def generate_kerchunk_async(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str, executor: typing.Optional[Executor] = None) -> typing.Optional[KerchunkResult]:
+        '''
+        generate_kerchunk for a coroutine running on fsspec's event loop. Pipelines that do not await their
+        requests run generate_kerchunk on the executor.
+        '''
+        return await run_in_executor(executor, self.generate_kerchunk, region, src_bucket, src_key, dest_bucket, dest_key, dest_prefix)
+
+    def generate_destination_key(self, key: str) -> str:
+        '''
+        The key in the destination bucket that the references of the given source key are written to
+        '''
+        return f'{self.dest_prefix}/{self.generate_kerchunk_output_key(key)}'
 
     @abstractmethod
     def read_file_metadata(self, key: str) -> FileMetadata:
@@ -40,16 +106,105 @@ class Pipeline(ABC):
         pass
 
     @abstractmethod
-    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str):
+    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str) -> typing.Optional[KerchunkResult]:
+        '''
+        Kerchunk a key, returning KerchunkResult.SKIPPED if the pipeline does not kerchunk it. None is taken as
+        KerchunkResult.WRITTEN.
+        '''
         pass
 
     
+class RoutingTable():
+    '''
+    Routing index over the filters of every pipeline, compiled once into a single regular expression
+
+    Every filter is a plain substring, so the expression looks ahead for the longest filter starting at each
+    position of the key. Any shorter filter matching at the same position is a prefix of that filter, so the
+    pipelines of a filter include the pipelines of all of its prefixes and every matching pipeline is found in
+    one scan of the key.
+    '''
+
+    def __init__(self, pipelines: typing.Dict[str, Pipeline]) -> None:
+        self.pipelines = dict(pipelines)
+
+        filter_pipelines: typing.Dict[str, typing.List[str]] = {}
+        for name, pipeline in self.pipelines.items():
+            for f in pipeline.filters:
+                names = filter_pipelines.setdefault(f, [])
+                if name not in names:
+                    names.append(name)
+
+        filters = sorted(filter_pipelines, key=len, reverse=True)
+        self.routes: typing.Dict[str, typing.FrozenSet[str]] = {
+            f: frozenset(n for prefix in filters if f.startswith(prefix) for n in filter_pipelines[prefix])
+            for f in filters
+        }
+        self.pattern = re.compile('(?=(' + '|'.join(re.escape(f) for f in filters) + '))') if filters else None
+
+    def route(self, key: str) -> typing.List[Pipeline]:
+        '''
+        Find the pipelines that accept the key
+
+        :param key: The key to route
+        :returns: The matching pipelines, in the order they were added
+        '''
+        if self.pattern is None:
+            return []
+
+        names: typing.Set[str] = set()
+        for match in self.pattern.finditer(key):
+            names.update(self.routes[match.group(1)])
+            if len(names) == len(self.pipelines):
+                break
+
+        return [p for n, p in self.pipelines.items() if n in names and key.endswith(p.fileformat)]
+
+
+def discover_pipelines() -> typing.Dict[str, Pipeline]:
+    '''
+    Discover the pipelines registered under the ingest_tools.pipelines entry point group, for example:
+
+        [project.entry-points."ingest_tools.pipelines"]
+        nos_ofs = "ingest_tools.nos_ofs:NOS_Pipeline"
+
+    When running from a source checkout without installed entry points, the built in pipelines are used
+
+    :returns: The pipelines by name
+    '''
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=PIPELINE_ENTRY_POINT_GROUP)
+    else:
+        eps = eps.get(PIPELINE_ENTRY_POINT_GROUP, [])
+
+    pipelines = {ep.name: ep.load()() for ep in sorted(eps, key=lambda ep: ep.name)}
+    if len(pipelines) == 0:
+        print(f'No pipelines registered under {PIPELINE_ENTRY_POINT_GROUP}, using the built in pipelines')
+        from .grib import HRRR_Pipeline
+        from .nos_ofs import NOS_Pipeline
+        from .rtofs import RTOFS_Pipeline
+        pipelines = {'hrrr': HRRR_Pipeline(), 'nos_ofs': NOS_Pipeline(), 'rtofs': RTOFS_Pipeline()}
+
+    return pipelines
+
+
 class PipelineContext():
 
     def __init__(self, region: str, dest_bucket: str) -> None:
         self.region = region
         self.dest_bucket = dest_bucket
         self.pipelines = {}
+        self._routing_table = None
+
+    @staticmethod
+    def from_entry_points(region: str, dest_bucket: str) -> 'PipelineContext':
+        '''
+        Create a context with every pipeline discovered through entry points
+        '''
+        context = PipelineContext(region, dest_bucket)
+        for name, pipeline in discover_pipelines().items():
+            context.add_pipeline(name, pipeline)
+        return context
 
     def get_region(self) -> str:
         return self.region
@@ -59,11 +214,13 @@ class PipelineContext():
     
     def add_pipeline(self, name: str, pipeline: Pipeline):
         self.pipelines[name] = pipeline
+        self._routing_table = None
 
     def get_matching_pipelines(self, key: str) -> typing.List[Pipeline]:
-        matching = []
-        for p in self.pipelines:        
-            pipeline = self.pipelines[p]
-            if pipeline.accepts(key):
-                matching.append(pipeline)
-        return matching
\ No newline at end of file
+        if self._routing_table is None:
+            self._routing_table = RoutingTable(self.pipelines)
+
+        matching = self._routing_table.route(key)
+        if len(matching) == 0:
+            print(f'No ingest available for key: {key}')
+        return matching
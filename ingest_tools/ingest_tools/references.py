@@ -0,0 +1,575 @@
+'''
+Reading and writing kerchunk reference sets
+
+Reference sets are written either as a single JSON object, or using kerchunk's partitioned Parquet layout:
+
+    nos.dbofs.fields.best.nc.zarr/.zmetadata
+    nos.dbofs.fields.best.nc.zarr/zeta/refs.0.parq
+    nos.dbofs.fields.best.nc.zarr/zeta/refs.1.parq
+    nos.dbofs.fields.best.nc.zarr/complete.zarr
+
+where each variable's chunk references are split into record blocks. Clients only load the metadata and the
+record blocks of the variables and chunks they actually read instead of parsing every reference up front. The
+empty complete.zarr marker is written last. Its key ends in .zarr like a JSON reference set's, so a finished parquet
+reference set triggers the same bucket notifications, which reference_set_key maps back to the reference set.
+
+JSON reference sets are written with object metadata recording a digest of the references and, for single file
+references, the ETag and size of the source object. Duplicate notifications can then be detected with a HEAD
+request, and rewriting byte identical references is skipped so no new bucket notification is sent. When byte
+identical references come from a different source object, only their object metadata is replaced.
+
+JSON reference sets are serialized and written one block of references at a time instead of as a single string,
+optionally gzip or zstd compressed with the matching Content-Encoding. Compressed reference sets keep their key and
+are detected from their leading bytes when they are read.
+'''
+
+import hashlib
+import zlib
+from concurrent.futures import Executor
+from enum import Enum
+from typing import Dict, Iterator, List, MutableMapping, Optional, Tuple
+
+import fsspec
+import numpy as np
+import ujson
+from fsspec.implementations.reference import LazyReferenceMapper
+from kerchunk.utils import consolidate, inline_array
+
+from .filesystems import call_async
+from .metrics import count_requests, phase, run_in_executor
+
+
+class ReferenceFormat(Enum):
+    JSON = 1
+    PARQUET = 2
+
+
+class ReferenceCompression(Enum):
+    NONE = 1
+    GZIP = 2
+    ZSTD = 3
+
+
+# The number of chunk references stored in each parquet record block
+PARQUET_RECORD_SIZE = 10000
+
+PARQUET_METADATA_KEY = '.zmetadata'
+
+# The marker written inside a parquet reference set once it is complete
+PARQUET_MARKER_KEY = 'complete.zarr'
+
+# S3 user metadata keys, S3 returns these lower cased
+SOURCE_ETAG_METADATA_KEY = 'source-etag'
+SOURCE_SIZE_METADATA_KEY = 'source-size'
+REFS_SHA256_METADATA_KEY = 'refs-sha256'
+REFS_COMPRESSION_METADATA_KEY = 'refs-compression'
+
+# The Content-Encoding written with compressed JSON reference sets
+CONTENT_ENCODINGS = {
+    ReferenceCompression.GZIP: 'gzip',
+    ReferenceCompression.ZSTD: 'zstd',
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# The approximate size of the serialized blocks JSON reference sets are written in
+JSON_BLOCK_SIZE = 1024 * 1024
+
+
+def read_references_metadata(fs: fsspec.AbstractFileSystem, url: str) -> Optional[Dict[str, str]]:
+    '''
+    Read the object metadata of a JSON reference set
+
+    :param fs: The filesystem to read the metadata from, filesystems without object metadata always return None
+    :param url: The url of the reference set
+    :returns: The object metadata, or None if the reference set does not exist
+    '''
+    if not hasattr(fs, 'metadata'):
+        return None
+
+    try:
+        return fs.metadata(url)
+    except FileNotFoundError:
+        return None
+
+
+async def read_references_metadata_async(fs: fsspec.AbstractFileSystem, url: str, executor: Optional[Executor] = None) -> Optional[Dict[str, str]]:
+    '''
+    read_references_metadata for a coroutine running on fsspec's event loop
+
+    :param executor: The executor the metadata of filesystems without async support is read on
+    '''
+    if not hasattr(fs, 'metadata'):
+        return None
+
+    try:
+        return await call_async(fs, 'metadata', url, executor=executor)
+    except FileNotFoundError:
+        return None
+
+
+def source_metadata(etag: str, size: int) -> Dict[str, str]:
+    '''
+    Create the object metadata identifying the source object of a reference set
+
+    :param etag: The ETag of the source object
+    :param size: The size of the source object in bytes
+    :returns: The object metadata
+    '''
+    return {SOURCE_ETAG_METADATA_KEY: etag.strip('"'), SOURCE_SIZE_METADATA_KEY: str(size)}
+
+
+def is_same_source(metadata: Optional[Dict[str, str]], etag: str, size: int) -> bool:
+    '''
+    Check whether a reference set was generated from a source object with the given ETag and size
+
+    :param metadata: The object metadata of the reference set
+    :param etag: The ETag of the source object
+    :param size: The size of the source object in bytes
+    :returns: True if the reference set was generated from the same source object
+    '''
+    if metadata is None:
+        return False
+
+    expected = source_metadata(etag, size)
+    return all(metadata.get(k) == v for k, v in expected.items())
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError('zstd compressed references require the zstandard package') from e
+    return zstandard
+
+
+def decode_references(data: bytes) -> dict:
+    '''
+    Parse a JSON reference set, decompressing it first if it is gzip or zstd compressed
+
+    :param data: The raw bytes of the reference set
+    :returns: The reference set
+    '''
+    if data[:2] == GZIP_MAGIC:
+        data = zlib.decompress(data, wbits=zlib.MAX_WBITS | 16)
+    elif data[:4] == ZSTD_MAGIC:
+        data = _zstandard().ZstdDecompressor().decompressobj().decompress(data)
+    return ujson.loads(data)
+
+
+def iter_json_references(refs: MutableMapping, block_size: int = JSON_BLOCK_SIZE) -> Iterator[bytes]:
+    '''
+    Serialize a reference set as JSON in blocks of roughly block_size bytes, so the whole serialized reference
+    set never has to be held in memory. The concatenated blocks are identical to ujson.dumps(refs).
+
+    :param refs: The reference set
+    :param block_size: The approximate size of each block
+    :returns: The serialized blocks
+    '''
+    def fragments(mapping: MutableMapping) -> Iterator[bytes]:
+        yield b'{'
+        for i, (k, v) in enumerate(mapping.items()):
+            if i > 0:
+                yield b','
+            yield ujson.dumps(k).encode() + b':'
+            if k == 'refs' and isinstance(v, dict):
+                yield from fragments(v)
+            else:
+                yield ujson.dumps(v).encode()
+        yield b'}'
+
+    block, size = [], 0
+    for fragment in fragments(refs):
+        block.append(fragment)
+        size += len(fragment)
+        if size >= block_size:
+            yield b''.join(block)
+            block, size = [], 0
+    if len(block) > 0:
+        yield b''.join(block)
+
+
+def _compressor(compression: ReferenceCompression):
+    if compression == ReferenceCompression.GZIP:
+        return zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    elif compression == ReferenceCompression.ZSTD:
+        return _zstandard().ZstdCompressor().compressobj()
+    return None
+
+
+def inline_whole_variables(refs: MutableMapping, names: List[str], remote_options: dict) -> MutableMapping:
+    '''
+    Inline whole variables into a reference set as a single chunk each, regardless of their size, so clients
+    read them without any requests to the referenced files. Variables that are not in the reference set are
+    ignored, and lazy parquet reference sets are returned as they are.
+
+    :param refs: The reference set
+    :param names: The names of the variables to inline
+    :param remote_options: Options for reading the referenced chunks
+    :returns: The reference set with the variables inlined
+    '''
+    if isinstance(refs, LazyReferenceMapper):
+        return refs
+
+    present = [name for name in names if f'{name}/.zarray' in refs.get('refs', refs)]
+    if len(present) == 0:
+        return refs
+
+    # inline_array modifies the references it is given, which may be shared with a cached template
+    inlined = dict(refs.get('refs', refs))
+
+    # inline_array cannot read scalar variables, their single chunk is copied as it is instead
+    scalars = [name for name in present if ujson.loads(inlined[f'{name}/.zarray'])['shape'] == []]
+    for name in scalars:
+        inline_chunk(inlined, f'{name}/0', remote_options=remote_options)
+
+    arrays = [name for name in present if name not in scalars]
+    if len(arrays) > 0:
+        inlined = inline_array({'version': 1, 'refs': inlined}, threshold=0, names=arrays, remote_options={'remote_protocol': 's3', 'remote_options': remote_options})
+    return consolidate(inlined)
+
+
+def inline_chunk(refs: Dict, key: str, fs: Optional[fsspec.AbstractFileSystem] = None, remote_options: Optional[dict] = None):
+    '''
+    Replace the reference of a single chunk with its bytes, in place. The bytes are stored as they are in the
+    referenced file, still encoded with the variable's compressor and filters. Chunks that are already inlined are
+    left as they are.
+
+    :param refs: The references, without the version wrapper
+    :param key: The key of the chunk, for example hc/0
+    :param fs: The filesystem to read the chunk with, created from the protocol of the referenced url if None
+    :param remote_options: Options for creating the filesystem to read the chunk with
+    '''
+    ref = refs.get(key)
+    if not isinstance(ref, list):
+        return
+
+    url = ref[0]
+    fs = fs or fsspec.filesystem(fsspec.utils.get_protocol(url), **(remote_options or {}))
+    if len(ref) == 1:
+        refs[key] = fs.cat_file(url)
+    else:
+        refs[key] = fs.cat_file(url, start=ref[1], end=ref[1] + ref[2])
+
+
+def _row_block_rows(extent: int, row_bytes: int, target_bytes: int) -> int:
+    # The largest divisor of the extent whose row block fits in the target size, so every block is a whole chunk
+    rows = max(1, min(extent, target_bytes // max(row_bytes, 1)))
+    while extent % rows != 0:
+        rows -= 1
+    return rows
+
+
+def subchunk_references(refs: MutableMapping, target_bytes: int) -> MutableMapping:
+    '''
+    Split the uncompressed chunks of contiguous variables into row blocks of at most target_bytes, so reading a
+    spatial subset only fetches the byte ranges of the rows it needs instead of the whole field. Each chunk is
+    split along its first axis longer than one, into blocks of whole rows whose count divides the axis length.
+    Only variables without a compressor or filters whose chunks span the whole variable from that axis on are
+    split, which covers NetCDF3 variables and contiguous HDF5 datasets. Inlined chunks are left as they are,
+    and lazy parquet reference sets are returned as they are.
+
+        'zeta/0.0.0': ['s3://bucket/key.nc', 1000, 800]
+    with target_bytes 400 and a (1, 10, 20) float32 chunk becomes:
+        'zeta/0.0.0': ['s3://bucket/key.nc', 1000, 400], 'zeta/0.1.0': ['s3://bucket/key.nc', 1400, 400]
+
+    :param refs: The reference set
+    :param target_bytes: The maximum size of a row block in bytes
+    :returns: The reference set with the chunks split
+    '''
+    if isinstance(refs, LazyReferenceMapper):
+        return refs
+
+    store = refs.get('refs', refs)
+    out = dict(store)
+    for meta_key in store:
+        if not meta_key.endswith('/.zarray'):
+            continue
+
+        meta = ujson.loads(store[meta_key])
+        shape, chunks = meta['shape'], meta['chunks']
+        if meta.get('compressor') is not None or meta.get('filters') or meta.get('order', 'C') != 'C':
+            continue
+        try:
+            itemsize = np.dtype(meta['dtype']).itemsize
+        except TypeError:
+            continue
+
+        axis = next((i for i, c in enumerate(chunks) if c > 1), None)
+        if axis is None or list(chunks[axis:]) != list(shape[axis:]):
+            continue
+
+        row_bytes = int(np.prod(chunks[axis + 1:], dtype=np.int64)) * itemsize
+        chunk_bytes = chunks[axis] * row_bytes
+        if chunk_bytes <= target_bytes:
+            continue
+
+        rows = _row_block_rows(chunks[axis], row_bytes, target_bytes)
+        blocks = chunks[axis] // rows
+        if blocks == 1:
+            continue
+
+        variable = meta_key[:-len('/.zarray')]
+        separator = meta.get('dimension_separator') or '.'
+        prefix = f'{variable}/'
+        chunk_keys = [k for k in store if k.startswith(prefix) and '/' not in k[len(prefix):] and not k[len(prefix):].startswith('.z')]
+        if any(not isinstance(store[k], list) or len(store[k]) != 3 or store[k][2] != chunk_bytes for k in chunk_keys):
+            # Inlined or whole file chunks, or chunks that do not hold every element, are not split
+            continue
+
+        for k in chunk_keys:
+            url, offset, _ = out.pop(k)
+            index = k[len(prefix):].split(separator)
+            for block in range(blocks):
+                index[axis] = str(block)
+                out[prefix + separator.join(index)] = [url, offset + block * rows * row_bytes, rows * row_bytes]
+
+        meta['chunks'] = chunks[:axis] + [rows] + chunks[axis + 1:]
+        out[meta_key] = ujson.dumps(meta)
+
+    if 'refs' in refs:
+        return {**refs, 'refs': out}
+    return out
+
+
+def reference_set_key(key: str) -> str:
+    '''
+    The key of the reference set an object belongs to, given the key of a JSON reference set or of the marker of a
+    parquet reference set:
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr/complete.zarr'
+    belongs to nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr
+
+    :param key: The key of the object
+    :returns: The key of the reference set
+    '''
+    suffix = f'/{PARQUET_MARKER_KEY}'
+    return key[:-len(suffix)] if key.endswith(suffix) else key
+
+
+def _parquet_root(fs: fsspec.AbstractFileSystem, url: str) -> str:
+    # LazyReferenceMapper writes the record blocks with pandas from the root alone, without the protocol they would
+    # be written to the local filesystem
+    return fs.unstrip_protocol(url)
+
+
+def read_references(fs: fsspec.AbstractFileSystem, url: str, reference_format: Optional[ReferenceFormat] = None) -> Optional[MutableMapping]:
+    '''
+    Read a kerchunk reference set from the given url
+
+    Compressed JSON reference sets are decompressed transparently. Parquet reference sets are opened lazily, so only the metadata is read until references are accessed.
+    Changes made to a lazy reference set are written back to the parquet store when it is flushed.
+
+    :param fs: The filesystem to read the references from
+    :param url: The url of the reference set
+    :param reference_format: The format of the reference set, if None both formats are tried
+    :returns: The reference set, or None if it does not exist
+    '''
+    if reference_format != ReferenceFormat.PARQUET:
+        try:
+            with fs.open(url, 'rb') as f:
+                data = f.read()
+            count_requests(bytes_read=len(data))
+            return decode_references(data)
+        except (FileNotFoundError, IsADirectoryError):
+            count_requests()
+            if reference_format == ReferenceFormat.JSON:
+                return None
+
+    count_requests()
+    if not fs.exists(f'{url}/{PARQUET_METADATA_KEY}'):
+        return None
+
+    # Only the metadata is read up front, the record blocks are read when the references are accessed
+    count_requests()
+    return LazyReferenceMapper(_parquet_root(fs, url), fs=fs)
+
+
+def read_many_references(fs: fsspec.AbstractFileSystem, urls: List[str]) -> List[MutableMapping]:
+    '''
+    Read several kerchunk reference sets, fetching JSON reference sets concurrently
+
+    :param fs: The filesystem to read the references from
+    :param urls: The urls of the reference sets
+    :returns: The reference sets, in the given order
+    :raises FileNotFoundError: If any of the reference sets does not exist
+    '''
+    try:
+        data = fs.cat(urls, on_error='raise')
+        count_requests(len(urls), sum(len(d) for d in data.values()))
+        return [decode_references(data[fs._strip_protocol(url)]) for url in urls]
+    except (FileNotFoundError, IsADirectoryError, ValueError):
+        # Parquet reference sets are directories, read them one at a time
+        refs = [read_references(fs, url) for url in urls]
+        missing = [url for url, r in zip(urls, refs) if r is None]
+        if len(missing) > 0:
+            raise FileNotFoundError(', '.join(missing))
+        return refs
+
+
+def _replace_metadata(fs: fsspec.AbstractFileSystem, url: str, metadata: Dict[str, str], content_encoding: Optional[str]):
+    options = {} if content_encoding is None else {'ContentEncoding': content_encoding}
+    if hasattr(fs, 'call_s3'):
+        # Copying the object onto itself is the only way to change the metadata of an S3 object without rewriting it
+        bucket, key, _ = fs.split_path(url)
+        fs.call_s3(
+            'copy_object',
+            Bucket=bucket,
+            Key=key,
+            CopySource={'Bucket': bucket, 'Key': key},
+            Metadata=metadata,
+            MetadataDirective='REPLACE',
+            **options,
+        )
+        fs.invalidate_cache(url)
+        return
+
+    data = fs.cat_file(url)
+    with fs.open(url, 'wb', Metadata=metadata, **options) as f:
+        f.write(data)
+
+
+def write_references(
+    fs: fsspec.AbstractFileSystem,
+    url: str,
+    refs: MutableMapping,
+    reference_format: ReferenceFormat = ReferenceFormat.JSON,
+    metadata: Optional[Dict[str, str]] = None,
+    compression: ReferenceCompression = ReferenceCompression.NONE,
+) -> bool:
+    '''
+    Write a kerchunk reference set to the given url, replacing any existing reference set.
+
+    JSON reference sets are streamed to the filesystem one block at a time, and are not rewritten when the existing
+    reference set is byte identical and written with the same compression. If only its source metadata differs, the
+    metadata is replaced in place, with a CopyObject on S3.
+
+    :param fs: The filesystem to write the references to
+    :param url: The url of the reference set
+    :param refs: The reference set to write
+    :param reference_format: The format to write the reference set in
+    :param metadata: Object metadata to write with a JSON reference set, or with the marker of a parquet reference set
+    :param compression: The compression of a JSON reference set, written as its Content-Encoding
+    :returns: True if the reference set was written, False if it was unchanged
+    '''
+    if isinstance(refs, LazyReferenceMapper):
+        # Lazy reference sets are amended in place and are written back when flushed
+        with phase('write'):
+            refs.flush()
+        return True
+
+    if reference_format == ReferenceFormat.PARQUET:
+        with phase('write'):
+            refs = refs.get('refs', refs)
+            # create removes the previous store, so a store rebuilt with fewer variables or record blocks keeps none
+            # of the old ones. Passed by keyword, fsspec releases before 2023.12 take the record size first.
+            out = LazyReferenceMapper.create(root=_parquet_root(fs, url), fs=fs, record_size=PARQUET_RECORD_SIZE)
+            for k in sorted(refs):
+                out[k] = refs[k]
+            out.flush()
+            fs.pipe(f'{url}/{PARQUET_MARKER_KEY}', b'', Metadata=metadata or {})
+        return True
+
+    # The digest is needed up front for the object metadata, so the references are serialized twice
+    # rather than kept in memory
+    with phase('serialize') as metrics:
+        sha256 = hashlib.sha256()
+        for block in iter_json_references(refs):
+            sha256.update(block)
+            metrics.output_bytes += len(block)
+        digest = sha256.hexdigest()
+
+    object_metadata, options = _json_object_metadata(digest, metadata, compression)
+    with phase('write') as metrics:
+        if _skip_unchanged(fs, url, read_references_metadata(fs, url), object_metadata, options):
+            return False
+
+        compressor = _compressor(compression)
+        with fs.open(url, 'wb', Metadata=object_metadata, **options) as f:
+            for block in iter_json_references(refs):
+                if compressor is not None:
+                    block = compressor.compress(block)
+                f.write(block)
+                metrics.output_bytes += len(block)
+            if compressor is not None:
+                block = compressor.flush()
+                f.write(block)
+                metrics.output_bytes += len(block)
+    return True
+
+
+async def write_references_async(
+    fs: fsspec.AbstractFileSystem,
+    url: str,
+    refs: MutableMapping,
+    reference_format: ReferenceFormat = ReferenceFormat.JSON,
+    metadata: Optional[Dict[str, str]] = None,
+    compression: ReferenceCompression = ReferenceCompression.NONE,
+    executor: Optional[Executor] = None,
+) -> bool:
+    '''
+    write_references for a coroutine running on fsspec's event loop. A JSON reference set is serialized on the
+    executor and written with a single awaited request, a parquet reference set is written on the executor.
+
+    :param executor: The executor the references are serialized on, the event loop's default executor if None
+    :returns: True if the reference set was written, False if it was unchanged
+    '''
+    if isinstance(refs, LazyReferenceMapper) or reference_format == ReferenceFormat.PARQUET:
+        return await run_in_executor(executor, write_references, fs, url, refs, reference_format, metadata, compression)
+
+    with phase('serialize') as metrics:
+        data, size, digest = await run_in_executor(executor, _serialize_json_references, refs, compression)
+        metrics.output_bytes += size
+
+    object_metadata, options = _json_object_metadata(digest, metadata, compression)
+    with phase('write') as metrics:
+        existing = await read_references_metadata_async(fs, url, executor)
+        if await run_in_executor(executor, _skip_unchanged, fs, url, existing, object_metadata, options):
+            return False
+
+        await call_async(fs, 'pipe_file', url, data, executor=executor, Metadata=object_metadata, **options)
+        metrics.output_bytes += len(data)
+    return True
+
+
+def _serialize_json_references(refs: MutableMapping, compression: ReferenceCompression) -> Tuple[bytes, int, str]:
+    # Returns the compressed references, their uncompressed size and the digest of the uncompressed references
+    sha256 = hashlib.sha256()
+    compressor = _compressor(compression)
+    blocks = []
+    size = 0
+    for block in iter_json_references(refs):
+        sha256.update(block)
+        size += len(block)
+        blocks.append(block if compressor is None else compressor.compress(block))
+    if compressor is not None:
+        blocks.append(compressor.flush())
+    return b''.join(blocks), size, sha256.hexdigest()
+
+
+def _json_object_metadata(digest: str, metadata: Optional[Dict[str, str]], compression: ReferenceCompression) -> Tuple[Dict[str, str], Dict[str, str]]:
+    # Returns the object metadata of a JSON reference set and the options it is written with
+    object_metadata = {**(metadata or {}), REFS_SHA256_METADATA_KEY: digest}
+    options = {}
+    if compression != ReferenceCompression.NONE:
+        object_metadata[REFS_COMPRESSION_METADATA_KEY] = compression.name.lower()
+        options['ContentEncoding'] = CONTENT_ENCODINGS[compression]
+    return object_metadata, options
+
+
+def _skip_unchanged(fs: fsspec.AbstractFileSystem, url: str, existing: Optional[Dict[str, str]], object_metadata: Dict[str, str], options: Dict[str, str]) -> bool:
+    if (
+        existing is None
+        or existing.get(REFS_SHA256_METADATA_KEY) != object_metadata[REFS_SHA256_METADATA_KEY]
+        or existing.get(REFS_COMPRESSION_METADATA_KEY) != object_metadata.get(REFS_COMPRESSION_METADATA_KEY)
+    ):
+        return False
+
+    if any(existing.get(k) != v for k, v in object_metadata.items()):
+        # The same references generated from a different source object, for example one that was uploaded
+        # again, would otherwise keep the stale source ETag and size and never be detected as duplicates
+        print(f'References at {url} are unchanged, refreshing their metadata')
+        _replace_metadata(fs, url, object_metadata, options.get('ContentEncoding'))
+    else:
+        print(f'References at {url} are unchanged, skipping write')
+    return True
@@ -1,20 +1,42 @@
 import re
 import datetime
-from typing import Tuple
+from concurrent.futures import Executor
+from typing import List, Optional, Tuple, Union
 
-import fsspec
-import ujson
 from ingest_tools.filemetadata import FileMetadata
-from ingest_tools.pipeline import Pipeline
-from kerchunk.combine import MultiZarrToZarr
+from ingest_tools.manifest import resolve_best_time_series_files
+from ingest_tools.pipeline import KerchunkResult, Pipeline
 
-from .generic import generate_kerchunked
+from .aggregation import generate_kerchunked_aggregation
+from .filesystems import get_read_filesystem, get_write_filesystem
+from .keys import parse_rtofs_keys
+from .metrics import phase, record_metrics
+from .references import ReferenceCompression, ReferenceFormat, write_references
+from .generic import generate_kerchunked, generate_kerchunked_async
+
+
+# The time coordinates of RTOFS, which every client reads when opening a dataset
+RTOFS_INLINE_VARIABLES = ['MT', 'Date']
 
 
 class RTOFS_Pipeline(Pipeline):
     
-    def __init__(self) -> None:
-        super().__init__('.nc', ['rtofs'], 'rtofs')
+    def __init__(
+        self,
+        output_format: ReferenceFormat = ReferenceFormat.JSON,
+        inline_threshold: Optional[int] = None,
+        inline_variables: Optional[List[str]] = None,
+        subchunk_bytes: Optional[int] = None,
+    ) -> None:
+        super().__init__(
+            '.nc',
+            ['rtofs'],
+            'rtofs',
+            output_format,
+            inline_threshold,
+            RTOFS_INLINE_VARIABLES if inline_variables is None else inline_variables,
+            subchunk_bytes,
+        )
 
     def read_file_metadata(self, key: str) -> FileMetadata:
         '''
@@ -36,8 +58,11 @@ class RTOFS_Pipeline(Pipeline):
         filename = components[-1]
         return f'{model_date}.{filename}.zarr'
 
-    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str):
-        generate_kerchunked(src_bucket, src_key, dest_key, dest_bucket, dest_prefix)
+    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str) -> KerchunkResult:
+        return generate_kerchunked(src_bucket, src_key, dest_key, dest_bucket, dest_prefix, self.output_format, self.inline_threshold, self.inline_variables, self.subchunk_bytes)
+
+    async def generate_kerchunk_async(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str, executor: Optional[Executor] = None) -> KerchunkResult:
+        return await generate_kerchunked_async(src_bucket, src_key, dest_key, dest_bucket, dest_prefix, self.output_format, self.inline_threshold, self.inline_variables, self.subchunk_bytes, executor)
 
 
 def generate_rtofs_best_time_series_glob_expression(key: str) -> str:
@@ -71,62 +96,65 @@ def generate_rtofs_best_timeseries_key(best_timeseries_glob: str) -> str:
     return best_timeseries_glob.replace('.*', '').replace('_f*', '').replace('.nc.zarr', '.best.nc.zarr')
 
 
-def generate_kerchunked_rtofs_best_time_series(region: str, bucket: str, key: str):
+def generate_kerchunked_rtofs_best_time_series(region: str, bucket: str, key: Union[str, List[str]], output_format: ReferenceFormat = ReferenceFormat.JSON, compression: ReferenceCompression = ReferenceCompression.NONE):
     '''
     Generate or update the best time series kerchunked aggregation for the model. If the specified file is not in the best time series, 
-    then the best time series aggregation will not be updated
+    then the best time series aggregation will not be updated. A list of keys from the same model can be given to add all of them with
+    a single update
     '''
-    print(f'Generating best time series multizarr aggregation for key: {key}')
+    keys = [key] if isinstance(key, str) else sorted(key)
+
+    print(f'Generating best time series multizarr aggregation for keys: {", ".join(keys)}')
 
     try:
-        best_time_series_glob = generate_rtofs_best_time_series_glob_expression(key)
+        best_time_series_glob = generate_rtofs_best_time_series_glob_expression(keys[0])
     except Exception as e: 
-        print(f'Failed to parse model run date and hour from key {key}: {e}. Skipping...')
+        print(f'Failed to parse model run date and hour from key {keys[0]}: {e}. Skipping...')
         return
     
-    # For now SSL false is solving my cert issues **shrug**
-    fs_read = fsspec.filesystem('s3', anon=True, skip_instance_cache=True, use_ssl=False)
-    fs_write = fsspec.filesystem('s3', anon=False, skip_instance_cache=True, use_ssl=False)
-
-    model_files = fs_read.glob(f's3://{bucket}/{best_time_series_glob}')
-    model_files = sorted(['s3://'+f for f in model_files])
-
-    indexes = {}
-
-    for f in model_files:
-        model_date_key, offset = parse_rtofs_model_run_datestamp_offset(f)
-        if model_date_key not in indexes:
-            indexes[model_date_key] = [offset, f]
-        else: 
-            if offset < indexes[model_date_key][0]:
-                indexes[model_date_key] = [offset, f]
-
-    model_best_files = [x[1] for x in list(indexes.values())]
-    
-    target_key = f's3://{bucket}/{key}'
-    if target_key not in model_best_files:
-        print(f'{key} is not a part of the current best time series for its model. Skipping...')
-        return
-
-    model_run_file_count = len(model_best_files)
-    print(f'Aggregating {model_run_file_count} model files for best time series aggregation...')
-
-    # TODO: Generalize this somehow? 
-    mzz = MultiZarrToZarr(
-        model_best_files, 
-        remote_protocol='s3', 
-        remote_options={'anon': True, 'use_ssl': False},
-        concat_dims=['MT'],
-        identical_dims=['Y', 'X', 'Latitude', 'Longitude']
-    )
-
-    d = mzz.translate()
-
     outkey = generate_rtofs_best_timeseries_key(best_time_series_glob)
-    outurl = f's3://{bucket}/{outkey}'
 
-    print(f'Writing zarr best time series aggregation to {outurl}')
-    with fs_write.open(outurl, 'w') as ofile:
-        ofile.write(ujson.dumps(d))
-    
-    print(f'Successfully updated {outurl} RTOFS best time series aggregation')
\ No newline at end of file
+    with record_metrics('best_time_series_aggregation', outkey):
+        # For now SSL false is solving my cert issues **shrug**
+        fs_read = get_read_filesystem(use_ssl=False)
+        fs_write = get_write_filesystem(use_ssl=False)
+
+        with phase('manifest'):
+            model_best_files = resolve_best_time_series_files(
+                fs_read,
+                fs_write,
+                bucket,
+                keys,
+                best_time_series_glob,
+                outkey,
+                parse_rtofs_model_run_datestamp_offset,
+                parse_rtofs_keys,
+            )
+        if model_best_files is None:
+            print(f'{", ".join(keys)} are not a part of the current best time series for its model. Skipping...')
+            return
+
+        outurl = f's3://{bucket}/{outkey}'
+        new_files = [f for f in (f's3://{bucket}/{k}' for k in keys) if f in model_best_files]
+
+        print(f'Updating best time series aggregation with {len(model_best_files)} model files...')
+
+        d = generate_kerchunked_aggregation(
+            fs_write,
+            outurl,
+            sorted(new_files, key=model_best_files.index),
+            lambda: model_best_files,
+            concat_dims=['MT'],
+            identical_dims=['Y', 'X', 'Latitude', 'Longitude'],
+            remote_options={'anon': True, 'use_ssl': False},
+            expected_length=len(model_best_files),
+            reference_format=output_format,
+        )
+        if d is None:
+            print(f'{outurl} is already up to date. Skipping...')
+            return
+
+        print(f'Writing zarr best time series aggregation to {outurl}')
+        write_references(fs_write, outurl, d, output_format, compression=compression)
+
+        print(f'Successfully updated {outurl} RTOFS best time series aggregation')
\ No newline at end of file
@@ -0,0 +1,239 @@
+'''
+Event coalescing aggregation scheduler
+
+Every kerchunked file written to the ingest bucket sends its own notification, and every notification updates the
+model run and best time series aggregations the file belongs to. A forecast cycle writes dozens of files of the same
+model run within minutes, so most of those updates are redundant. The scheduler groups pending notifications by the
+key of the aggregation they update and runs one update per aggregation with all of the new files once no new files
+have arrived for that aggregation for the debounce window.
+'''
+
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .aws import parse_s3_sqs_payload
+from .references import reference_set_key
+
+
+# The default number of record groups processed concurrently from a single SQS batch
+SQS_BATCH_MAX_WORKERS = 4
+
+
+@dataclass(frozen=True)
+class AggregationTarget:
+    '''
+    An aggregation that a new file is added to
+
+    :param key: The key of the aggregation, for example the model run or best time series key
+    :param aggregate: Function adding a list of new files to the aggregation, called with (region, bucket, keys)
+    '''
+    key: str
+    aggregate: Callable[[str, str, List[str]], None]
+
+
+@dataclass
+class PendingAggregation:
+    target: AggregationTarget
+    region: str
+    bucket: str
+    keys: List[str] = field(default_factory=list)
+    message_ids: List[str] = field(default_factory=list)
+    last_event_time: float = 0.0
+
+
+class InMemoryQueue:
+    '''
+    In memory stand in for an SQS queue, for running the scheduler locally and in tests. Received messages are in
+    flight until they are deleted, or released to be received again.
+    '''
+
+    def __init__(self) -> None:
+        self.messages: 'OrderedDict[str, str]' = OrderedDict()
+        self.in_flight: Dict[str, str] = {}
+        self._next_id = 0
+
+    def send(self, body: str) -> str:
+        self._next_id += 1
+        message_id = str(self._next_id)
+        self.messages[message_id] = body
+        return message_id
+
+    def receive(self, max_messages: int = 10) -> List[dict]:
+        records = []
+        while self.messages and len(records) < max_messages:
+            message_id, body = self.messages.popitem(last=False)
+            self.in_flight[message_id] = body
+            records.append({'messageId': message_id, 'body': body})
+        return records
+
+    def delete(self, message_ids: List[str]):
+        for message_id in message_ids:
+            self.in_flight.pop(message_id, None)
+
+    def release(self, message_ids: List[str]):
+        for message_id in message_ids:
+            body = self.in_flight.pop(message_id, None)
+            if body is not None:
+                self.messages[message_id] = body
+
+    def __len__(self) -> int:
+        return len(self.messages) + len(self.in_flight)
+
+
+class AggregationScheduler:
+    '''
+    Coalesces new file notifications by the aggregations they update
+    '''
+
+    def __init__(
+        self,
+        resolve_targets: Callable[[str], List[AggregationTarget]],
+        debounce_seconds: float = 0,
+        max_workers: int = SQS_BATCH_MAX_WORKERS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        '''
+        :param resolve_targets: Function returning the aggregations a new file key is added to
+        :param debounce_seconds: How long an aggregation waits for more new files after its latest new file
+        :param max_workers: The maximum number of aggregations updated concurrently
+        :param clock: Function returning the current time in seconds
+        '''
+        self.resolve_targets = resolve_targets
+        self.debounce_seconds = debounce_seconds
+        self.max_workers = max_workers
+        self.clock = clock
+
+        self.pending: 'OrderedDict[str, PendingAggregation]' = OrderedDict()
+        self._outstanding: Dict[str, Set[str]] = {}
+        self._failed: Set[str] = set()
+        self._finished: List[str] = []
+
+    def add(self, records: List[dict]):
+        '''
+        Add SQS records with new file notifications to the pending aggregations
+
+        :param records: The SQS records
+        '''
+        now = self.clock()
+        for record in records:
+            message_id = record['messageId']
+            try:
+                region, bucket, key = parse_s3_sqs_payload(record['body'])
+            except Exception as e:
+                print(f'Failed to parse SQS message {message_id}: {e}')
+                self._failed.add(message_id)
+                self._finished.append(message_id)
+                continue
+
+            # Parquet reference sets send their notification from the marker written inside them
+            self.add_key(message_id, region, bucket, reference_set_key(key), now)
+
+    def add_key(self, message_id: str, region: str, bucket: str, key: str, now: Optional[float] = None):
+        '''
+        Add a single new file to the pending aggregations
+
+        :param message_id: The id reported back once the file's aggregations have run
+        :param region: The region of the bucket
+        :param bucket: The bucket the new file is in
+        :param key: The key of the new file
+        :param now: The time the file arrived, defaults to the current time
+        '''
+        now = self.clock() if now is None else now
+        targets = self.resolve_targets(key)
+        if len(targets) == 0:
+            print(f'No aggregation available for key: {key}')
+            self._finished.append(message_id)
+            return
+
+        self._outstanding[message_id] = {t.key for t in targets}
+        for target in targets:
+            pending = self.pending.get(target.key)
+            if pending is None:
+                pending = PendingAggregation(target, region, bucket)
+                self.pending[target.key] = pending
+            if key not in pending.keys:
+                pending.keys.append(key)
+            pending.message_ids.append(message_id)
+            pending.last_event_time = now
+
+    def due(self) -> List[PendingAggregation]:
+        '''
+        :returns: The pending aggregations that have not received a new file for the debounce window
+        '''
+        now = self.clock()
+        return [p for p in self.pending.values() if now - p.last_event_time >= self.debounce_seconds]
+
+    def run_due(self, force: bool = False) -> Tuple[List[str], List[str]]:
+        '''
+        Update every due aggregation once with all of its new files
+
+        :param force: Update every pending aggregation, regardless of the debounce window
+        :returns: The message ids whose aggregations all succeeded, and the message ids with a failed aggregation
+        '''
+        due = list(self.pending.values()) if force else self.due()
+        for pending in due:
+            del self.pending[pending.target.key]
+
+        def run(pending: PendingAggregation) -> bool:
+            print(f'Updating aggregation {pending.target.key} with {len(pending.keys)} new files')
+            try:
+                pending.target.aggregate(pending.region, pending.bucket, pending.keys)
+                return True
+            except Exception as e:
+                print(f'Failed to update aggregation {pending.target.key}: {e}')
+                traceback.print_exc()
+                return False
+
+        if len(due) > 0:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(due))) as executor:
+                results = list(executor.map(run, due))
+        else:
+            results = []
+
+        for pending, succeeded in zip(due, results):
+            for message_id in pending.message_ids:
+                if not succeeded:
+                    self._failed.add(message_id)
+                outstanding = self._outstanding[message_id]
+                outstanding.discard(pending.target.key)
+                if len(outstanding) == 0:
+                    del self._outstanding[message_id]
+                    self._finished.append(message_id)
+
+        finished, self._finished = self._finished, []
+        succeeded = [m for m in finished if m not in self._failed]
+        failed = [m for m in finished if m in self._failed]
+        self._failed.difference_update(failed)
+        return succeeded, failed
+
+    def handle_batch(self, records: List[dict]) -> Dict[str, List[Dict[str, str]]]:
+        '''
+        Coalesce and run all of the aggregations for a batch of SQS records, for use in a lambda handler where the
+        SQS batching window acts as the debounce window
+
+        :param records: The SQS records
+        :returns: The partial batch response, listing the message ids of the failed records as batchItemFailures
+        '''
+        self.add(records)
+        _, failed = self.run_due(force=True)
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
+
+    def poll(self, queue: InMemoryQueue, max_messages: int = 10) -> int:
+        '''
+        Receive new messages from a queue and run the due aggregations. Messages are deleted once all of their
+        aggregations succeeded, and released back to the queue if any of them failed.
+
+        :param queue: The queue to receive messages from
+        :param max_messages: The maximum number of messages to receive
+        :returns: The number of messages received
+        '''
+        records = queue.receive(max_messages)
+        self.add(records)
+        succeeded, failed = self.run_due()
+        queue.delete(succeeded)
+        queue.release(failed)
+        return len(records)
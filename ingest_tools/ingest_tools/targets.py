@@ -0,0 +1,76 @@
+'''
+Aggregation targets
+
+Resolves the aggregations a kerchunked file in the ingest bucket belongs to, shared by the aggregation lambda and
+the backfill command.
+'''
+
+from typing import Callable, List
+
+from .filters import key_contains
+from .nos_ofs import (
+    generate_kerchunked_nos_roms_model_run,
+    generate_kerchunked_nos_roms_best_time_series,
+    generate_kerchunked_nos_fvcom_model_run,
+    generate_kerchunked_nos_fvcom_best_time_series,
+    generate_kerchunked_nos_selfe_model_run,
+    generate_kerchunked_nos_selfe_best_time_series,
+    generate_nos_best_time_series_glob_expression,
+    generate_nos_best_time_series_key,
+    generate_nos_model_run_key,
+)
+from .rtofs import (
+    generate_kerchunked_rtofs_best_time_series,
+    generate_rtofs_best_time_series_glob_expression,
+    generate_rtofs_best_timeseries_key,
+)
+from .scheduler import AggregationTarget
+
+
+NOS_ROMS_FILTERS = ["cbofs", "ciofs", "dbofs", 'gomofs', "tbofs", "wcofs"]
+NOS_FVCOM_FILTERS = ["leofs", "lmhofs", "loofs", 'lsofs', "ngofs2", "sfbofs"]
+NOS_SELFE_FILTERS = ['creofs']
+RTOFS_FILTERS = ["rtofs"]
+
+
+def nos_aggregation_targets(key: str, model_run: Callable, best_time_series: Callable) -> List[AggregationTarget]:
+    '''
+    The model run and, for forecast files, the best time series aggregation of a NOS file
+    '''
+    targets = []
+    try:
+        targets.append(AggregationTarget(generate_nos_model_run_key(key), model_run))
+    except Exception as e:
+        print(f"Failed to parse model run from key {key}: {e}")
+
+    try:
+        best_time_series_key = generate_nos_best_time_series_key(generate_nos_best_time_series_glob_expression(key))
+        targets.append(AggregationTarget(best_time_series_key, best_time_series))
+    except Exception as e:
+        print(f"Failed to parse best time series from key {key}: {e}")
+
+    return targets
+
+
+def aggregation_targets(key: str) -> List[AggregationTarget]:
+    '''
+    The aggregations that the given kerchunked file belongs to
+
+    :param key: The key of the kerchunked file in the ingest bucket
+    :returns: The aggregation targets, empty if the file does not belong to any aggregation
+    '''
+    if key_contains(key, NOS_ROMS_FILTERS):
+        return nos_aggregation_targets(key, generate_kerchunked_nos_roms_model_run, generate_kerchunked_nos_roms_best_time_series)
+    elif key_contains(key, NOS_FVCOM_FILTERS):
+        return nos_aggregation_targets(key, generate_kerchunked_nos_fvcom_model_run, generate_kerchunked_nos_fvcom_best_time_series)
+    elif key_contains(key, NOS_SELFE_FILTERS):
+        return nos_aggregation_targets(key, generate_kerchunked_nos_selfe_model_run, generate_kerchunked_nos_selfe_best_time_series)
+    elif key_contains(key, RTOFS_FILTERS):
+        try:
+            best_time_series_key = generate_rtofs_best_timeseries_key(generate_rtofs_best_time_series_glob_expression(key))
+        except Exception as e:
+            print(f"Failed to parse best time series from key {key}: {e}")
+            return []
+        return [AggregationTarget(best_time_series_key, generate_kerchunked_rtofs_best_time_series)]
+    else:
+        return []
@@ -0,0 +1,253 @@
+'''
+Template driven kerchunking of structurally identical HDF5 files
+
+Every forecast hour of a model run, and every model run of a model, is written with the same variables, dimensions,
+attributes and HDF5 layout. SingleHdf5ToZarr still walks and decodes the whole HDF5 object tree for each file. Once one
+file with a given structure has been fully scanned, its references are kept as a template. The next file with the
+same structural fingerprint reuses the template's zarr metadata and only needs each variable's chunk offsets and
+sizes, which are collected with a walk of the chunk index, plus its attributes, which live in the object headers
+that were already read to compute the fingerprint.
+
+The fast path result is verified against the template, and any mismatch falls back to the full scan.
+'''
+
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import h5py
+import numpy as np
+import ujson
+from kerchunk.hdf import SingleHdf5ToZarr
+from kerchunk.utils import _encode_for_JSON
+from zarr.util import json_dumps
+
+
+# The number of templates kept per container, one per model and file type is enough
+MAX_TEMPLATES = 64
+
+# Only plain numeric datasets are translated from a template, everything else is left to the full scan
+TEMPLATE_DTYPE_KINDS = 'biufc'
+
+_templates: 'OrderedDict[str, dict]' = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def _dataset_fingerprint(name: str, dset: h5py.Dataset) -> Optional[list]:
+    dsid = dset.id
+    if dsid.dtype.kind not in TEMPLATE_DTYPE_KINDS:
+        return None
+
+    # Every h5py.Dataset filter and layout property fetches its own copy of the creation property list, which is
+    # most of the cost of fingerprinting a file, so they are all read from a single one
+    dcpl = dsid.get_create_plist()
+    layout = dcpl.get_layout()
+    if layout == h5py.h5d.COMPACT:
+        return None
+
+    fillvalue = np.zeros((1,), dtype=dsid.dtype)
+    dcpl.get_fill_value(fillvalue)
+    attrs = sorted(dset.attrs.keys())
+
+    return [
+        name,
+        list(dsid.shape or []),
+        dsid.dtype.str,
+        list(dcpl.get_chunk()) if layout == h5py.h5d.CHUNKED else [],
+        [list(dcpl.get_filter(i)[:3]) for i in range(dcpl.get_nfilters())],
+        layout,
+        repr(fillvalue[0]),
+        repr(dset.attrs['_FillValue']) if '_FillValue' in attrs else None,
+        attrs,
+    ]
+
+
+def hdf5_structural_fingerprint(h5f: h5py.File) -> Optional[str]:
+    '''
+    Compute a fingerprint of the structure of an HDF5 file: its groups and datasets, their attribute names and
+    each dataset's shape, dtype, chunking, filters, layout and fill value. Attribute values and chunk locations
+    are not part of the fingerprint.
+
+    :param h5f: The open HDF5 file
+    :returns: The hex digest of the fingerprint, or None if the file contains datasets that templates do not support
+    '''
+    structure = [['/', sorted(h5f.attrs.keys())]]
+    supported = True
+
+    def visit(name, h5obj):
+        nonlocal supported
+        if isinstance(h5obj, h5py.Dataset):
+            fingerprint = _dataset_fingerprint(name, h5obj)
+            if fingerprint is None:
+                supported = False
+            structure.append(fingerprint)
+        elif isinstance(h5obj, h5py.Group):
+            structure.append([name, sorted(h5obj.attrs.keys())])
+
+    h5f.visititems(visit)
+    if not supported:
+        return None
+
+    return hashlib.sha256(ujson.dumps(structure).encode()).hexdigest()
+
+
+def get_template(fingerprint: str) -> Optional[dict]:
+    '''
+    Get the template references for a structural fingerprint
+
+    :param fingerprint: The structural fingerprint
+    :returns: The template references, or None if no file with this structure has been fully scanned yet
+    '''
+    with _templates_lock:
+        template = _templates.get(fingerprint)
+        if template is not None:
+            _templates.move_to_end(fingerprint)
+        return template
+
+
+def put_template(fingerprint: str, refs: dict):
+    '''
+    Keep the references of a fully scanned file as the template for its structural fingerprint
+
+    :param fingerprint: The structural fingerprint
+    :param refs: The references of the fully scanned file
+    '''
+    with _templates_lock:
+        _templates[fingerprint] = refs
+        _templates.move_to_end(fingerprint)
+        while len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+
+
+def clear_templates():
+    '''
+    Drop every cached template
+    '''
+    with _templates_lock:
+        _templates.clear()
+
+
+def _is_metadata_key(key: str) -> bool:
+    return key.rsplit('/', 1)[-1].startswith('.z')
+
+
+def _variable_chunk_keys(refs: dict) -> Dict[str, List[str]]:
+    variables = {}
+    for key in refs:
+        if key.endswith('.zarray'):
+            variables.setdefault(key[:-len('.zarray')].rstrip('/'), [])
+    for key in refs:
+        if not _is_metadata_key(key) and '/' in key:
+            variable = key.rsplit('/', 1)[0]
+            if variable in variables:
+                variables[variable].append(key)
+    return variables
+
+
+class _AttributeCollector:
+    '''Stands in for the zarr group or array that SingleHdf5ToZarr._transfer_attrs writes attributes to'''
+
+    def __init__(self):
+        self.attrs = {}
+
+
+class TemplatedHdf5ToZarr(SingleHdf5ToZarr):
+    '''
+    SingleHdf5ToZarr that reuses the references of a previously scanned file with the same structure as a template
+
+    Files without a template, or whose fast path result does not match their template, are fully scanned and
+    become the template for their structure.
+    '''
+
+    def translate(self, preserve_linked_dsets: bool = False) -> dict:
+        '''
+        :param preserve_linked_dsets: Translate soft and hard links to datasets as well, see SingleHdf5ToZarr.translate.
+            Linked datasets are not part of the structural fingerprint, so such files are always fully scanned.
+        :returns: The references
+        '''
+        if preserve_linked_dsets:
+            return super().translate(preserve_linked_dsets=True)
+
+        fingerprint = hdf5_structural_fingerprint(self._h5f)
+        if fingerprint is None:
+            return super().translate()
+
+        template = get_template(fingerprint)
+        if template is not None:
+            try:
+                refs = self.translate_from_template(template['refs'])
+            except Exception as e:
+                print(f'Failed to kerchunk {self._uri} from its template: {e}')
+                refs = None
+
+            if refs is not None:
+                return refs
+
+            print(f'Kerchunking {self._uri} from its template did not match, falling back to a full scan...')
+
+        refs = super().translate()
+        put_template(fingerprint, refs)
+        return refs
+
+    def _attrs_json(self, h5obj, **extra) -> Optional[str]:
+        collector = _AttributeCollector()
+        self._transfer_attrs(h5obj, collector)
+        collector.attrs.update(extra)
+        # Encoded the way zarr writes .zattrs, so the result is identical to a full scan
+        return json_dumps(collector.attrs).decode() if collector.attrs else None
+
+    def translate_from_template(self, template: dict) -> Optional[dict]:
+        '''
+        Translate the file using the zarr metadata of a template
+
+        Only the attributes and the chunk offsets and sizes of each variable are read from the file. No zarr
+        hierarchy is built, the .zgroup and .zarray metadata are copied from the template as they are.
+
+        :param template: The template references
+        :returns: The references, or None if the result does not match the template
+        '''
+        store = {k: v for k, v in template.items() if k.endswith(('.zgroup', '.zarray'))}
+
+        # Attributes can change from file to file, for example the time units, so they are always read
+        for key in template:
+            if key.endswith('.zgroup'):
+                name = key[:-len('.zgroup')].rstrip('/')
+                attrs = self._attrs_json(self._h5f[name] if name else self._h5f)
+                if attrs is not None:
+                    store[f'{name}/.zattrs' if name else '.zattrs'] = attrs
+
+        variables = _variable_chunk_keys(template)
+        for name, template_chunk_keys in variables.items():
+            dset = self._h5f.get(name)
+            if not isinstance(dset, h5py.Dataset):
+                return None
+
+            dimensions = ujson.loads(template[f'{name}/.zattrs'])['_ARRAY_DIMENSIONS']
+            store[f'{name}/.zattrs'] = self._attrs_json(dset, _ARRAY_DIMENSIONS=dimensions)
+
+            separator = ujson.loads(template[f'{name}/.zarray']).get('dimension_separator') or '.'
+            chunk_keys = []
+            for k, v in self._storage_info(dset).items():
+                size = v['size'] - 4 if dset.fletcher32 else v['size']
+                chunk_key = f'{name}/{separator.join(str(i) for i in k)}'
+                chunk_keys.append(chunk_key)
+                if self.inline and size < self.inline:
+                    self.input_file.seek(v['offset'])
+                    data = self.input_file.read(size)
+                    try:
+                        data.decode('ascii')
+                    except UnicodeDecodeError:
+                        data = b'base64:' + base64.b64encode(data)
+                    store[chunk_key] = data
+                else:
+                    store[chunk_key] = [self._uri, v['offset'], size]
+
+            if sorted(chunk_keys) != sorted(template_chunk_keys):
+                return None
+
+        if set(store) != set(template):
+            return None
+
+        return {'version': 1, 'refs': _encode_for_JSON(store)}
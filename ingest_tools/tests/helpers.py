@@ -0,0 +1,63 @@
+'''
+Factories shared by the test modules
+'''
+
+import fsspec
+import numpy as np
+import ujson
+import zarr
+from fsspec.implementations.memory import MemoryFileSystem
+from fsspec.spec import AbstractBufferedFile
+from kerchunk.utils import consolidate
+
+
+def make_refs(ocean_time: float) -> dict:
+    '''
+    Create a small, fully inlined reference set that looks like a single ROMS output timestep
+    '''
+    store = {}
+    group = zarr.group(store=store)
+    group.attrs['title'] = 'test'
+
+    t = group.create_dataset('ocean_time', data=np.array([ocean_time]), compressor=None)
+    t.attrs['_ARRAY_DIMENSIONS'] = ['ocean_time']
+
+    h = group.create_dataset('h', data=np.arange(4.0).reshape(2, 2), compressor=None)
+    h.attrs['_ARRAY_DIMENSIONS'] = ['eta_rho', 'xi_rho']
+
+    zeta = group.create_dataset('zeta', data=np.full((1, 2, 2), ocean_time), chunks=(1, 2, 2), compressor=None)
+    zeta.attrs['_ARRAY_DIMENSIONS'] = ['ocean_time', 'eta_rho', 'xi_rho']
+
+    return {'version': 1, 'refs': consolidate(store)['refs']}
+
+
+def make_sqs_record(message_id: str, key: str) -> dict:
+    with open('tests/data/s3_sqs_payload.json', 'r') as f:
+        sqs_message = ujson.load(f)
+
+    message = ujson.loads(sqs_message['Message'])
+    message['Records'][0]['s3']['object']['key'] = key
+    sqs_message['Message'] = ujson.dumps(message)
+
+    return {'messageId': message_id, 'body': ujson.dumps(sqs_message)}
+
+
+class BytesFile(AbstractBufferedFile):
+    '''Buffered read only file over in memory bytes, fetching through the fsspec block cache'''
+
+    def __init__(self, data: bytes, block_size: int, cache_type: str = 'readahead'):
+        self.data = data
+        super().__init__(fsspec.filesystem('memory'), 'bytes', block_size=block_size, cache_type=cache_type, size=len(data))
+
+    def _fetch_range(self, start, end):
+        return self.data[start:end]
+
+
+class ETagMemoryFileSystem(MemoryFileSystem):
+    '''
+    Memory filesystem reporting an S3 style ETag for its files
+    '''
+    protocol = 'etagmemory'
+
+    def info(self, path, **kwargs):
+        return {**super().info(path, **kwargs), 'ETag': '"etag"'}
@@ -0,0 +1,182 @@
+import fsspec
+import numpy as np
+import zarr
+from kerchunk.combine import MultiZarrToZarr
+from kerchunk.utils import consolidate
+from ingest_tools.aggregation import (
+    append_kerchunked_aggregation,
+    contains_kerchunked_references,
+    generate_kerchunked_aggregation,
+    read_concat_dim_values,
+)
+from ingest_tools.references import ReferenceFormat, inline_whole_variables, read_references, write_references
+
+from helpers import make_refs
+
+
+def combine(refs: list) -> dict:
+    return MultiZarrToZarr(refs, concat_dims=['ocean_time'], identical_dims=['h']).translate()
+
+
+def open_group(refs: dict) -> zarr.Group:
+    return zarr.open_group(fsspec.filesystem('reference', fo=refs).get_mapper(''), mode='r')
+
+
+def test_append_matches_full_rebuild():
+    members = [make_refs(t) for t in (3600.0, 7200.0, 10800.0)]
+
+    appended = append_kerchunked_aggregation(
+        combine(members[:2]),
+        [members[2]],
+        concat_dims=['ocean_time'],
+        identical_dims=['h'],
+        remote_options={},
+    )
+    assert appended is not None
+
+    expected = open_group(combine(members))
+    actual = open_group(appended)
+    np.testing.assert_array_equal(actual['ocean_time'][:], expected['ocean_time'][:])
+    np.testing.assert_array_equal(actual['zeta'][:], expected['zeta'][:])
+    np.testing.assert_array_equal(actual['h'][:], expected['h'][:])
+    assert read_concat_dim_values(appended, 'ocean_time', {}).tolist() == [3600.0, 7200.0, 10800.0]
+
+
+def test_append_out_of_order_falls_back():
+    members = [make_refs(t) for t in (3600.0, 7200.0, 10800.0)]
+
+    # The new file is inside the existing time range so it can not be appended
+    appended = append_kerchunked_aggregation(
+        combine([members[0], members[2]]),
+        [members[1]],
+        concat_dims=['ocean_time'],
+        identical_dims=['h'],
+        remote_options={},
+    )
+    assert appended is None
+
+
+def test_append_unexpected_length_falls_back():
+    members = [make_refs(t) for t in (3600.0, 7200.0, 10800.0)]
+
+    # Appending would be in order, but the caller expects members to have been dropped
+    appended = append_kerchunked_aggregation(
+        combine(members[:2]),
+        [members[2]],
+        concat_dims=['ocean_time'],
+        identical_dims=['h'],
+        remote_options={},
+        expected_length=2,
+    )
+    assert appended is None
+
+
+def test_aggregation_missing_member_is_rebuilt(capsys):
+    fs = fsspec.filesystem('memory')
+    url = 'memory://aggregation-test/nos.dbofs.fields.forecast.20230315.t00z.nc.zarr'
+    times = (3600.0, 7200.0, 10800.0, 14400.0)
+    files = [f'memory://aggregation-test/nos.dbofs.fields.f00{i + 1}.20230315.t00z.nc.zarr' for i in range(len(times))]
+    members = [make_refs(t) for t in times]
+    for f, member, t in zip(files, members, times):
+        # Chunks above the inline threshold are combined without being read
+        member['refs']['zeta/0.0.0'] = [f's3://noaa-ofs-pds/dbofs/nos.dbofs.fields.{int(t)}.nc', 1000, 4096]
+        write_references(fs, f, member)
+
+    def aggregate(new_files):
+        return generate_kerchunked_aggregation(
+            fs,
+            url,
+            new_files,
+            lambda: files,
+            concat_dims=['ocean_time'],
+            identical_dims=['h'],
+            remote_options={},
+            expected_length=len(files),
+        )
+
+    # The third member was appended by a concurrent update whose write was overwritten, the fourth sorts after
+    # the aggregation but appending it would leave the third out
+    write_references(fs, url, combine(members[:2]))
+    d = aggregate(files[3:])
+    assert read_concat_dim_values(d, 'ocean_time', {}).tolist() == list(times)
+    assert 'Appending would result in 3 ocean_time values, expected 4' in capsys.readouterr().out
+
+    # A redelivered member that is already part of the short aggregation rebuilds it too
+    write_references(fs, url, combine(members[:2]))
+    d = aggregate(files[1:2])
+    assert read_concat_dim_values(d, 'ocean_time', {}).tolist() == list(times)
+    assert 'The aggregation has 2 ocean_time values, expected 4' in capsys.readouterr().out
+
+    fs.rm('memory://aggregation-test', recursive=True)
+
+
+def test_append_parquet_aggregation_in_place():
+    fs = fsspec.filesystem('memory')
+    url = 'memory://aggregation-test/nos.dbofs.fields.best.nc.zarr'
+    members = [make_refs(t) for t in (3600.0, 7200.0, 10800.0)]
+
+    write_references(fs, url, combine(members[:2]), ReferenceFormat.PARQUET)
+
+    aggregation_refs = read_references(fs, url, ReferenceFormat.PARQUET)
+    appended = append_kerchunked_aggregation(
+        aggregation_refs,
+        [members[2]],
+        concat_dims=['ocean_time'],
+        identical_dims=['h'],
+        remote_options={},
+    )
+    assert appended is not None
+    write_references(fs, url, appended, ReferenceFormat.PARQUET)
+
+    expected = open_group(combine(members))
+    actual = open_group(read_references(fs, url, ReferenceFormat.PARQUET))
+    np.testing.assert_array_equal(actual['ocean_time'][:], expected['ocean_time'][:])
+    np.testing.assert_array_equal(actual['zeta'][:], expected['zeta'][:])
+
+    fs.rm('memory://aggregation-test', recursive=True)
+
+
+def test_contains_references():
+    members = [make_refs(t) for t in (3600.0, 7200.0)]
+    for member, t in zip(members, (3600.0, 7200.0)):
+        # Chunks above the inline threshold are combined without being read
+        member['refs']['zeta/0.0.0'] = [f's3://noaa-ofs-pds/dbofs/nos.dbofs.fields.{int(t)}.nc', 1000, 4096]
+
+    assert contains_kerchunked_references(combine(members), members[1], ['ocean_time'], {})
+    assert not contains_kerchunked_references(combine(members[:1]), members[1], ['ocean_time'], {})
+
+    # Fully inlined reference sets can not be matched by their chunk references
+    assert not contains_kerchunked_references(combine(members), make_refs(7200.0), ['ocean_time'], {})
+
+
+def test_inline_concat_dim():
+    store = {}
+    group = zarr.group(store=store)
+    t = group.create_dataset('ocean_time', data=np.array([3600.0, 7200.0, 10800.0]), chunks=(1,), compressor=None)
+    t.attrs['_ARRAY_DIMENSIONS'] = ['ocean_time']
+    refs = consolidate(store)
+
+    inlined = inline_whole_variables(refs, ['ocean_time', 'missing'], {})
+    assert sorted(k for k in inlined['refs'] if k.startswith('ocean_time/')) == ['ocean_time/.zarray', 'ocean_time/.zattrs', 'ocean_time/0']
+    assert read_concat_dim_values(inlined, 'ocean_time', {}).tolist() == [3600.0, 7200.0, 10800.0]
+    # The given reference set is left as it is
+    assert 'ocean_time/2' in refs['refs']
+
+
+def test_append_to_inlined_aggregation():
+    members = [make_refs(t) for t in (3600.0, 7200.0, 10800.0)]
+    inlined = inline_whole_variables(combine(members[:2]), ['ocean_time'], {})
+
+    appended = append_kerchunked_aggregation(
+        inlined,
+        [members[2]],
+        concat_dims=['ocean_time'],
+        identical_dims=['h'],
+        remote_options={},
+    )
+    assert appended is not None
+
+    expected = open_group(combine(members))
+    actual = open_group(appended)
+    np.testing.assert_array_equal(actual['ocean_time'][:], expected['ocean_time'][:])
+    np.testing.assert_array_equal(actual['zeta'][:], expected['zeta'][:])
@@ -0,0 +1,120 @@
+import datetime
+
+import fsspec
+
+import ingest_tools.backfill as backfill
+from ingest_tools.backfill import AGGREGATED, FAILED, KERCHUNKED, PENDING, SKIPPED, Checkpoint, aggregate_backfill, list_backfill_keys, stage_pipelines
+from ingest_tools.engine import IngestEngine
+from ingest_tools.filemetadata import FileMetadata
+from ingest_tools.pipeline import KerchunkResult, Pipeline, PipelineContext
+from ingest_tools.scheduler import AggregationTarget
+
+
+class SkippingPipeline(Pipeline):
+    '''Pipeline writing empty references for .nc keys, skipping f002 keys and failing n002 keys'''
+
+    def __init__(self, fs: fsspec.AbstractFileSystem) -> None:
+        super().__init__('.nc', ['ofs'], 'nos')
+        self.fs = fs
+
+    def read_file_metadata(self, key: str) -> FileMetadata:
+        pass
+
+    def generate_kerchunk_output_key(self, key: str) -> str:
+        return f'{key}.zarr'
+
+    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str):
+        if 'f002' in src_key:
+            return KerchunkResult.SKIPPED
+        if 'n002' in src_key:
+            raise ValueError('Failed to kerchunk')
+        self.fs.pipe(f's3://{dest_bucket}/{dest_prefix}/{dest_key}', b'{}')
+
+
+def test_list_backfill_keys():
+    fs = fsspec.filesystem('memory')
+    fs.pipe('/backfill-src/cbofs.20231022/nos.cbofs.fields.n006.20231022.t00z.nc', b'')
+    fs.pipe('/backfill-src/cbofs.20231022/nos.cbofs.fields.f001.20231022.t00z.nc', b'')
+    fs.pipe('/backfill-src/cbofs.20231024/nos.cbofs.fields.f001.20231024.t00z.nc', b'')
+    fs.pipe('/backfill-src/cbofs.20231025/nos.cbofs.fields.f001.20231025.t00z.nc', b'')
+    fs.pipe('/backfill-src/dbofs.20231022/nos.dbofs.fields.f001.20231022.t00z.nc', b'')
+
+    keys = list_backfill_keys(fs, 'backfill-src', 'cbofs', datetime.date(2023, 10, 22), datetime.date(2023, 10, 24))
+    assert keys == [
+        'cbofs.20231022/nos.cbofs.fields.f001.20231022.t00z.nc',
+        'cbofs.20231022/nos.cbofs.fields.n006.20231022.t00z.nc',
+        'cbofs.20231024/nos.cbofs.fields.f001.20231024.t00z.nc',
+    ]
+
+
+def test_checkpoint_resume(tmp_path):
+    path = str(tmp_path / 'backfill.sqlite')
+    checkpoint = Checkpoint(path)
+    assert checkpoint.add(['a.nc', 'b.nc', 'c.nc']) == 3
+    checkpoint.set_status('a.nc', KERCHUNKED, ['nos/a.nc.zarr'])
+    checkpoint.set_status('b.nc', FAILED, [], 'bad file')
+    checkpoint.close()
+
+    # A second run keeps the status of the keys that are already in the checkpoint
+    checkpoint = Checkpoint(path)
+    assert checkpoint.add(['a.nc', 'b.nc', 'c.nc', 'd.nc']) == 1
+    assert checkpoint.keys(PENDING, FAILED) == ['b.nc', 'c.nc', 'd.nc']
+    assert checkpoint.output_keys(KERCHUNKED) == {'a.nc': ['nos/a.nc.zarr']}
+    assert checkpoint.counts() == {KERCHUNKED: 1, FAILED: 1, PENDING: 2}
+    checkpoint.close()
+
+
+def test_skipped_keys_are_not_retried(tmp_path, monkeypatch):
+    fs = fsspec.filesystem('memory')
+    monkeypatch.setattr(backfill, 'get_write_filesystem', lambda: fs)
+    context = PipelineContext('us-east-1', 'backfill-dest')
+    context.add_pipeline('nos', SkippingPipeline(fs))
+    stage_pipelines(context, 'staging/')
+    monkeypatch.setattr(backfill, '_engine', IngestEngine(lambda _: context))
+
+    keys = ['cbofs.20231022/nos.cbofs.fields.f001.20231022.t00z.nc', 'cbofs.20231022/nos.cbofs.fields.f002.20231022.t00z.nc', 'cbofs.20231022/nos.cbofs.fields.n002.20231022.t00z.nc']
+    results = backfill._kerchunk_keys('src', keys)
+
+    assert [(key, status, output_keys) for key, status, output_keys, _ in results] == [
+        (keys[0], KERCHUNKED, [f'staging/nos/{keys[0]}.zarr']),
+        (keys[1], SKIPPED, []),
+        (keys[2], FAILED, []),
+    ]
+    assert fs.exists(f's3://backfill-dest/staging/nos/{keys[0]}.zarr')
+
+    checkpoint = Checkpoint(str(tmp_path / 'backfill.sqlite'))
+    checkpoint.add(keys)
+    for key, status, output_keys, error in results:
+        checkpoint.set_status(key, status, output_keys, error)
+    assert checkpoint.keys(PENDING, FAILED) == [keys[2]]
+    assert checkpoint.counts() == {KERCHUNKED: 1, SKIPPED: 1, FAILED: 1}
+    checkpoint.close()
+
+    fs.rm('s3://backfill-dest', recursive=True)
+
+
+def test_aggregate_backfill_once_per_aggregation(tmp_path):
+    calls = []
+
+    def aggregate(region, bucket, keys):
+        if any('fail' in k for k in keys):
+            raise ValueError('failed aggregation')
+        calls.append((region, bucket, list(keys)))
+
+    def resolve_targets(key):
+        model_run = key.rsplit('.', 3)[0]
+        return [AggregationTarget(model_run, aggregate)]
+
+    checkpoint = Checkpoint(str(tmp_path / 'backfill.sqlite'))
+    checkpoint.add(['a1', 'a2', 'b1', 'c1'])
+    checkpoint.set_status('a1', KERCHUNKED, ['nos/a.t00z.f001.nc.zarr'])
+    checkpoint.set_status('a2', KERCHUNKED, ['nos/a.t00z.f002.nc.zarr'])
+    checkpoint.set_status('b1', KERCHUNKED, ['nos/fail.t00z.f001.nc.zarr'])
+
+    aggregate_backfill(checkpoint, 'us-east-1', 'dest', resolve_targets)
+
+    assert calls == [('us-east-1', 'dest', ['nos/a.t00z.f001.nc.zarr', 'nos/a.t00z.f002.nc.zarr'])]
+    assert checkpoint.keys(AGGREGATED) == ['a1', 'a2']
+    # The failed aggregation is retried by the next run
+    assert checkpoint.keys(KERCHUNKED) == ['b1']
+    assert checkpoint.keys(PENDING) == ['c1']
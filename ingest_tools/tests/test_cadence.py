@@ -0,0 +1,52 @@
+import fsspec
+import s3fs
+
+from ingest_tools.cadence import NOS_OFS_CADENCES, find_existing_files, model_run_member_keys
+from ingest_tools.generic import ModelRunType
+
+
+class HeadCountingS3FileSystem(s3fs.S3FileSystem):
+    '''S3 filesystem answering HEAD requests from a set of keys, failing any other request'''
+
+    def __init__(self, keys, **kwargs):
+        super().__init__(anon=True, skip_instance_cache=True, **kwargs)
+        self.keys = set(keys)
+        self.calls = []
+
+    async def _call_s3(self, method, *akwarglist, **kwargs):
+        self.calls.append(method)
+        assert method == 'head_object'
+        if f"{kwargs['Bucket']}/{kwargs['Key']}" not in self.keys:
+            raise FileNotFoundError(kwargs['Key'])
+        return {}
+
+
+def test_model_run_member_keys():
+    glob = 'nos/cbofs/nos.cbofs.fields.f[0-9][0-9][0-9].20230315.t00z.nc.zarr'
+    cadence = NOS_OFS_CADENCES['cbofs']
+
+    keys = model_run_member_keys(glob, cadence.offsets(ModelRunType.FORECAST))
+    assert len(keys) == 48
+    assert keys[0] == 'nos/cbofs/nos.cbofs.fields.f001.20230315.t00z.nc.zarr'
+    assert keys[-1] == 'nos/cbofs/nos.cbofs.fields.f048.20230315.t00z.nc.zarr'
+
+    glob = 'nos/cbofs/nos.cbofs.fields.n[0-9][0-9][0-9].20230315.t00z.nc.zarr'
+    keys = model_run_member_keys(glob, cadence.offsets(ModelRunType.NOWCAST))
+    assert keys == [f'nos/cbofs/nos.cbofs.fields.n00{i}.20230315.t00z.nc.zarr' for i in range(1, 7)]
+
+
+def test_find_existing_files():
+    fs = fsspec.filesystem('memory')
+    fs.pipe('/bucket/a.zarr', b'{}')
+    fs.pipe('/bucket/c.zarr', b'{}')
+
+    urls = ['memory://bucket/a.zarr', 'memory://bucket/b.zarr', 'memory://bucket/c.zarr']
+    assert find_existing_files(fs, urls) == ['memory://bucket/a.zarr', 'memory://bucket/c.zarr']
+
+
+def test_find_existing_files_with_head_requests():
+    fs = HeadCountingS3FileSystem(['bucket/a.zarr', 'bucket/c.zarr'])
+
+    urls = [f's3://bucket/{k}.zarr' for k in 'abcd']
+    assert find_existing_files(fs, urls, max_concurrent=2) == ['s3://bucket/a.zarr', 's3://bucket/c.zarr']
+    assert fs.calls == ['head_object'] * 4
@@ -0,0 +1,178 @@
+import threading
+import time
+
+import numpy as np
+import ujson
+from scipy.io import netcdf_file
+
+import ingest_tools.generic as generic
+from ingest_tools.engine import IngestEngine
+from ingest_tools.netcdf3 import SharedFileNetCDF3ToZarr
+from ingest_tools.filemetadata import FileMetadata
+from ingest_tools.nos_ofs import NOS_Pipeline
+from ingest_tools.pipeline import Pipeline, PipelineContext
+
+from helpers import BytesFile, ETagMemoryFileSystem, make_sqs_record
+
+
+class SleepingPipeline(Pipeline):
+    '''Pipeline standing in for S3 latency, recording how many keys were in flight at once'''
+
+    def __init__(self) -> None:
+        super().__init__('.nc', ['ofs'], 'test')
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.keys = []
+
+    def read_file_metadata(self, key: str) -> FileMetadata:
+        pass
+
+    def generate_kerchunk_output_key(self, key: str) -> str:
+        return f'{key}.zarr'
+
+    def generate_kerchunk(self, region: str, src_bucket: str, src_key: str, dest_bucket: str, dest_key: str, dest_prefix: str):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(0.05)
+            if 'n002' in src_key:
+                raise ValueError('Failed to kerchunk')
+            self.keys.append(src_key)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def make_engine(max_concurrent: int):
+    pipeline = SleepingPipeline()
+    context = PipelineContext('us-east-1', 'dest')
+    context.add_pipeline('test', pipeline)
+    return IngestEngine(lambda region: context, max_concurrent=max_concurrent), pipeline
+
+
+def test_ingest_concurrency_limit():
+    engine, pipeline = make_engine(max_concurrent=4)
+    keys = [f'tbofs.20230314/nos.tbofs.fields.f{i:03d}.20230314.t00z.nc' for i in range(1, 13)] + ['unrouted.grib2']
+
+    results = engine.run([('src', key) for key in keys])
+
+    assert [r.key for r in results] == keys
+    assert all(r.succeeded for r in results)
+    assert results[0].output_keys == [f'test/{keys[0]}.zarr']
+    assert results[-1].output_keys == []
+    assert sorted(pipeline.keys) == keys[:-1]
+    assert 1 < pipeline.max_in_flight <= 4
+
+
+def test_handle_batch_reports_failures():
+    engine, pipeline = make_engine(max_concurrent=4)
+    records = [
+        make_sqs_record('1', 'tbofs.20230314/nos.tbofs.fields.n001.20230314.t00z.nc'),
+        make_sqs_record('2', 'tbofs.20230314/nos.tbofs.fields.n002.20230314.t00z.nc'),
+        make_sqs_record('3', 'tbofs.20230314/nos.tbofs.fields.n001.20230314.t00z.nc'),
+        {'messageId': '4', 'body': 'not json'},
+    ]
+
+    response = engine.handle_batch(records)
+
+    assert sorted(f['itemIdentifier'] for f in response['batchItemFailures']) == ['2', '4']
+    # Records for the same key are kerchunked once
+    assert pipeline.keys == ['tbofs.20230314/nos.tbofs.fields.n001.20230314.t00z.nc']
+
+
+def test_handle_batch_reports_failed_scans(monkeypatch):
+    # A NetCDF3 file cut off in its header, as if the read failed part way
+    data = b'CDF\x01\x00\x00'
+    def open_truncated(fs, url, **kwargs):
+        return BytesFile(data, block_size=1024)
+
+    fs = ETagMemoryFileSystem()
+    fs.pipe('s3://src/tbofs.20230314/nos.tbofs.fields.n001.20230314.t00z.nc', data)
+    monkeypatch.setattr(generic, 'open_for_scan', open_truncated)
+    monkeypatch.setattr(generic, 'get_read_filesystem', lambda: fs)
+    monkeypatch.setattr(generic, 'get_write_filesystem', lambda: fs)
+
+    context = PipelineContext('us-east-1', 'dest')
+    context.add_pipeline('nos', NOS_Pipeline())
+    engine = IngestEngine(lambda region: context)
+
+    response = engine.handle_batch([make_sqs_record('1', 'tbofs.20230314/nos.tbofs.fields.n001.20230314.t00z.nc')])
+
+    assert response['batchItemFailures'] == [{'itemIdentifier': '1'}]
+    assert not fs.exists('s3://dest/nos/tbofs/nos.tbofs.fields.n001.20230314.t00z.nc.zarr')
+
+    fs.rm('s3://src', recursive=True)
+
+
+def test_unsupported_formats_are_skipped(monkeypatch):
+    key = 'tbofs.20230314/nos.tbofs.fields.n001.20230314.t00z.nc'
+    fs = ETagMemoryFileSystem()
+    fs.pipe(f's3://src/{key}', b'GRIB\x00\x00\x00\x00')
+    monkeypatch.setattr(generic, 'get_read_filesystem', lambda: fs)
+    monkeypatch.setattr(generic, 'get_write_filesystem', lambda: fs)
+
+    context = PipelineContext('us-east-1', 'dest')
+    context.add_pipeline('nos', NOS_Pipeline())
+    engine = IngestEngine(lambda region: context)
+
+    [result] = engine.run([('src', key)])
+
+    assert result.succeeded and result.skipped
+    assert result.output_keys == []
+    assert result.skipped_keys == ['nos/tbofs/nos.tbofs.fields.n001.20230314.t00z.nc.zarr']
+
+    fs.rm('s3://src', recursive=True)
+
+
+class AwaitedMemoryFileSystem(ETagMemoryFileSystem):
+    '''ETag memory filesystem standing in for an async filesystem, recording the requests that were awaited'''
+    async_impl = True
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.awaited = []
+
+    async def _info(self, path, **kwargs):
+        self.awaited.append('info')
+        return self.info(path, **kwargs)
+
+    async def _cat_file(self, path, start=None, end=None, **kwargs):
+        self.awaited.append('cat_file')
+        return self.cat_file(path, start=start, end=end, **kwargs)
+
+    async def _pipe_file(self, path, value, **kwargs):
+        self.awaited.append('pipe_file')
+        return self.pipe_file(path, value, **kwargs)
+
+
+def test_engine_awaits_requests(monkeypatch, tmp_path):
+    path = str(tmp_path / 'roms.nc')
+    with netcdf_file(path, 'w') as f:
+        f.createDimension('ocean_time', None)
+        f.createDimension('xi_rho', 20)
+        f.createVariable('ocean_time', 'f8', ('ocean_time',))[:] = [3600.0]
+        f.createVariable('zeta', 'f4', ('ocean_time', 'xi_rho'))[:] = np.ones((1, 20))
+    with open(path, 'rb') as f:
+        data = f.read()
+    key = 'tbofs.20230314/nos.tbofs.fields.n001.20230314.t00z.nc'
+    fs = AwaitedMemoryFileSystem(skip_instance_cache=True)
+    fs.pipe(f's3://src/{key}', data)
+    monkeypatch.setattr(generic, 'get_read_filesystem', lambda: fs)
+    monkeypatch.setattr(generic, 'get_write_filesystem', lambda: fs)
+
+    pipeline = NOS_Pipeline(inline_variables=[])
+    context = PipelineContext('us-east-1', 'dest')
+    context.add_pipeline('nos', pipeline)
+    results = IngestEngine(lambda region: context).run([('src', key)])
+
+    assert results[0].succeeded
+    # Only the scan reads through a synchronous file
+    assert fs.awaited == ['info', 'cat_file', 'pipe_file']
+
+    expected = SharedFileNetCDF3ToZarr(BytesFile(data, block_size=1024), f's3://src/{key}').translate()
+    assert ujson.loads(fs.cat('s3://dest/nos/tbofs/nos.tbofs.fields.n001.20230314.t00z.nc.zarr')) == expected
+
+    fs.rm('s3://src', recursive=True)
+    fs.rm('s3://dest', recursive=True)
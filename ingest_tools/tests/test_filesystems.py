@@ -0,0 +1,38 @@
+from ingest_tools.filesystems import (
+    DEFAULT_MAX_POOL_CONNECTIONS,
+    clear_filesystems,
+    get_read_filesystem,
+    get_s3_filesystem,
+    get_write_filesystem,
+)
+
+
+def test_filesystems_are_shared_by_options():
+    clear_filesystems()
+
+    fs_read = get_read_filesystem()
+    assert get_read_filesystem() is fs_read
+    assert get_s3_filesystem(anon=True, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS) is fs_read
+
+    assert get_write_filesystem() is not fs_read
+    assert get_read_filesystem(use_ssl=False) is not fs_read
+    assert get_read_filesystem(max_pool_connections=4) is not fs_read
+
+    assert fs_read.config_kwargs['max_pool_connections'] == DEFAULT_MAX_POOL_CONNECTIONS
+    assert get_read_filesystem(max_pool_connections=4).config_kwargs['max_pool_connections'] == 4
+
+    clear_filesystems()
+
+
+def test_refresh_filesystem():
+    clear_filesystems()
+
+    fs_write = get_write_filesystem()
+    refreshed = get_write_filesystem(refresh=True)
+    assert refreshed is not fs_write
+    assert get_write_filesystem() is refreshed
+
+    clear_filesystems()
+    assert get_write_filesystem() is not refreshed
+
+    clear_filesystems()
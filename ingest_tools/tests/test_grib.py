@@ -0,0 +1,131 @@
+import types
+
+import fsspec
+import numpy as np
+import pytest
+import zarr
+from kerchunk.utils import consolidate
+
+import ingest_tools.grib as grib
+from ingest_tools.grib import (
+    HRRR_Pipeline,
+    build_grib_mapping,
+    grib_horizon,
+    parse_grib_idx,
+    references_from_mapping,
+)
+
+from helpers import ETagMemoryFileSystem
+
+
+def read_idx(date: str = '2023110401', size: int = 6000000):
+    with open('tests/data/hrrr.t01z.wrfsfcf05.grib2.idx', 'r') as f:
+        return parse_grib_idx(f.read().replace('d=2023110401', f'd={date}'), size)
+
+
+def make_message(offset: int, length: int, run_time: int) -> dict:
+    '''
+    Create references that look like the scan_grib output of a single message, with inlined time coordinates and
+    the data referencing the message
+    '''
+    store = {}
+    group = zarr.group(store=store)
+    for name, value in [('time', run_time), ('valid_time', run_time + 5 * 3600), ('step', 5.0)]:
+        arr = group.create_dataset(name, data=np.array(value), compressor=None)
+        arr.attrs['units'] = 'hours' if name == 'step' else 'seconds since 1970-01-01T00:00:00'
+    group.create_dataset('refc', shape=(2, 2), chunks=(2, 2), dtype='f4', compressor=None)
+    refs = consolidate(store)['refs']
+    refs['refc/0.0'] = ['{{u}}', offset, length]
+    return {'version': 1, 'refs': refs, 'templates': {'u': 's3://noaa-hrrr-bdp-pds/template.grib2'}}
+
+
+def open_message(refs: dict) -> zarr.Group:
+    return zarr.open_group(fsspec.filesystem('reference', fo=refs).get_mapper(''), mode='r')
+
+
+def test_parse_grib_idx():
+    idx = read_idx()
+    assert len(idx) == 11
+    assert idx['offset'].tolist()[:2] == [0, 449315]
+    assert idx['length'].tolist()[0] == 449315
+    assert idx['length'].tolist()[-1] == 6000000 - 5748405
+    assert idx['date'].unique().tolist() == ['2023110401']
+    assert idx['message_key'].tolist()[5] == 'REFD:1000 m above ground:5 hour fcst:'
+
+
+def test_parse_grib_idx_repeated_attrs():
+    idx = parse_grib_idx('1:0:d=2023110401:TMP:surface:anl:\n2:10:d=2023110401:TMP:surface:anl:\n', 20)
+    assert idx['message_key'].tolist() == ['TMP:surface:anl:', 'TMP:surface:anl:#1']
+
+
+def test_grib_horizon():
+    assert grib_horizon('hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2') == 'conus.hrrr.wrfsfcf05.grib2'
+    assert grib_horizon('hrrr.20231105/conus/hrrr.t13z.wrfsfcf05.grib2') == 'conus.hrrr.wrfsfcf05.grib2'
+    assert grib_horizon('gfs.20231104/00/atmos/gfs.t00z.pgrb2.0p25.f021') == 'atmos.gfs.pgrb2.0p25.f021'
+
+
+def test_references_from_mapping():
+    template_run_time = 1699059600  # 2023-11-04T01
+    template_idx = read_idx()
+    messages = [make_message(row.offset, row.length, template_run_time) for row in template_idx.itertuples()]
+    mapping = build_grib_mapping('conus.hrrr.wrfsfcf05.grib2', template_idx, messages)
+
+    # The next model run, with different message sizes
+    idx = read_idx('2023110402', size=7000000)
+    idx['offset'] = idx['offset'] + 100
+    idx['length'] = idx['offset'].shift(-1, fill_value=7000000) - idx['offset']
+    url = 's3://noaa-hrrr-bdp-pds/hrrr.20231104/conus/hrrr.t02z.wrfsfcf05.grib2'
+    refs = references_from_mapping(mapping, idx, url)
+
+    assert len(refs) == 11
+    assert refs[1]['refs']['refc/0.0'] == [url, 449415, 201227]
+    group = open_message(refs[1])
+    assert group['time'][()] == template_run_time + 3600
+    assert group['valid_time'][()] == template_run_time + 6 * 3600
+    assert group['step'][()] == 5.0
+
+
+def test_references_from_mapping_mismatch():
+    idx = read_idx()
+    messages = [make_message(row.offset, row.length, 1699059600) for row in idx.itertuples()]
+    mapping = build_grib_mapping('conus.hrrr.wrfsfcf05.grib2', idx, messages)
+
+    assert references_from_mapping(mapping, idx.iloc[:-1], 's3://bucket/a.grib2') is None
+    changed = idx.copy()
+    changed.loc[3, 'message_key'] = 'TMP:surface:5 hour fcst:'
+    assert references_from_mapping(mapping, changed, 's3://bucket/a.grib2') is None
+
+
+def test_build_grib_mapping_offset_mismatch():
+    idx = read_idx()
+    messages = [make_message(row.offset + 1, row.length, 1699059600) for row in idx.itertuples()]
+    with pytest.raises(ValueError):
+        build_grib_mapping('conus.hrrr.wrfsfcf05.grib2', idx, messages)
+
+
+def test_hrrr_pipeline():
+    pipeline = HRRR_Pipeline()
+    key = 'hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2'
+    assert pipeline.accepts(key)
+    assert not pipeline.accepts(f'{key}.idx')
+    assert pipeline.generate_kerchunk_output_key(key) == 'conus/hrrr.20231104/hrrr.t01z.wrfsfcf05.zarr'
+
+    metadata = pipeline.read_file_metadata(key)
+    assert (metadata.model_date, metadata.model_hour, metadata.offset) == ('20231104', '01', 5)
+
+
+def test_hrrr_pipeline_scan_failure(monkeypatch):
+    def scan_grib(url, **kwargs):
+        raise OSError('Connection reset')
+
+    fs = ETagMemoryFileSystem()
+    fs.pipe('s3://grib-test/hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2', b'GRIB')
+    monkeypatch.setattr(grib, 'get_read_filesystem', lambda: fs)
+    monkeypatch.setattr(grib, 'get_write_filesystem', lambda: fs)
+    monkeypatch.setattr(grib, '_grib2', lambda: types.SimpleNamespace(scan_grib=scan_grib))
+
+    # The failure is raised, so the record is redelivered instead of being reported as kerchunked
+    with pytest.raises(OSError):
+        HRRR_Pipeline().run('us-east-1', 'grib-test', 'hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2', 'grib-test')
+
+    fs.rm('s3://grib-test/hrrr.20231104/conus/hrrr.t01z.wrfsfcf05.grib2')
@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+
+from ingest_tools.keys import parse_nos_keys, parse_rtofs_keys, select_best_time_series, valid_time_keys
+from ingest_tools.nos_ofs import parse_nos_model_run_datestamp_offset
+from ingest_tools.rtofs import parse_rtofs_model_run_datestamp_offset
+
+
+NOS_KEYS = [
+    'nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr',
+    'nos/dbofs/nos.dbofs.fields.n001.20231019.t06z.nc.zarr',
+    'nos/ngofs2/nos.ngofs2.fields.f042.20231003.t09z.nc.zarr',
+    'nos/ngofs2/nos.ngofs2.2ds.f040.20231003.t03z.nc.zarr',
+    'cbofs.20231022/nos.cbofs.fields.n006.20231022.t00z.nc',
+]
+
+RTOFS_KEYS = [
+    'rtofs.20230922/rtofs_glo_2ds_f001_diag.nc',
+    'rtofs/rtofs.20230922.rtofs_glo_2ds_f024_diag.nc.zarr',
+]
+
+
+def test_parse_nos_keys():
+    table = parse_nos_keys(NOS_KEYS)
+    assert list(table['key']) == NOS_KEYS
+    assert list(table['model']) == ['dbofs', 'dbofs', 'ngofs2', 'ngofs2', 'cbofs']
+    assert list(table['model_date']) == ['20230315', '20231019', '20231003', '20231003', '20231022']
+    assert list(table['model_hour']) == ['00', '06', '09', '03', '00']
+    assert list(table['run_type']) == ['f', 'n', 'f', 'f', 'n']
+    assert list(table['offset']) == [1, 1, 42, 40, 6]
+    assert table['model_run_time'][2] == pd.Timestamp('2023-10-03T09')
+
+    expected = [parse_nos_model_run_datestamp_offset(k) for k in NOS_KEYS]
+    assert list(zip(valid_time_keys(table), table['offset'])) == expected
+
+
+def test_parse_rtofs_keys():
+    table = parse_rtofs_keys(RTOFS_KEYS)
+    assert list(table['model']) == ['rtofs', 'rtofs']
+    assert list(table['model_hour']) == ['00', '00']
+
+    expected = [parse_rtofs_model_run_datestamp_offset(k) for k in RTOFS_KEYS]
+    assert list(zip(valid_time_keys(table), table['offset'])) == expected
+
+
+def test_parse_keys_failure():
+    with pytest.raises(ValueError):
+        parse_nos_keys(NOS_KEYS + ['nos/dbofs/nos.dbofs.fields.best.nc.zarr'])
+
+    assert len(parse_nos_keys([])) == 0
+
+
+def test_select_best_time_series():
+    keys = [
+        'nos/dbofs/nos.dbofs.fields.f007.20230315.t00z.nc.zarr',
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t06z.nc.zarr',
+        'nos/dbofs/nos.dbofs.fields.f006.20230315.t00z.nc.zarr',
+        'nos/dbofs/nos.dbofs.fields.n001.20230315.t06z.nc.zarr',
+    ]
+    best = select_best_time_series(parse_nos_keys(keys))
+    assert list(best['key']) == [
+        'nos/dbofs/nos.dbofs.fields.f006.20230315.t00z.nc.zarr',
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t06z.nc.zarr',
+    ]
+    assert list(valid_time_keys(best)) == ['20230315T06', '20230315T07']
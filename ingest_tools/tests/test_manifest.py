@@ -0,0 +1,151 @@
+import datetime
+import hashlib
+
+import fsspec
+from botocore.exceptions import ClientError
+from fsspec.implementations.memory import MemoryFileSystem
+from s3fs.errors import translate_boto_error
+from ingest_tools.manifest import (
+    best_time_series_manifest_files,
+    build_best_time_series_manifest,
+    build_best_time_series_manifest_from_table,
+    generate_best_time_series_manifest_key,
+    prune_best_time_series_manifest,
+    read_best_time_series_manifest,
+    resolve_best_time_series_files,
+    update_best_time_series_manifest,
+    write_best_time_series_manifest,
+)
+from ingest_tools.keys import parse_nos_keys
+from ingest_tools.nos_ofs import parse_nos_model_run_datestamp_offset
+
+
+def test_generate_manifest_key():
+    key = 'nos/dbofs/nos.dbofs.fields.best.nc.zarr'
+    manifest_key = generate_best_time_series_manifest_key(key)
+    assert manifest_key == 'nos/dbofs/nos.dbofs.fields.best.nc.zarr.manifest.json'
+    assert not manifest_key.endswith('.zarr')
+
+
+def test_build_manifest():
+    keys = [
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t06z.nc.zarr',
+        'nos/dbofs/nos.dbofs.fields.f007.20230315.t00z.nc.zarr',
+        'nos/dbofs/nos.dbofs.fields.f006.20230315.t00z.nc.zarr',
+    ]
+    manifest = build_best_time_series_manifest(keys, parse_nos_model_run_datestamp_offset)
+    assert manifest == {
+        '20230315T06': [6, 'nos/dbofs/nos.dbofs.fields.f006.20230315.t00z.nc.zarr'],
+        '20230315T07': [1, 'nos/dbofs/nos.dbofs.fields.f001.20230315.t06z.nc.zarr'],
+    }
+    assert best_time_series_manifest_files(manifest) == [
+        'nos/dbofs/nos.dbofs.fields.f006.20230315.t00z.nc.zarr',
+        'nos/dbofs/nos.dbofs.fields.f001.20230315.t06z.nc.zarr',
+    ]
+
+
+def test_update_manifest():
+    manifest = {'20230315T07': [7, 'nos.dbofs.fields.f007.20230315.t00z.nc.zarr']}
+
+    # A new valid time is always part of the best time series
+    assert update_best_time_series_manifest(manifest, '20230315T08', 8, 'nos.dbofs.fields.f008.20230315.t00z.nc.zarr')
+
+    # A smaller offset for the same valid time replaces the existing entry
+    assert update_best_time_series_manifest(manifest, '20230315T07', 1, 'nos.dbofs.fields.f001.20230315.t06z.nc.zarr')
+    assert manifest['20230315T07'] == [1, 'nos.dbofs.fields.f001.20230315.t06z.nc.zarr']
+
+    # A larger offset for the same valid time does not
+    assert not update_best_time_series_manifest(manifest, '20230315T07', 7, 'nos.dbofs.fields.f007.20230315.t00z.nc.zarr')
+    assert manifest['20230315T07'] == [1, 'nos.dbofs.fields.f001.20230315.t06z.nc.zarr']
+
+    # The same file arriving twice is still part of the best time series
+    assert update_best_time_series_manifest(manifest, '20230315T07', 1, 'nos.dbofs.fields.f001.20230315.t06z.nc.zarr')
+
+
+def test_prune_manifest():
+    manifest = {
+        '20230201T07': [7, 'nos.dbofs.fields.f007.20230201.t00z.nc.zarr'],
+        '20230315T07': [1, 'nos.dbofs.fields.f001.20230315.t06z.nc.zarr'],
+    }
+    expired = prune_best_time_series_manifest(manifest, retention_days=28, now=datetime.datetime(2023, 3, 20))
+    assert expired == ['20230201T07']
+    assert list(manifest) == ['20230315T07']
+
+
+def test_read_write_manifest():
+    fs = fsspec.filesystem('memory')
+    url = 'memory://manifest-test/nos.dbofs.fields.best.nc.zarr.manifest.json'
+
+    assert read_best_time_series_manifest(fs, url) is None
+
+    manifest = {'20230315T07': [1, 'nos.dbofs.fields.f001.20230315.t06z.nc.zarr']}
+    write_best_time_series_manifest(fs, url, manifest)
+    assert read_best_time_series_manifest(fs, url) == manifest
+
+    fs.rm('memory://manifest-test', recursive=True)
+
+
+def test_build_manifest_from_table():
+    keys = [
+        f'nos/dbofs/nos.dbofs.fields.f{offset:03d}.202303{day:02d}.t{hour:02d}z.nc.zarr'
+        for day in range(10, 16) for hour in (0, 6, 12, 18) for offset in range(1, 49)
+    ]
+    manifest = build_best_time_series_manifest_from_table(parse_nos_keys(keys))
+    assert manifest == build_best_time_series_manifest(keys, parse_nos_model_run_datestamp_offset)
+
+
+class ConditionalMemoryFileSystem(MemoryFileSystem):
+    '''
+    Memory filesystem with S3 style ETags and conditional writes. before_write is called once before the next
+    write, to interleave another update with it.
+    '''
+    protocol = 'conditionalmemory'
+    before_write = None
+
+    def info(self, path, **kwargs):
+        info = super().info(path, **kwargs)
+        if info['type'] == 'file':
+            info['ETag'] = f'"{hashlib.md5(self.cat_file(path)).hexdigest()}"'
+        return info
+
+    def _open(self, path, mode='rb', IfMatch=None, IfNoneMatch=None, **kwargs):
+        if 'w' in mode:
+            before_write, self.before_write = self.before_write, None
+            if before_write is not None:
+                before_write()
+            exists = self.exists(path)
+            if (IfNoneMatch == '*' and exists) or (IfMatch is not None and (not exists or self.info(path)['ETag'] != IfMatch)):
+                error = ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'Precondition failed'}}, 'PutObject')
+                raise translate_boto_error(error)
+        return super()._open(path, mode, **kwargs)
+
+
+def test_concurrent_manifest_updates():
+    fs = ConditionalMemoryFileSystem()
+    run = datetime.datetime.utcnow().strftime('%Y%m%d')
+    keys = [f'nos/dbofs/nos.dbofs.fields.f{offset:03d}.{run}.t00z.nc.zarr' for offset in (1, 2, 3)]
+    best_time_series_key = 'nos/dbofs/nos.dbofs.fields.best.nc.zarr'
+    manifest_url = f's3://manifest-test/{generate_best_time_series_manifest_key(best_time_series_key)}'
+
+    def resolve(key):
+        return resolve_best_time_series_files(
+            fs,
+            fs,
+            'manifest-test',
+            [key],
+            'nos/dbofs/nos.dbofs.fields.f[0-9][0-9][0-9].*.t*z.nc.zarr',
+            best_time_series_key,
+            parse_nos_model_run_datestamp_offset,
+        )
+
+    model_date_key, offset = parse_nos_model_run_datestamp_offset(keys[0])
+    write_best_time_series_manifest(fs, manifest_url, {model_date_key: [offset, f's3://manifest-test/{keys[0]}']})
+
+    # The update for the third file writes the manifest after the update for the second file read it
+    fs.before_write = lambda: resolve(keys[2])
+    files = resolve(keys[1])
+
+    assert files == [f's3://manifest-test/{k}' for k in keys]
+    assert best_time_series_manifest_files(read_best_time_series_manifest(fs, manifest_url)) == files
+
+    fs.rm(manifest_url)
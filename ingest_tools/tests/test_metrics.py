@@ -0,0 +1,141 @@
+import json
+
+import fsspec
+import pytest
+
+from ingest_tools.aggregation import generate_kerchunked_aggregation
+from ingest_tools.manifest import read_best_time_series_manifest_version
+from ingest_tools.metrics import (
+    EmbeddedMetricFormatSink,
+    InMemoryMetricsSink,
+    KeyMetrics,
+    PhaseMetrics,
+    phase,
+    read_counts,
+    record_metrics,
+    set_metrics_sink,
+    track_reads,
+)
+from ingest_tools.references import write_references
+
+from helpers import BytesFile, make_refs
+
+
+@pytest.fixture
+def sink():
+    sink = InMemoryMetricsSink()
+    previous = set_metrics_sink(sink)
+    yield sink
+    set_metrics_sink(previous)
+
+
+def test_record_metrics(sink):
+    with record_metrics('ingest', 'a.nc'):
+        with phase('sniff'):
+            pass
+        with phase('translate') as metrics:
+            metrics.output_bytes = 10
+
+    assert len(sink.records) == 1
+    record = sink.records[0]
+    assert record.operation == 'ingest'
+    assert record.key == 'a.nc'
+    assert record.succeeded
+    assert [p.phase for p in record.phases] == ['sniff', 'translate']
+    assert record.phase('translate').output_bytes == 10
+    assert record.duration_seconds >= sum(p.duration_seconds for p in record.phases)
+
+
+def test_record_metrics_on_failure(sink):
+    with pytest.raises(ValueError):
+        with record_metrics('ingest', 'a.nc'):
+            with phase('scan'):
+                raise ValueError('bad file')
+
+    assert len(sink.records) == 1
+    assert not sink.records[0].succeeded
+    assert sink.records[0].phase('scan') is not None
+
+
+def test_phase_without_record_metrics(sink):
+    with phase('translate') as metrics:
+        metrics.output_bytes = 10
+
+    assert len(sink.records) == 0
+
+
+def test_track_reads(sink):
+    f = track_reads(BytesFile(b'x' * 1000, block_size=100))
+
+    with record_metrics('ingest', 'a.nc'):
+        with phase('sniff'):
+            f.read(5)
+        with phase('scan'):
+            f.read(10)
+            f.seek(500)
+            f.read(10)
+
+    record = sink.records[0]
+    assert record.phase('sniff').requests == 1
+    assert record.phase('sniff').bytes_read == 105
+    # The first read is served from the readahead block
+    assert record.phase('scan').requests == 1
+    assert record.phase('scan').bytes_read == 110
+
+    assert read_counts(f).requests == 2
+    assert read_counts(f).bytes_read == 215
+    assert read_counts(BytesFile(b'', block_size=100)).requests == 0
+
+
+def test_write_references_metrics(sink):
+    fs = fsspec.filesystem('memory')
+    refs = {'version': 1, 'refs': {'.zgroup': '{"zarr_format":2}'}}
+
+    with record_metrics('ingest', 'a.nc'):
+        write_references(fs, 'memory://metrics/a.nc.zarr', refs)
+
+    record = sink.records[0]
+    size = len(fs.cat('memory://metrics/a.nc.zarr'))
+    assert record.phase('serialize').output_bytes == size
+    assert record.phase('write').output_bytes == size
+
+
+def test_aggregation_read_metrics(sink):
+    fs = fsspec.filesystem('memory')
+    url = 'memory://metrics/nos.dbofs.fields.forecast.20230315.t00z.nc.zarr'
+    files = [f'memory://metrics/nos.dbofs.fields.f00{i}.20230315.t00z.nc.zarr' for i in (1, 2)]
+    for i, f in enumerate(files):
+        write_references(fs, f, make_refs(3600.0 * (i + 1)))
+
+    with record_metrics('model_run_aggregation', url):
+        with phase('manifest'):
+            read_best_time_series_manifest_version(fs, f'{url}.manifest.json')
+        generate_kerchunked_aggregation(fs, url, files[1:], lambda: files, concat_dims=['ocean_time'], identical_dims=['h'], remote_options={})
+
+    record = sink.records[0]
+    # The HEAD of the missing manifest, and of the missing aggregation
+    assert record.phase('manifest').requests == 1
+    assert record.phase('read').requests >= 1
+    assert record.phase('read_members').requests == 2
+    assert record.phase('read_members').bytes_read == sum(len(fs.cat(f)) for f in files)
+
+    fs.rm('memory://metrics', recursive=True)
+
+
+def test_embedded_metric_format(capsys):
+    metrics = KeyMetrics('ingest', 'a.nc', [PhaseMetrics('translate', duration_seconds=0.5, bytes_read=100, requests=2, output_bytes=50)], duration_seconds=1.0)
+    EmbeddedMetricFormatSink().emit(metrics)
+
+    lines = [json.loads(l) for l in capsys.readouterr().out.splitlines()]
+    assert [l['Phase'] for l in lines] == ['translate', 'total']
+
+    translate, total = lines
+    assert translate['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'ingest_tools'
+    assert translate['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Operation', 'Phase']]
+    assert translate['Operation'] == 'ingest'
+    assert translate['Key'] == 'a.nc'
+    assert translate['Duration'] == 500
+    assert translate['BytesRead'] == 100
+    assert translate['Requests'] == 2
+    assert total['Duration'] == 1000
+    assert total['OutputBytes'] == 50
@@ -0,0 +1,62 @@
+import fsspec
+import numpy as np
+import zarr
+from kerchunk.netCDF3 import NetCDF3ToZarr
+from scipy.io import netcdf_file
+
+from ingest_tools.generic import FileFormat
+from ingest_tools.metrics import read_counts, track_reads
+from ingest_tools.netcdf3 import SharedFileNetCDF3ToZarr
+
+from helpers import BytesFile
+
+
+def write_roms_file(path: str):
+    with netcdf_file(path, 'w') as f:
+        f.createDimension('ocean_time', None)
+        f.createDimension('eta_rho', 10)
+        f.createDimension('xi_rho', 20)
+        f.title = 'test'
+        t = f.createVariable('ocean_time', 'f8', ('ocean_time',))
+        t[:] = [3600.0, 7200.0]
+        t.units = 'seconds since 2023-01-01 00:00:00'
+        f.createVariable('zeta', 'f4', ('ocean_time', 'eta_rho', 'xi_rho'))[:] = np.ones((2, 10, 20))
+        f.createVariable('h', 'f4', ('eta_rho', 'xi_rho'))[:] = np.zeros((10, 20))
+
+
+def test_shared_file_matches_netcdf3_to_zarr(tmp_path):
+    path = str(tmp_path / 'roms.nc')
+    write_roms_file(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    url = 's3://bucket/roms.nc'
+    expected = NetCDF3ToZarr(path).translate()
+    expected['refs'] = {k: [url] + v[1:] if isinstance(v, list) else v for k, v in expected['refs'].items()}
+
+    f = track_reads(BytesFile(data, block_size=64 * 1024, cache_type='blockcache'))
+    assert FileFormat.from_startbytes(f.read(5)) == FileFormat.NETCDF
+    actual = SharedFileNetCDF3ToZarr(f, url).translate()
+
+    assert actual == expected
+    # The format detection, header and inlined arrays are all read from the first block
+    assert read_counts(f).requests == 1
+    assert not f.closed
+
+
+def test_shared_file_inlines_scalar_variables(tmp_path):
+    path = str(tmp_path / 'roms.nc')
+    with netcdf_file(path, 'w') as f:
+        f.createDimension('s_rho', 3)
+        f.createVariable('hc', 'f8', ())[...] = 5.0
+        f.createVariable('Cs_r', 'f8', ('s_rho',))[:] = [-0.75, -0.5, -0.25]
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    refs = SharedFileNetCDF3ToZarr(BytesFile(data, block_size=64 * 1024, cache_type='blockcache'), 's3://bucket/roms.nc').translate()
+
+    assert not isinstance(refs['refs']['hc/0'], list)
+    assert not isinstance(refs['refs']['Cs_r/0'], list)
+    group = zarr.open_group(fsspec.filesystem('reference', fo=refs).get_mapper(''), mode='r')
+    assert group['hc'][...] == 5.0
+    np.testing.assert_array_equal(group['Cs_r'][:], [-0.75, -0.5, -0.25])
@@ -87,3 +87,28 @@ def test_generate_best_time_series_glob_expression():
     key = 'nos/ngofs2/nos.ngofs2.fields.f042.20231003.t09z.nc.zarr'
     glob_expression = nos_ofs.generate_nos_best_time_series_glob_expression(key)
     assert glob_expression == 'nos/ngofs2/nos.ngofs2.fields.f*.*.t*z.nc.zarr'
+
+
+def test_generate_aggregation_keys():
+    key = 'nos/dbofs/nos.dbofs.fields.f001.20230315.t00z.nc.zarr'
+    assert nos_ofs.generate_nos_model_run_key(key) == 'nos/dbofs/nos.dbofs.fields.forecast.20230315.t00z.nc.zarr'
+
+    best_time_series_glob = nos_ofs.generate_nos_best_time_series_glob_expression(key)
+    assert nos_ofs.generate_nos_best_time_series_key(best_time_series_glob) == 'nos/dbofs/nos.dbofs.fields.best.nc.zarr'
+
+    key = 'nos/dbofs/nos.dbofs.fields.n001.20231019.t06z.nc.zarr'
+    assert nos_ofs.generate_nos_model_run_key(key) == 'nos/dbofs/nos.dbofs.fields.nowcast.20231019.t06z.nc.zarr'
+
+
+def test_generate_model_run_member_keys():
+    key = 'nos/cbofs/nos.cbofs.fields.n003.20230315.t06z.nc.zarr'
+    keys = nos_ofs.generate_nos_model_run_member_keys(key, '20230315', '06')
+    assert keys == [f'nos/cbofs/nos.cbofs.fields.n00{i}.20230315.t06z.nc.zarr' for i in range(1, 7)]
+
+    key = 'nos/gomofs/nos.gomofs.fields.f003.20230315.t00z.nc.zarr'
+    keys = nos_ofs.generate_nos_model_run_member_keys(key, '20230315', '00')
+    assert len(keys) == 24
+    assert keys[1] == 'nos/gomofs/nos.gomofs.fields.f006.20230315.t00z.nc.zarr'
+
+    key = 'nos/unknown/nos.unknown.fields.f001.20230315.t00z.nc.zarr'
+    assert nos_ofs.generate_nos_model_run_member_keys(key, '20230315', '00') is None
@@ -1,6 +1,6 @@
 import pytest
 from ingest_tools.nos_ofs import NOS_Pipeline
-from ingest_tools.pipeline import Pipeline, PipelineContext
+from ingest_tools.pipeline import Pipeline, PipelineContext, RoutingTable
 from ingest_tools.rtofs import RTOFS_Pipeline
 
 
@@ -56,4 +56,59 @@ def test_filemetadata_rtofs():
     # TODO: Do we need both hour and offset?
     assert m.model_hour == '1'
     assert m.offset == 1
-    assert m.output_key == 'rtofs.20230922.rtofs_glo_2ds_f001_diag.nc.zarr'
\ No newline at end of file
+    assert m.output_key == 'rtofs.20230922.rtofs_glo_2ds_f001_diag.nc.zarr'
+
+def test_routing_table_matches_accepts():
+    pipelines = {'nos': NOS_Pipeline(), 'rtofs': RTOFS_Pipeline()}
+    context = PipelineContext('us-east-1', 'nextgen-dmac')
+    for name, pipeline in pipelines.items():
+        context.add_pipeline(name, pipeline)
+
+    keys = [
+        'tbofs.20230314/nos.tbofs.fields.n002.20230314.t00z.nc',
+        'ngofs2.20231003/nos.ngofs2.2ds.f042.20231003.t09z.nc',
+        'rtofs.20230922/rtofs_glo_2ds_f001_diag.nc',
+        'rtofs.20230922/rtofs_glo_2ds_f001_diag.nc.idx',
+        'cbofs.20231022/nos.cbofs.stations.forecast.20231022.t00z.nc',
+        'nwm.20231022/nwm.t00z.short_range.channel_rt.f001.conus.nc',
+    ]
+    for key in keys:
+        expected = [p for p in pipelines.values() if p.accepts(key)]
+        assert context.get_matching_pipelines(key) == expected
+
+
+def test_routing_table_prefix_filters():
+    class FilterPipeline(RTOFS_Pipeline):
+        def __init__(self, filters):
+            super().__init__()
+            self.filters = filters
+
+    short = FilterPipeline(['ofs'])
+    long = FilterPipeline(['cbofs'])
+    table = RoutingTable({'short': short, 'long': long})
+
+    assert table.route('cbofs.20231022/nos.cbofs.fields.n006.20231022.t00z.nc') == [short, long]
+    assert table.route('dbofs.20231022/nos.dbofs.fields.n006.20231022.t00z.nc') == [short]
+    assert table.route('nwm.20231022/nwm.t00z.short_range.channel_rt.f001.conus.nc') == []
+    assert RoutingTable({}).route('cbofs.nc') == []
+
+
+def test_pipeline_context_from_entry_points():
+    context = PipelineContext.from_entry_points('us-east-1', 'nextgen-dmac')
+    assert isinstance(context.pipelines['nos_ofs'], NOS_Pipeline)
+    assert isinstance(context.pipelines['rtofs'], RTOFS_Pipeline)
+
+    matching = context.get_matching_pipelines('rtofs.20230922/rtofs_glo_2ds_f001_diag.nc')
+    assert len(matching) == 1
+    assert isinstance(matching[0], RTOFS_Pipeline)
+
+
+def test_pipeline_inline_options():
+    nos = NOS_Pipeline()
+    assert nos.inline_threshold is None
+    assert 'ocean_time' in nos.inline_variables
+
+    rtofs = RTOFS_Pipeline(inline_threshold=1000, inline_variables=[])
+    assert rtofs.inline_threshold == 1000
+    assert rtofs.inline_variables == []
+    assert RTOFS_Pipeline().inline_variables == ['MT', 'Date']
@@ -0,0 +1,226 @@
+import fsspec
+import numpy as np
+import pytest
+import ujson
+import zarr
+from fsspec.implementations.memory import MemoryFileSystem
+from fsspec.implementations.reference import LazyReferenceMapper
+from kerchunk.netCDF3 import NetCDF3ToZarr
+from kerchunk.utils import consolidate
+from scipy.io import netcdf_file
+from ingest_tools.references import (
+    GZIP_MAGIC,
+    PARQUET_MARKER_KEY,
+    ReferenceCompression,
+    ReferenceFormat,
+    is_same_source,
+    inline_whole_variables,
+    iter_json_references,
+    read_many_references,
+    read_references,
+    read_references_metadata,
+    reference_set_key,
+    source_metadata,
+    subchunk_references,
+    write_references,
+)
+
+from helpers import make_refs
+
+
+def open_group(refs) -> zarr.Group:
+    return zarr.open_group(fsspec.filesystem('reference', fo=refs).get_mapper(''), mode='r')
+
+
+def test_read_write_json_references():
+    fs = fsspec.filesystem('memory')
+    url = 'memory://references-test/nos.dbofs.fields.f001.20230315.t00z.nc.zarr'
+
+    assert read_references(fs, url) is None
+
+    refs = make_refs(3600.0)
+    write_references(fs, url, refs, ReferenceFormat.JSON)
+    assert read_references(fs, url) == refs
+    assert read_references(fs, url, ReferenceFormat.JSON) == refs
+    assert read_references(fs, url, ReferenceFormat.PARQUET) is None
+
+    fs.rm('memory://references-test', recursive=True)
+
+
+def test_read_write_parquet_references():
+    fs = fsspec.filesystem('memory')
+    url = 'memory://references-test/nos.dbofs.fields.best.nc.zarr'
+
+    assert read_references(fs, url, ReferenceFormat.PARQUET) is None
+
+    refs = make_refs(3600.0)
+    write_references(fs, url, refs, ReferenceFormat.PARQUET)
+    assert fs.exists(f'{url}/.zmetadata')
+    assert fs.exists(f'{url}/zeta/refs.0.parq')
+    assert not fs.isfile(url)
+    # The marker ends in .zarr, the suffix the aggregation notifications are filtered on
+    assert fs.isfile(f'{url}/{PARQUET_MARKER_KEY}')
+    assert reference_set_key(f'{url}/{PARQUET_MARKER_KEY}') == url
+    assert reference_set_key(url) == url
+
+    # Both an explicit format and detection open the store lazily
+    for reference_format in (None, ReferenceFormat.PARQUET):
+        lazy = read_references(fs, url, reference_format)
+        assert isinstance(lazy, LazyReferenceMapper)
+
+        expected = open_group(refs)
+        actual = open_group(lazy)
+        np.testing.assert_array_equal(actual['ocean_time'][:], expected['ocean_time'][:])
+        np.testing.assert_array_equal(actual['zeta'][:], expected['zeta'][:])
+        assert actual.attrs['title'] == 'test'
+
+    # Rebuilding the store without a variable leaves none of its record blocks behind
+    write_references(fs, url, {k: v for k, v in refs['refs'].items() if not k.startswith('h/')}, ReferenceFormat.PARQUET)
+    assert not fs.exists(f'{url}/h/refs.0.parq')
+    assert fs.exists(f'{url}/zeta/refs.0.parq')
+    assert fs.isfile(f'{url}/{PARQUET_MARKER_KEY}')
+    assert 'h' not in open_group(read_references(fs, url))
+
+    fs.rm('memory://references-test', recursive=True)
+
+
+class MetadataMemoryFileSystem(MemoryFileSystem):
+    '''
+    Memory filesystem that keeps S3 style user metadata and Content-Encoding for the objects it writes
+    '''
+    protocol = 'metadatamemory'
+    object_metadata = {}
+    content_encodings = {}
+
+    def _open(self, path, mode='rb', Metadata=None, ContentEncoding=None, **kwargs):
+        if 'w' in mode:
+            self.object_metadata[self._strip_protocol(path)] = Metadata or {}
+            self.content_encodings[self._strip_protocol(path)] = ContentEncoding
+        return super()._open(path, mode, **kwargs)
+
+    def metadata(self, path):
+        if not self.exists(path):
+            raise FileNotFoundError(path)
+        return self.object_metadata.get(self._strip_protocol(path), {})
+
+
+def test_write_references_skips_identical_references():
+    fs = MetadataMemoryFileSystem()
+    url = 'metadatamemory://references-test/nos.dbofs.fields.f001.20230315.t00z.nc.zarr'
+
+    assert read_references_metadata(fs, url) is None
+    assert write_references(fs, url, make_refs(3600.0), metadata=source_metadata('"abc123"', 1024))
+
+    metadata = read_references_metadata(fs, url)
+    assert is_same_source(metadata, '"abc123"', 1024)
+    assert not is_same_source(metadata, '"abc123"', 2048)
+    assert not is_same_source(metadata, '"def456"', 1024)
+    assert not is_same_source(None, '"abc123"', 1024)
+
+    # Identical references from a new source object keep their data but record the new source
+    assert not write_references(fs, url, make_refs(3600.0), metadata=source_metadata('"def456"', 1024))
+    assert is_same_source(read_references_metadata(fs, url), '"def456"', 1024)
+    assert read_references(fs, url) == make_refs(3600.0)
+    assert not write_references(fs, url, make_refs(3600.0), metadata=source_metadata('"def456"', 1024))
+    assert write_references(fs, url, make_refs(7200.0), metadata=source_metadata('"def456"', 1024))
+    assert is_same_source(read_references_metadata(fs, url), '"def456"', 1024)
+
+    fs.rm('metadatamemory://references-test', recursive=True)
+
+
+def test_iter_json_references():
+    refs = make_refs(3600.0)
+    blocks = list(iter_json_references(refs, block_size=64))
+    assert len(blocks) > 1
+    assert b''.join(blocks) == ujson.dumps(refs).encode()
+
+
+@pytest.mark.parametrize('compression', [ReferenceCompression.GZIP, ReferenceCompression.ZSTD])
+def test_write_compressed_references(compression):
+    if compression == ReferenceCompression.ZSTD:
+        pytest.importorskip('zstandard')
+
+    fs = MetadataMemoryFileSystem()
+    url = 'metadatamemory://references-test/nos.dbofs.fields.best.nc.zarr'
+    refs = make_refs(3600.0)
+
+    assert write_references(fs, url, refs, compression=compression)
+    assert fs.content_encodings[fs._strip_protocol(url)] == compression.name.lower()
+    if compression == ReferenceCompression.GZIP:
+        assert fs.cat(url)[:2] == GZIP_MAGIC
+    assert read_references(fs, url) == refs
+
+    # Unchanged references are only skipped when written with the same compression
+    assert not write_references(fs, url, refs, compression=compression)
+    assert write_references(fs, url, refs)
+    assert fs.content_encodings[fs._strip_protocol(url)] is None
+    assert fs.cat(url) == ujson.dumps(refs).encode()
+
+    fs.rm('metadatamemory://references-test', recursive=True)
+
+
+def test_read_many_references():
+    fs = fsspec.filesystem('memory')
+    urls = [f'memory://references-test/f00{i}.nc.zarr' for i in range(3)]
+    refs = [make_refs(3600.0 * i) for i in range(3)]
+    for url, r, compression in zip(urls, refs, [ReferenceCompression.NONE, ReferenceCompression.GZIP, ReferenceCompression.NONE]):
+        write_references(fs, url, r, compression=compression)
+
+    assert read_many_references(fs, urls) == refs
+
+    with pytest.raises(FileNotFoundError):
+        read_many_references(fs, urls + ['memory://references-test/missing.nc.zarr'])
+
+    fs.rm('memory://references-test', recursive=True)
+
+
+def test_subchunk_netcdf3_references(tmp_path):
+    path = str(tmp_path / 'roms.nc')
+    zeta = np.arange(2 * 10 * 20, dtype='>f4').reshape(2, 10, 20)
+    with netcdf_file(path, 'w') as f:
+        f.createDimension('ocean_time', None)
+        f.createDimension('eta_rho', 10)
+        f.createDimension('xi_rho', 20)
+        f.createVariable('ocean_time', 'f8', ('ocean_time',))[:] = [3600.0, 7200.0]
+        f.createVariable('zeta', 'f4', ('ocean_time', 'eta_rho', 'xi_rho'))[:] = zeta
+        f.createVariable('h', 'f4', ('eta_rho', 'xi_rho'))[:] = zeta[0]
+
+    refs = NetCDF3ToZarr(path, inline_threshold=0).translate()
+    subchunked = subchunk_references(refs, 400)
+
+    assert ujson.loads(subchunked['refs']['zeta/.zarray'])['chunks'] == [1, 5, 20]
+    assert ujson.loads(subchunked['refs']['h/.zarray'])['chunks'] == [5, 20]
+    assert subchunked['refs']['zeta/1.1.0'][1:] == [refs['refs']['zeta/1.0.0'][1] + 400, 400]
+    # The given reference set is left as it is
+    assert ujson.loads(refs['refs']['zeta/.zarray'])['chunks'] == [1, 10, 20]
+
+    group = zarr.open_group(fsspec.filesystem('reference', fo=subchunked).get_mapper(''), mode='r')
+    np.testing.assert_array_equal(group['zeta'][:], zeta)
+    np.testing.assert_array_equal(group['h'][:], zeta[0])
+    np.testing.assert_array_equal(group['zeta'][1, 7, 3:5], zeta[1, 7, 3:5])
+
+
+def test_inline_scalar_variables(tmp_path):
+    path = str(tmp_path / 'roms.nc')
+    with netcdf_file(path, 'w') as f:
+        f.createDimension('s_rho', 3)
+        f.createVariable('hc', 'f8', ())[...] = 5.0
+        f.createVariable('Cs_r', 'f8', ('s_rho',))[:] = [-0.75, -0.5, -0.25]
+
+    refs = NetCDF3ToZarr(path, inline_threshold=0).translate()
+    assert isinstance(refs['refs']['hc/0'], list)
+
+    inlined = inline_whole_variables(refs, ['hc'], {})
+    assert not isinstance(inlined['refs']['hc/0'], list)
+    assert isinstance(inlined['refs']['Cs_r/0'], list)
+    assert open_group(inlined)['hc'][...] == 5.0
+
+
+def test_subchunk_skips_compressed_and_small_chunks():
+    store = {}
+    group = zarr.group(store=store)
+    group.create_dataset('compressed', data=np.zeros((10, 20)), chunks=(10, 20))
+    group.create_dataset('small', data=np.zeros((2, 2)), compressor=None)
+    refs = {'version': 1, 'refs': {k: ['s3://bucket/key.nc', 0, 100] if '.z' not in k else v for k, v in consolidate(store)['refs'].items()}}
+
+    assert subchunk_references(refs, 64)['refs'] == refs['refs']
@@ -0,0 +1,121 @@
+from ingest_tools.scheduler import AggregationScheduler, AggregationTarget, InMemoryQueue
+
+from helpers import make_sqs_record
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def model_run_targets(calls: list, fail: set = frozenset()):
+    def aggregate(target_key):
+        def run(region, bucket, keys):
+            if target_key in fail:
+                raise ValueError(f'Failed to aggregate {target_key}')
+            calls.append((target_key, list(keys)))
+        return run
+
+    def resolve(key):
+        model_run = key.split('/')[0]
+        return [
+            AggregationTarget(f'{model_run}.forecast', aggregate(f'{model_run}.forecast')),
+            AggregationTarget(f'{model_run}.best', aggregate(f'{model_run}.best')),
+        ]
+
+    return resolve
+
+
+def make_keys(model: str, count: int) -> list:
+    return [f'{model}.20230314/nos.{model}.fields.f{i:03d}.20230314.t00z.nc' for i in range(1, count + 1)]
+
+
+def test_events_are_coalesced_by_target():
+    calls = []
+    queue = InMemoryQueue()
+    keys = make_keys('tbofs', 5) + make_keys('cbofs', 2)
+    for key in keys:
+        queue.send(make_sqs_record('', key)['body'])
+
+    scheduler = AggregationScheduler(model_run_targets(calls))
+    assert scheduler.poll(queue) == 7
+
+    assert sorted(calls) == [
+        ('cbofs.20230314.best', keys[5:]),
+        ('cbofs.20230314.forecast', keys[5:]),
+        ('tbofs.20230314.best', keys[:5]),
+        ('tbofs.20230314.forecast', keys[:5]),
+    ]
+    assert len(queue) == 0
+
+
+def test_aggregations_wait_for_the_debounce_window():
+    calls = []
+    clock = FakeClock()
+    queue = InMemoryQueue()
+    scheduler = AggregationScheduler(model_run_targets(calls), debounce_seconds=30, clock=clock)
+    keys = make_keys('tbofs', 3)
+
+    queue.send(make_sqs_record('', keys[0])['body'])
+    scheduler.poll(queue)
+    assert calls == []
+
+    clock.now = 20
+    for key in keys[1:]:
+        queue.send(make_sqs_record('', key)['body'])
+    scheduler.poll(queue)
+    assert calls == []
+
+    # 40 seconds after the first event, but only 20 seconds after the latest
+    clock.now = 40
+    scheduler.poll(queue)
+    assert calls == []
+    assert len(queue) == 3
+
+    clock.now = 50
+    scheduler.poll(queue)
+    assert sorted(calls) == [('tbofs.20230314.best', keys), ('tbofs.20230314.forecast', keys)]
+    assert len(queue) == 0
+
+
+def test_failed_aggregations_are_released():
+    calls = []
+    queue = InMemoryQueue()
+    tbofs_keys = make_keys('tbofs', 2)
+    cbofs_keys = make_keys('cbofs', 1)
+    for key in tbofs_keys + cbofs_keys:
+        queue.send(make_sqs_record('', key)['body'])
+
+    scheduler = AggregationScheduler(model_run_targets(calls, fail={'tbofs.20230314.best'}))
+    scheduler.poll(queue)
+
+    # The tbofs messages are released since one of their aggregations failed
+    assert ('tbofs.20230314.forecast', tbofs_keys) in calls
+    assert sorted(queue.messages) == ['1', '2']
+    assert len(queue.in_flight) == 0
+
+
+def test_handle_batch_reports_failures():
+    calls = []
+    records = [make_sqs_record(str(i), key) for i, key in enumerate(make_keys('tbofs', 2) + make_keys('cbofs', 1))]
+    records.append({'messageId': 'bad', 'body': 'not json'})
+
+    scheduler = AggregationScheduler(model_run_targets(calls, fail={'cbofs.20230314.forecast'}))
+    response = scheduler.handle_batch(records)
+
+    assert sorted(f['itemIdentifier'] for f in response['batchItemFailures']) == ['2', 'bad']
+    assert len(calls) == 3
+
+
+def test_parquet_markers_aggregate_their_store():
+    calls = []
+    keys = make_keys('tbofs', 2)
+    records = [make_sqs_record('1', keys[0]), make_sqs_record('2', f'{keys[1]}/complete.zarr')]
+
+    scheduler = AggregationScheduler(model_run_targets(calls))
+    assert scheduler.handle_batch(records) == {'batchItemFailures': []}
+
+    assert sorted(calls) == [('tbofs.20230314.best', keys), ('tbofs.20230314.forecast', keys)]
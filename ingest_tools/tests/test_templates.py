@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import xarray as xr
+from kerchunk.hdf import SingleHdf5ToZarr, has_visititems_links
+from ingest_tools.templates import (
+    TemplatedHdf5ToZarr,
+    clear_templates,
+    get_template,
+    hdf5_structural_fingerprint,
+)
+
+
+def write_roms_file(path, ocean_time: float, model_date: str):
+    ds = xr.Dataset(
+        {
+            'zeta': (('ocean_time', 'eta_rho', 'xi_rho'), np.full((1, 20, 30), ocean_time, dtype='f4')),
+            'h': (('eta_rho', 'xi_rho'), np.arange(600, dtype='f8').reshape(20, 30)),
+        },
+        coords={'ocean_time': ('ocean_time', [ocean_time])},
+        attrs={'title': 'test', 'history': f'created {model_date}'},
+    )
+    ds['ocean_time'].attrs['units'] = f'seconds since {model_date}'
+    encoding = {'zeta': {'chunksizes': (1, 10, 15), 'zlib': True}}
+    ds.to_netcdf(path, engine='h5netcdf', encoding=encoding)
+    return str(path)
+
+
+@pytest.fixture
+def roms_files(tmp_path):
+    clear_templates()
+    yield [
+        write_roms_file(tmp_path / 'nos.dbofs.fields.f001.20230315.t00z.nc', 3600.0, '2023-03-15'),
+        write_roms_file(tmp_path / 'nos.dbofs.fields.f001.20230315.t06z.nc', 25200.0, '2023-03-15 06:00'),
+    ]
+    clear_templates()
+
+
+def test_fingerprint_ignores_values(roms_files):
+    fingerprints = [hdf5_structural_fingerprint(SingleHdf5ToZarr(f)._h5f) for f in roms_files]
+    assert fingerprints[0] is not None
+    assert fingerprints[0] == fingerprints[1]
+
+
+def test_translate_from_template_matches_full_scan(roms_files):
+    first, second = roms_files
+
+    # The first file is fully scanned and becomes the template
+    assert TemplatedHdf5ToZarr(first).translate() == SingleHdf5ToZarr(first).translate()
+
+    chunker = TemplatedHdf5ToZarr(second)
+    template = get_template(hdf5_structural_fingerprint(chunker._h5f))
+    assert template is not None
+
+    refs = chunker.translate_from_template(template['refs'])
+    assert refs == SingleHdf5ToZarr(second).translate()
+    assert 'seconds since 2023-03-15 06:00' in refs['refs']['ocean_time/.zattrs']
+
+
+def test_template_mismatch_falls_back_to_full_scan(roms_files):
+    first, second = roms_files
+    TemplatedHdf5ToZarr(first).translate()
+
+    # Pretend the template has a chunk that the new file does not
+    template = get_template(hdf5_structural_fingerprint(TemplatedHdf5ToZarr(second)._h5f))
+    template['refs']['zeta/0.2.0'] = [first, 0, 100]
+
+    assert TemplatedHdf5ToZarr(second).translate_from_template(template['refs']) is None
+    assert TemplatedHdf5ToZarr(second).translate() == SingleHdf5ToZarr(second).translate()
+
+
+@pytest.mark.skipif(not has_visititems_links(), reason='preserve_linked_dsets requires h5py 3.11 or later')
+def test_preserve_linked_dsets_is_fully_scanned(roms_files):
+    first, second = roms_files
+    TemplatedHdf5ToZarr(first).translate()
+
+    refs = TemplatedHdf5ToZarr(second).translate(preserve_linked_dsets=True)
+    assert refs == SingleHdf5ToZarr(second).translate(preserve_linked_dsets=True)